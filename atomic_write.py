@@ -0,0 +1,25 @@
+import os
+import threading
+
+
+def write_atomically(path, content, mode=0o666):
+    """Writes the text to the file at path through a temporary file that replaces it once it's
+    complete, so a crash never leaves a half written file and readers only ever see a whole one.
+    The temporary file is named after the process and the thread writing it, so several writers
+    of the same file don't collide. The file is created with mode, less the umask.
+    Raises OSError if the file couldn't be written."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        file_descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(file_descriptor, "w") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Not leaving the temporary file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
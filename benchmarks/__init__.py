@@ -0,0 +1 @@
+"""Offline benchmarks of the invoicing run against the local stand-ins."""
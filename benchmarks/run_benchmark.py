@@ -0,0 +1,446 @@
+"""
+Runs the real main() against local stand-ins of SellerCloud, QuickBooks Online, the databases,
+the FTP server and the SMTP server, with synthetic orders, and reports the orders per second
+and the latency of each stage. ExampleDb runs its own SQL on an SQLite stand-in, so its stages
+time the round trips and the rows moved but not SQL Server's query plans.
+
+    python -m benchmarks.run_benchmark --orders 1000 10000 100000
+
+A run can be recorded to a cassette and replayed from it without the stand-ins answering:
+
+    python -m benchmarks.run_benchmark --orders 1000 --cassette record
+    python -m benchmarks.run_benchmark --orders 1000 --cassette replay --replay-latency
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import pyodbc
+
+import config
+import email_helper
+import main
+from cassette import cassette
+from decimal_rounding import to_cents
+from exampple_db import ExampleDb
+from ftp import FTPManager
+from order import Order, OrderItems
+from invoice import QbInvoice
+from seller_cloud_api import SellerCloudAPI
+from stand_ins.databases import ExampleDbStandIn, QuickBooksDbStandIn
+from stand_ins.ftp_server import FtpStandIn
+from stand_ins.qbo_server import QboStandIn
+from stand_ins.sellercloud_server import SellerCloudStandIn
+from stand_ins.smtp_server import SmtpSink
+
+INVOICE_CSV_HEADERS = {
+    "default": [
+        "po_number",
+        "invoice_number",
+        "invoice_date",
+        "invoice_total_amount",
+        "invoice_subtotal_amount",
+        "invoice_tax_amount",
+        "line_item_sku",
+        "line_item_quantity",
+        "line_item_unit_cost",
+    ],
+    "aag": [
+        "Invoice Number",
+        "SONumber",
+        "Date",
+        "Customer",
+        "CarrierName",
+        "TrackingNumber",
+        "item",
+        "qty",
+        "price",
+    ],
+}
+
+
+class StageTimer:
+    """Times the calls to the functions of each stage, restoring the functions when done."""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def record(self, stage, duration):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(duration)
+
+    def wrap(self, stage, owner, name):
+        function = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+
+        self._replace(owner, name, timed)
+
+    def wrap_iterator(self, stage, owner, name):
+        """Times how long each item of the iterator the function returns takes to come."""
+        function = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            iterator = iter(function(*args, **kwargs))
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - start)
+                yield item
+
+        self._replace(owner, name, timed)
+
+    def _replace(self, owner, name, function):
+        # Keeping what the owner itself had, so a method wrapped on an instance is just removed
+        self._wrapped.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, function)
+
+    def restore(self):
+        for owner, name, function in reversed(self._wrapped):
+            if function is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, function)
+        self._wrapped = []
+
+    def report(self):
+        report = {}
+        for stage, durations in self.durations.items():
+            durations = sorted(durations)
+            report[stage] = {
+                "count": len(durations),
+                "total_s": sum(durations),
+                "p50_ms": _percentile(durations, 50) * 1000,
+                "p95_ms": _percentile(durations, 95) * 1000,
+                "p99_ms": _percentile(durations, 99) * 1000,
+                "max_ms": durations[-1] * 1000,
+            }
+        return report
+
+
+def _percentile(sorted_values, percent):
+    """Nearest rank percentile of the already sorted values."""
+    index = max(0, -(-len(sorted_values) * percent // 100) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def build_orders(order_count, dropshipper_count, max_items, seed=0):
+    """Builds the synthetic ready to invoice orders, with the SellerCloud order of each one
+    and the vendor mapping of their dropshippers."""
+    rng = random.Random(seed)
+    dropshippers = []
+    vendor_mapping = {}
+    for index in range(dropshipper_count):
+        code = f"D{index:02d}"
+        name = f"Dropshipper {index}"
+        dropshippers.append(
+            (
+                (code, f"dropshipper_{index}"),
+                "aag" if index % 4 == 3 else "default",
+                name,
+            )
+        )
+        vendor_mapping[name] = {
+            "ship_method": "UPS",
+            "email": f"{code.lower()}@example.com",
+            "customer_id": 100 + index,
+        }
+
+    orders = []
+    sellercloud_orders = {}
+    for purchase_order_id in range(1, order_count + 1):
+        dropshipper_info, file_format_name, name = dropshippers[
+            rng.randrange(dropshipper_count)
+        ]
+        code = dropshipper_info[0]
+        sellercloud_order_id = str(5000000 + purchase_order_id)
+        items = [
+            (f"SKU-{rng.randrange(10000):05d}-{line}", rng.randint(1, 4))
+            for line in range(rng.randint(1, max_items))
+        ]
+        line_totals = [round(rng.uniform(5, 200), 2) for _ in items]
+        tax = round(sum(line_totals) * 0.07, 2)
+
+        orders.append(
+            (
+                dropshipper_info,
+                file_format_name,
+                Order(
+                    items=OrderItems(
+                        [sku for sku, _ in items], [quantity for _, quantity in items]
+                    ),
+                    purchase_order_id=purchase_order_id,
+                    purchase_order_number=f"{code}{900000 + purchase_order_id}",
+                    sellercloud_order_id=sellercloud_order_id,
+                    order_id=f"{code}{900000 + purchase_order_id}",
+                    shipping=to_cents(rng.uniform(0, 15)),
+                    code=code,
+                    tracking_number=f"1Z{purchase_order_id:016d}",
+                    ship_date="2024/01/02",
+                    city="Miami",
+                    state="FL",
+                    country="US",
+                    postal_code="33101",
+                    address=f"{purchase_order_id} Main St",
+                    dropshipper_name=name,
+                ),
+            )
+        )
+        sellercloud_orders[sellercloud_order_id] = {
+            "TotalInfo": {"Tax": tax, "GrandTotal": round(sum(line_totals) + tax, 2)},
+            "OrderItems": [
+                {"ProductIDOriginal": sku, "LineTotal": line_total}
+                for (sku, _), line_total in zip(items, line_totals)
+            ],
+        }
+
+    return orders, sellercloud_orders, vendor_mapping
+
+
+def run_benchmark(
+    order_count,
+    dropshipper_count=8,
+    max_items=3,
+    sellercloud_latency=0.0,
+    qbo_latency=0.0,
+    db_latency=0.0,
+    verbose=False,
+    processes=1,
+    qbo_throttle_rate=0.0,
+    cassette_mode=None,
+    cassette_path=None,
+    replay_latency=False,
+):
+    """Runs main() once over order_count synthetic orders and returns the measurements.
+    With more than one process the dropshippers are invoiced in worker processes, whose
+    stages are only measured by the trace's operations."""
+    orders, sellercloud_orders, vendor_mapping = build_orders(
+        order_count, dropshipper_count, max_items
+    )
+    ex_db = ExampleDbStandIn(
+        orders, vendor_mapping, INVOICE_CSV_HEADERS, query_latency=db_latency
+    )
+    qb_db = QuickBooksDbStandIn()
+
+    with contextlib.ExitStack() as stack:
+        run_directory = stack.enter_context(tempfile.TemporaryDirectory())
+        sellercloud = stack.enter_context(
+            SellerCloudStandIn(sellercloud_orders, latency=sellercloud_latency)
+        )
+        qbo = stack.enter_context(
+            QboStandIn(latency=qbo_latency, throttle_rate=qbo_throttle_rate)
+        )
+        ftp = stack.enter_context(FtpStandIn())
+        smtp = stack.enter_context(SmtpSink())
+
+        # Pointing every client at the stand-ins
+        for endpoint in config.sellercloud_endpoints.values():
+            endpoint["url"] = endpoint["url"].replace(
+                config.sellercloud_base_url, sellercloud.base_url
+            )
+        config.sellercloud_base_url = sellercloud.base_url
+        config.client_data["environment"] = qbo.discovery_url
+        config.qb_settings["api_url"] = qbo.api_url
+        # The stand-in has no request limits of its own, only the throttling it's given
+        stack.callback(config.qb_settings.update, dict(config.qb_settings))
+        config.qb_settings["requests_per_minute"] = 1_000_000
+        config.qb_settings["batch_requests_per_minute"] = 1_000_000
+        config.ftp_server["server"], config.ftp_server["port"] = ftp.address
+        config.smtp_settings["server"], config.smtp_settings["port"] = smtp.address
+        config.smtp_settings["use_ssl"] = False
+        stack.callback(config.tracing_settings.update, dict(config.tracing_settings))
+        config.tracing_settings["json_path"] = os.path.join(run_directory, "trace.json")
+        stack.callback(config.pipeline_settings.update, dict(config.pipeline_settings))
+        config.pipeline_settings["invoice_processes"] = processes
+        stack.callback(config.cassette_settings.update, dict(config.cassette_settings))
+        stack.callback(
+            cassette.configure,
+            cassette.mode,
+            cassette.path,
+            cassette.replay_latency,
+        )
+        if cassette_mode:
+            config.cassette_settings.update(
+                mode=cassette_mode,
+                path=os.path.abspath(cassette_path),
+                replay_latency=replay_latency,
+            )
+            cassette.configure(
+                cassette_mode, os.path.abspath(cassette_path), replay_latency
+            )
+
+        stack.callback(setattr, pyodbc, "connect", pyodbc.connect)
+        stack.callback(setattr, main, "QuickBooksDb", main.QuickBooksDb)
+        pyodbc.connect = ex_db.connect
+        main.QuickBooksDb = lambda: qb_db
+
+        timer = StageTimer()
+        stack.callback(timer.restore)
+        timer.wrap_iterator("extract_page", ExampleDb, "iter_invoice_ready_orders")
+        timer.wrap("sellercloud_request", SellerCloudAPI, "perform_request")
+        timer.wrap("qbo_lookup", QbInvoice, "get_existing_invoices")
+        timer.wrap("qbo_build", QbInvoice, "build_invoices")
+        timer.wrap("qbo_save", QbInvoice, "save_invoices")
+        timer.wrap("invoice_dropshipper", main, "invoice_dropshipper")
+        timer.wrap("write_file", main, "close_dropshipper_file")
+        timer.wrap("ftp_upload", FTPManager, "_upload_file")
+        timer.wrap("status_write_back", ExampleDb, "update_invoice_status")
+        timer.wrap("email", email_helper, "send_email")
+        timer.wrap("email", main, "send_email")
+
+        # Everything the run writes under tmp/ goes to the run's own directory
+        stack.callback(os.chdir, os.getcwd())
+        os.chdir(run_directory)
+
+        with contextlib.ExitStack() as output:
+            if not verbose:
+                null_output = output.enter_context(open(os.devnull, "w"))
+                output.enter_context(contextlib.redirect_stdout(null_output))
+                output.enter_context(contextlib.redirect_stderr(null_output))
+            start = time.perf_counter()
+            main.main()
+            elapsed = time.perf_counter() - start
+
+        return {
+            "orders": order_count,
+            "elapsed_s": elapsed,
+            "orders_per_s": order_count / elapsed if elapsed else 0,
+            "invoices_created": len(qbo.invoices),
+            "orders_status_updated": ex_db.invoiced_count,
+            "files_uploaded": sum(ftp.uploads.values()),
+            "bytes_uploaded": ftp.bytes_received,
+            "sellercloud_requests": sellercloud.request_count,
+            "qbo_requests": qbo.request_count,
+            "qbo_throttled": qbo.throttled_count,
+            "emails": len(smtp.subjects),
+            "stages": timer.report(),
+            "operations": _load_operations(config.tracing_settings["json_path"]),
+        }
+
+
+def _load_operations(trace_path):
+    """Gets the latency of each I/O operation from the run's trace, if tracing is enabled."""
+    if not os.path.exists(trace_path):
+        return {}
+    with open(trace_path) as trace_file:
+        return json.load(trace_file)["operations"]
+
+
+def print_result(result):
+    print(
+        f"\n{result['orders']} orders in {result['elapsed_s']:.2f}s "
+        f"({result['orders_per_s']:.1f} orders/s)"
+    )
+    print(
+        f"  invoices created: {result['invoices_created']}, "
+        f"status updated: {result['orders_status_updated']}, "
+        f"files uploaded: {result['files_uploaded']} ({result['bytes_uploaded']} bytes), "
+        f"emails: {result['emails']}"
+    )
+    print(
+        f"  requests: SellerCloud {result['sellercloud_requests']}, "
+        f"QBO {result['qbo_requests']} ({result['qbo_throttled']} throttled)"
+    )
+    print(
+        f"  {'stage':<22}{'count':>8}{'total s':>10}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for stage, stats in result["stages"].items():
+        print(
+            f"  {stage:<22}{stats['count']:>8}{stats['total_s']:>10.2f}"
+            f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+            f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+        )
+    if result["operations"]:
+        print(
+            f"  {'operation':<34}{'count':>8}{'errors':>8}{'bytes':>12}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        )
+    for operation, stats in result["operations"].items():
+        print(
+            f"  {operation:<34}{stats['count']:>8}{stats['errors']:>8}{stats['bytes']:>12}"
+            f"{stats['p50_s'] * 1000:>10.2f}{stats['p95_s'] * 1000:>10.2f}"
+            f"{stats['p99_s'] * 1000:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--dropshippers", type=int, default=8)
+    parser.add_argument("--max-items", type=int, default=3)
+    parser.add_argument(
+        "--sellercloud-latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--qbo-latency", type=float, default=0.0, help="seconds per request"
+    )
+    parser.add_argument(
+        "--db-latency", type=float, default=0.0, help="seconds per query"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=1, help="worker processes invoicing"
+    )
+    parser.add_argument(
+        "--qbo-throttle-rate",
+        type=float,
+        default=0.0,
+        help="share of QBO requests answered with a 429",
+    )
+    parser.add_argument(
+        "--cassette",
+        choices=["record", "replay"],
+        help="records the run's requests to a cassette or replays them from it",
+    )
+    parser.add_argument(
+        "--cassette-path",
+        default="cassettes/benchmark_{orders}.jsonl.gz",
+        help="cassette of each run, {orders} is its order count",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        action="store_true",
+        help="waits as long as the recorded requests took when replaying",
+    )
+    parser.add_argument("--json", help="also writes the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="shows the run output")
+    args = parser.parse_args()
+
+    results = []
+    for order_count in args.orders:
+        result = run_benchmark(
+            order_count,
+            args.dropshippers,
+            args.max_items,
+            args.sellercloud_latency,
+            args.qbo_latency,
+            args.db_latency,
+            args.verbose,
+            args.processes,
+            args.qbo_throttle_rate,
+            args.cassette,
+            args.cassette_path.format(orders=order_count),
+            args.replay_latency,
+        )
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2)
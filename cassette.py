@@ -0,0 +1,479 @@
+import base64
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+import requests
+from requests.structures import CaseInsensitiveDict
+from config import (
+    cassette_settings,
+    extraction_settings,
+    journal_settings,
+    qb_settings,
+    sellercloud_settings,
+)
+
+# What the credentials and tokens are recorded as, they're never written to a cassette
+REDACTED = "$redacted"
+
+
+# The local state runs share, which a run through a cassette goes without so its requests only depend on the cassette
+LOCAL_STATE_SETTINGS = [
+    (extraction_settings, "watermark_path"),
+    (sellercloud_settings, "token_path"),
+    (sellercloud_settings, "cache_path"),
+    (qb_settings, "ref_cache_path"),
+    (journal_settings, "path"),
+]
+
+
+class CassetteMissError(Exception):
+    """Raised when replaying a request the cassette has no recording of."""
+
+
+def _encode_value(value):
+    """Makes a value JSON serializable, tagging the types JSON doesn't have so they can be rebuilt."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _encode_value(item) for key, item in value.items()}
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"$decimal": str(value)}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$bytes": base64.b64encode(bytes(value)).decode()}
+    # Anything else, like a uuid, is replayed as its text
+    return str(value)
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return [_decode_value(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            tag, tagged = next(iter(value.items()))
+            if tag == "$datetime":
+                return datetime.fromisoformat(tagged)
+            if tag == "$date":
+                return date.fromisoformat(tagged)
+            if tag == "$decimal":
+                return Decimal(tagged)
+            if tag == "$bytes":
+                return base64.b64decode(tagged)
+        return {key: _decode_value(item) for key, item in value.items()}
+    return value
+
+
+def _encode_error(error):
+    error_class = type(error)
+    return {
+        "type": f"{error_class.__module__}.{error_class.__qualname__}",
+        "message": str(error),
+    }
+
+
+def _decode_error(error):
+    """Rebuilds a recorded error as its own type, so the code replayed handles it the same way."""
+    module_name, _, class_name = error["type"].rpartition(".")
+    try:
+        error_class = getattr(importlib.import_module(module_name), class_name)
+        return error_class(error["message"])
+    except Exception:
+        return CassetteMissError(f"{error['type']}: {error['message']}")
+
+
+def encode_response(response):
+    """Keeps what the callers read of an HTTP response: its status code, headers and body."""
+    try:
+        body = response.content.decode("utf-8")
+    except UnicodeDecodeError:
+        body = response.content
+    return {
+        "status_code": response.status_code,
+        "headers": dict(response.headers),
+        "body": body,
+        "url": response.url,
+    }
+
+
+def redact_response(recorded, keys):
+    """Replaces the values of the keys of a recorded JSON response body with REDACTED."""
+    try:
+        body = json.loads(recorded["body"])
+    except (TypeError, ValueError):
+        return recorded
+    if isinstance(body, dict):
+        for key in keys:
+            if key in body:
+                body[key] = REDACTED
+        recorded["body"] = json.dumps(body)
+    return recorded
+
+
+def decode_response(recorded):
+    response = requests.Response()
+    response.status_code = recorded["status_code"]
+    response.headers = CaseInsensitiveDict(recorded["headers"])
+    body = recorded["body"]
+    response._content = body.encode("utf-8") if isinstance(body, str) else body
+    response.encoding = "utf-8"
+    response.url = recorded["url"]
+    return response
+
+
+class Cassette:
+    """
+    Records the run's external interactions (SellerCloud and QBO responses, database result sets
+    and FTP commands) to a gzipped JSON lines file, or replays them from it, so a production run
+    can be reproduced and profiled offline.
+    Each interaction is found again by its operation and a hash of its request, the same request
+    made more than once gets its recordings in the order they happened. A request that wasn't
+    recorded raises CassetteMissError. The run keeps no local state while recording or replaying
+    (SellerCloud token and cache, QBO refs, journal and watermark), the cassette turns off their
+    settings until it's closed, so its requests only depend on the cassette. Replays can wait as
+    long as the recorded interactions took.
+    Credentials and tokens are recorded as REDACTED, and the file is only readable by the current user.
+    """
+
+    def __init__(self, mode=None, path=None, replay_latency=False):
+        self._lock = threading.Lock()
+        self._overridden = []
+        self.configure(mode, path, replay_latency)
+
+    def configure(self, mode, path, replay_latency=False):
+        """Sets the cassette up to record to path, replay from it, or pass everything through when mode is None.
+        A recording cassette without a path keeps the interactions until they're taken.
+        """
+        if mode not in (None, "record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if mode == "replay" and not path:
+            raise ValueError("Replaying needs the path of a cassette")
+        with self._lock:
+            self._restore()
+            # Turning the local state off until the cassette is closed
+            if mode is not None:
+                for settings, key in LOCAL_STATE_SETTINGS:
+                    self._override(settings, key, None)
+            self.mode = mode
+            self.path = path
+            self.replay_latency = replay_latency
+            self.interactions = []
+            self.misses = 0
+            self._file = None
+            self._by_key = None
+
+    def patch(self, target, name, replacement):
+        """Replaces the name attribute of target while the cassette records or replays, until it's closed."""
+        with self._lock:
+            if self.mode is not None:
+                self._override(target, name, replacement)
+
+    def _override(self, target, key, value):
+        if isinstance(target, dict):
+            self._overridden.append((target, key, target[key]))
+            target[key] = value
+        else:
+            self._overridden.append((target, key, getattr(target, key)))
+            setattr(target, key, value)
+
+    def _restore(self):
+        """Puts back what the cassette overrode, the last override first."""
+        while self._overridden:
+            target, key, value = self._overridden.pop()
+            if isinstance(target, dict):
+                target[key] = value
+            else:
+                setattr(target, key, value)
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def call(self, operation, request, function, encode=None, decode=None):
+        """Runs function, the interaction that sends request to an external system, through the cassette.
+        When recording, its result (through encode) or its error is kept with how long it took.
+        When replaying, function isn't run and the recorded result (through decode) is returned or its error raised.
+        """
+        if self.mode is None:
+            return function()
+
+        key = hashlib.sha1(
+            json.dumps(_encode_value(request), sort_keys=True).encode()
+        ).hexdigest()
+        if self.replaying:
+            return self._replay(operation, key, decode)
+
+        start = time.perf_counter()
+        try:
+            result = function()
+        except Exception as e:
+            self._record(
+                operation, key, None, _encode_error(e), time.perf_counter() - start
+            )
+            raise
+        self._record(
+            operation,
+            key,
+            _encode_value(encode(result) if encode else result),
+            None,
+            time.perf_counter() - start,
+        )
+        return result
+
+    def connect(self, operation, connect, *args, redact=False):
+        """Opens a database connection whose statements go through the cassette. connect(*args) is only
+        called when the statements aren't replayed. A redacting connection records REDACTED instead of
+        its parameters and the values of its result sets, for the tables that hold credentials.
+        """
+        if self.mode is None:
+            return connect(*args)
+        return CassetteConnection(
+            self, operation, None if self.replaying else connect(*args), redact
+        )
+
+    def _record(self, operation, key, result, error, duration):
+        interaction = {
+            "operation": operation,
+            "key": key,
+            "duration": duration,
+            "result": result,
+            "error": error,
+        }
+        with self._lock:
+            if not self.path:
+                self.interactions.append(interaction)
+                return
+            # Writing each interaction as it happens, a long run isn't kept in memory
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = self._open_file()
+            self._file.write(json.dumps(interaction) + "\n")
+
+    def _open_file(self):
+        """Opens the cassette for writing, readable only by the current user."""
+        # Creating the file with its mode before anything is written to it, an existing cassette keeps its mode otherwise
+        file_descriptor = os.open(
+            self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        try:
+            os.fchmod(file_descriptor, 0o600)
+        finally:
+            os.close(file_descriptor)
+        return gzip.open(self.path, "wt", encoding="utf-8")
+
+    def take(self):
+        """Takes the interactions kept so far."""
+        with self._lock:
+            interactions, self.interactions = self.interactions, []
+        return interactions
+
+    def take_misses(self):
+        """Takes the number of requests the replay had no recording of so far."""
+        with self._lock:
+            misses, self.misses = self.misses, 0
+        return misses
+
+    def merge(self, interactions, misses=0):
+        """Records the interactions another cassette took and counts its misses."""
+        with self._lock:
+            self.misses += misses
+        for interaction in interactions:
+            self._record(
+                interaction["operation"],
+                interaction["key"],
+                interaction["result"],
+                interaction["error"],
+                interaction["duration"],
+            )
+
+    def close(self):
+        """Finishes writing the cassette and puts back the local state settings and what it patched.
+        Raises CassetteMissError if the replay had no recording of some requests, which the run may have handled as failures.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._restore()
+        misses = self.take_misses()
+        if misses:
+            raise CassetteMissError(
+                f"The cassette had no recording of {misses} requests of the run"
+            )
+
+    def _load(self):
+        """Loads the recordings of the cassette by request."""
+        self._by_key = {}
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+                for line in cassette_file:
+                    interaction = json.loads(line)
+                    self._by_key.setdefault(
+                        (interaction["operation"], interaction["key"]), deque()
+                    ).append(interaction)
+        except OSError as e:
+            print(f"Error while loading the cassette: {e}")
+            raise
+
+    def _replay(self, operation, key, decode):
+        with self._lock:
+            if self._by_key is None:
+                self._load()
+            recordings = self._by_key.get((operation, key))
+            if not recordings:
+                self.misses += 1
+                raise CassetteMissError(
+                    f"The cassette has no recording left of this {operation} request ({key})"
+                )
+            interaction = recordings.popleft()
+
+        if self.replay_latency:
+            time.sleep(interaction["duration"])
+        if interaction["error"]:
+            raise _decode_error(interaction["error"])
+        result = _decode_value(interaction["result"])
+        return decode(result) if decode else result
+
+
+class CassetteCursor:
+    """
+    Database cursor whose statements go through a cassette, see Cassette.connect. The result set
+    of each statement is read whole when it runs, then fetched from memory.
+    The rows have the attribute and index access of the pyodbc rows.
+    """
+
+    def __init__(self, cassette, operation, cursor, redact=False):
+        self._cassette = cassette
+        self._operation = operation
+        self._cursor = cursor
+        self._redact = redact
+        self._rows = deque()
+
+    @property
+    def fast_executemany(self):
+        return self._cursor.fast_executemany if self._cursor else False
+
+    @fast_executemany.setter
+    def fast_executemany(self, value):
+        if self._cursor:
+            self._cursor.fast_executemany = value
+
+    def execute(self, sql, *params):
+        # The parameters can be given one by one or as a single sequence, like in pyodbc
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        params = list(params)
+        result = self._cassette.call(
+            self._operation,
+            (
+                " ".join(sql.split()),
+                [REDACTED] * len(params) if self._redact else params,
+            ),
+            lambda: self._execute(sql, params),
+            encode=self._redact_result if self._redact else None,
+        )
+        self._rows = deque()
+        if result:
+            row_class = namedtuple("Row", result["columns"], rename=True)
+            self._rows = deque(row_class(*row) for row in result["rows"])
+        return self
+
+    def _execute(self, sql, params):
+        if params:
+            self._cursor.execute(sql, *params)
+        else:
+            self._cursor.execute(sql)
+        if self._cursor.description is None:
+            return None
+        return {
+            "columns": [column[0] for column in self._cursor.description],
+            "rows": [list(row) for row in self._cursor.fetchall()],
+        }
+
+    @staticmethod
+    def _redact_result(result):
+        if result is None:
+            return None
+        return {
+            "columns": result["columns"],
+            "rows": [[REDACTED] * len(row) for row in result["rows"]],
+        }
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        # Keyed by the number of rows written, the rows themselves can hold the time of the run
+        self._cassette.call(
+            self._operation,
+            (" ".join(sql.split()), len(seq_of_params)),
+            lambda: self._executemany(sql, seq_of_params),
+        )
+        self._rows = deque()
+
+    def _executemany(self, sql, seq_of_params):
+        self._cursor.executemany(sql, seq_of_params)
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=1):
+        return [self._rows.popleft() for _ in range(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+
+class CassetteConnection:
+    """Database connection whose cursors go through a cassette, see Cassette.connect.
+    When replaying there's no connection and committing does nothing."""
+
+    def __init__(self, cassette, operation, connection, redact=False):
+        self._cassette = cassette
+        self._operation = operation
+        self._connection = connection
+        self._redact = redact
+
+    def cursor(self):
+        return CassetteCursor(
+            self._cassette,
+            self._operation,
+            self._connection.cursor() if self._connection else None,
+            self._redact,
+        )
+
+    def commit(self):
+        if self._connection:
+            self._connection.commit()
+
+    def rollback(self):
+        if self._connection:
+            self._connection.rollback()
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+
+
+# Cassette of the current run
+cassette = Cassette(
+    cassette_settings["mode"],
+    cassette_settings["path"],
+    cassette_settings["replay_latency"],
+)
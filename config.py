@@ -30,10 +30,16 @@ def create_connection_string(server_config):
 
 ftp_server = {
     "server": "ftp.example.com",
+    "port": 21,
     "username": "example",
     "password": "password",
 }
 
+ftp_settings = {
+    "max_connections": 4,  # Files uploaded at the same time, each over its own connection
+    "max_attempts": 3,  # Tries per file before reporting it as not uploaded
+}
+
 
 client_data = {
     "client_id": "example_client_id",
@@ -44,6 +50,18 @@ client_data = {
     "access_token": "example_access_token",
 }
 
+qb_settings = {
+    "ref_cache_path": "tmp/qb_ref_cache.json",  # None keeps the refs cache in memory for the run only
+    "ref_cache_ttl": 24 * 60 * 60,  # Seconds a persisted ref is trusted before resolving it again
+    "batch_size": 30,  # Invoices per QBO batch request (30 is the QBO maximum), 1 saves them one by one
+    "api_url": None,  # Overrides the QBO API base url, e.g. with the local stand-in server's
+    "requests_per_minute": 500,  # QBO's limit of requests per realm, split between the worker processes
+    "batch_requests_per_minute": 40,  # QBO's limit of batch requests per realm
+    "max_concurrency": 10,  # QBO's limit of concurrent requests per realm
+    "target_latency": 5.0,  # Seconds, slower requests make the scheduler send fewer at once
+    "max_attempts": 5,  # Attempts of a throttled or failed request before giving up
+}
+
 
 sellercloud_credentials = {
     "Username": "username",
@@ -66,6 +84,56 @@ sellercloud_endpoints = {
     },
 }
 
+sellercloud_settings = {
+    "max_workers": 8,  # Concurrent GET_ORDERS requests, 1 fetches the orders one at a time
+    "cache_path": "tmp/sellercloud_cache.sqlite3",  # Local cache of the orders, None always asks SellerCloud
+    "cache_ttl": 7 * 24 * 60 * 60,  # Seconds a cached order is used before asking SellerCloud again
+    "cache_max_entries": 100000,  # Most recently used orders kept in the cache
+    "token_path": "tmp/sellercloud_token.json",  # Where the token is kept between runs, None gets one every run
+    "token_lifetime": 60 * 60,  # Seconds a token lasts when SellerCloud doesn't say
+    "token_refresh_margin": 5 * 60,  # Seconds before expiring that a new token is requested
+}
+
+file_settings = {
+    "stream_invoice_files": True,  # Writes the invoice rows to the csv files as the orders are invoiced
+}
+
+pipeline_settings = {
+    "queue_size": 2,  # Dropshippers or files waiting between two stages of the run
+    "invoice_processes": 1,  # Worker processes invoicing the dropshippers by hash bucket, 1 invoices them in this process
+}
+
+extraction_settings = {
+    "page_size": 1000,  # Orders read from ExampleDb per page, None reads them all in a single query
+    "watermark_path": None,  # Where the extraction watermark is kept, e.g. "tmp/extraction_watermark.json", None reads every order
+    "watermark_lookback": 24 * 60 * 60,  # Seconds before the watermark that are read again for late tracking dates
+    "watermark_full_sweep_interval": 7 * 24 * 60 * 60,  # Seconds between the runs that read every order despite the watermark, None never does
+}
+
+tracing_settings = {
+    "enabled": True,  # Records the latency of the run's requests, queries, uploads and emails
+    "json_path": "tmp/traces/run_{run_date}.json",  # Spans and latency summaries of each run, None skips it
+    "prometheus_path": None,  # Prometheus textfile with the latency summaries, e.g. for node_exporter
+    "max_spans": 10000,  # Most recent spans kept for the JSON file, the summaries count all of them
+}
+
+journal_settings = {
+    "path": "tmp/run_journal.sqlite3",  # Journal a crashed run is resumed from, None disables it
+    "max_age": 30 * 24 * 60 * 60,  # Seconds an unfinished order is kept in the journal, None keeps it until it's finished
+}
+
+cassette_settings = {
+    "mode": None,  # "record" captures the SellerCloud, QBO, database and FTP traffic of the run, "replay" feeds it back offline
+    "path": "tmp/cassettes/run.jsonl.gz",  # Cassette the run is recorded to or replayed from
+    "replay_latency": False,  # Waits as long as each recorded interaction took when replaying
+}
+
+
+smtp_settings = {
+    "server": "smtp.gmail.com",
+    "port": 465,
+    "use_ssl": True,  # False connects in plain text, e.g. to the local SMTP sink
+}
 
 SENDER_EMAIL = "sender_email@domain.com"
 SENDER_PASSWORD = "sender_password"
@@ -1,9 +1,42 @@
-from decimal import Decimal, ROUND_HALF_UP
+import math
+import numpy as np
+
+# Largest number of cents a float holds exactly, larger amounts can't be real order amounts
+MAX_CENTS = 2**53
+
+
+def to_cents(amounts):
+    """Converts dollar amounts to integer cents rounding half up, either one amount or a whole
+    array or column at once. The amounts are first rounded to a millionth of a cent so the
+    float noise of the multiplication (1.005 * 100 = 100.49999999999999) still rounds like
+    the decimal value does.
+    Raises ValueError if an amount is missing, isn't a finite number or is too large to be one.
+    """
+    if np.ndim(amounts) == 0:
+        if amounts is None:
+            raise ValueError("The amount is missing")
+        cents = round(float(amounts) * 100, 6)
+        if not math.isfinite(cents) or abs(cents) > MAX_CENTS:
+            raise ValueError(f"{amounts} is not a valid amount")
+        return int(math.copysign(math.floor(abs(cents) + 0.5), cents))
+
+    # None becomes NaN in a float array, so it's caught with the other invalid amounts
+    cents = np.round(np.asarray(amounts, dtype=np.float64) * 100, 6)
+    invalid = ~np.isfinite(cents) | (np.abs(cents) > MAX_CENTS)
+    if invalid.any():
+        raise ValueError(
+            f"{np.asarray(amounts, dtype=object)[invalid].tolist()} are not valid amounts"
+        )
+    return (np.sign(cents) * np.floor(np.abs(cents) + 0.5)).astype(np.int64)
+
+
+def from_cents(cents):
+    """Converts integer cents back to dollars, giving the same float as the written amount."""
+    if np.ndim(cents) == 0:
+        return int(cents) / 100
+    return np.asarray(cents, dtype=np.int64) / 100
 
 
 def round_to_decimal(number):
     """Round a number to a given precision."""
-    decimal_number = Decimal(str(number))
-    rounded_number = decimal_number.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-    return float(rounded_number)
+    return from_cents(to_cents(number))
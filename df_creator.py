@@ -1,116 +1,96 @@
 import pandas as pd
-from decimal_rounding import round_to_decimal
+from decimal_rounding import to_cents
+from invoice_formats import INVOICE_FORMATS
 
 
 class DfCreator:
-    def __init__(self, invoice_csv_headers, dropshipper_data):
+    def __init__(self, invoice_csv_headers, dropshipper_data, invoice_file=None):
         self.file_format_name = dropshipper_data["file_format_name"]
+        self.headers = invoice_csv_headers[self.file_format_name]
 
-        # Creating a dataframe to store the invoice data
-        self.invoice_file_df = pd.DataFrame(
-            columns=invoice_csv_headers[self.file_format_name]
-        )
+        # Storing the invoice data as tuples in header order, the dataframe is built only once from them
+        self.rows = []
 
-    def populate_df(self, order):
-        """Populates the dataframe with the order data."""
-        try:
+        # When an invoice file writer is given, the rows are streamed to it instead of being stored
+        self.invoice_file = invoice_file
 
-            if self.file_format_name == "default":
-                row = {
-                    "po_number": order["purchase_order_number"],
-                    "invoice_number": order["order_id"],
-                    "invoice_date": order["ship_date"],
-                    "invoice_total_amount": order["subtotal"],
-                    "invoice_subtotal_amount": round_to_decimal(
-                        order["subtotal"] - order["tax"]
-                    ),
-                    "invoice_tax_amount": order["tax"],
-                }
-                for item in order["items"]:
-                    sku, quantity, unit_cost = item
-                    row["line_item_sku"] = sku
-                    row["line_item_quantity"] = quantity
-                    row["line_item_unit_cost"] = unit_cost
-
-                    self.invoice_file_df = self.invoice_file_df._append(
-                        row, ignore_index=True
-                    )
-
-            # If the file format is aag, the invoice data is stored in a different way
-            elif self.file_format_name == "aag":
-                row = {}
-                for item in order["items"]:
-                    sku, quantity, unit_cost = item
-                    row = {
-                        "Invoice Number": order["order_id"],
-                        "SONumber": order["purchase_order_number"],
-                        "Date": order["ship_date"],
-                        "Customer": "auto_accessories_garage",
-                        "CarrierName": "FEDEX_GROUND",
-                        "TrackingNumber": order["tracking_number"],
-                        "item": sku,
-                        "qty": quantity,
-                        "price": unit_cost * quantity,
-                    }
-                    self.invoice_file_df = self.invoice_file_df._append(
-                        row, ignore_index=True
-                    )
-                tax_row = {
-                    "Invoice Number": order["order_id"],
-                    "SONumber": order["purchase_order_number"],
-                    "Date": order["ship_date"],
-                    "Customer": "auto_accessories_garage",
-                    "CarrierName": "FEDEX_GROUND",
-                    "TrackingNumber": order["tracking_number"],
-                    "item": "Taxes",
-                    "qty": 1,
-                    "price": order["tax"],
-                }
-                self.invoice_file_df = self.invoice_file_df._append(
-                    tax_row, ignore_index=True
-                )
-                shipping_row = {
-                    "Invoice Number": order["order_id"],
-                    "SONumber": order["purchase_order_number"],
-                    "Date": order["ship_date"],
-                    "Customer": "auto_accessories_garage",
-                    "CarrierName": "FEDEX_GROUND",
-                    "TrackingNumber": order["tracking_number"],
-                    "item": "SHIPPING",
-                    "qty": 1,
-                    "price": order["shipping"],
-                }
-                self.invoice_file_df = self.invoice_file_df._append(
-                    shipping_row, ignore_index=True
-                )
-
-            return True
+        # Compiling the file format's row emitter once for all the orders of the file
+        invoice_format = INVOICE_FORMATS.get(self.file_format_name)
+        self.emit_rows = (
+            invoice_format.compile(self.headers) if invoice_format else None
+        )
 
+    @property
+    def invoice_file_df(self):
+        """Builds the dataframe with all the invoice data added so far."""
+        invoice_file_df = pd.DataFrame(self.rows, columns=self.headers, dtype=object)
+
+        # Keeping the csv output of the row by row appends, where a column starting with a float is a float column
+        if self.rows:
+            for index, header in enumerate(self.headers):
+                if isinstance(self.rows[0][index], float):
+                    try:
+                        invoice_file_df[header] = invoice_file_df[header].astype(float)
+                    except (TypeError, ValueError):
+                        pass
+
+        return invoice_file_df
+
+    def prepare_orders(self, orders):
+        """Builds the rows of the orders without adding them, so the orders can be validated before they're invoiced.
+        Returns the rows of each order and the orders whose rows couldn't be built."""
+        if self.emit_rows is None:
+            print(
+                f"Error while populating dataframe: unknown file format {self.file_format_name}"
+            )
+            return {}, list(orders)
+
+        failed_orders = []
+        try:
+            rows_by_order = self.emit_rows(orders, by_order=True)
+        except Exception:
+            # Building the rows order by order to find the ones that fail
+            rows_by_order = {}
+            for order in orders:
+                try:
+                    rows_by_order.update(self.emit_rows([order], by_order=True))
+                except Exception as e:
+                    print(f"Error while populating dataframe: {e}")
+                    failed_orders.append(order)
+
+        return rows_by_order, failed_orders
+
+    def add_rows(self, rows):
+        """Adds rows prepare_orders built to the dataframe, or streams them to the invoice file."""
+        try:
+            if self.invoice_file:
+                self.invoice_file.write_rows(rows)
+            else:
+                self.rows.extend(rows)
         except Exception as e:
             print(f"Error while populating dataframe: {e}")
-
             return False
 
+        return True
+
     def _order_invoice_matcher(self, order, invoice):
         order_items = {}
-        order["subtotal"] = invoice.TotalAmt
+        order.subtotal = to_cents(invoice.TotalAmt)
 
         for line in invoice.Line:
             if line.Description == "Shipping":
 
-                order["shipping"] = line.Amount
+                order.shipping = to_cents(line.Amount)
 
             elif line.Description == "Taxes":
 
-                order["tax"] = line.Amount
+                order.tax = to_cents(line.Amount)
 
             elif line.DetailType == "SalesItemLineDetail":
 
                 # order_items[line.Description] = round(float(line.Amount), 2)
-                order_items[line.Description] = line.Amount
+                order_items[line.Description] = to_cents(line.Amount)
 
-        for i in range(len(order["items"])):
-            sku, quantity, _ = order["items"][i]
-            order["items"][i] = (sku, quantity, order_items[sku])
+        order.items.price([order_items[sku] for sku in order.items.skus])
 
         return order
@@ -1,12 +1,15 @@
 import smtplib
 from email.message import EmailMessage
-from config import SENDER_EMAIL, SENDER_PASSWORD, RECIPIENT_EMAILS
+from config import SENDER_EMAIL, SENDER_PASSWORD, RECIPIENT_EMAILS, smtp_settings
 import os
 import getpass
 import socket
+import queue
+import threading
+from tracing import span
 
 
-def send_email(subject, body):
+def _create_message(subject, body):
     current_dir = os.getcwd()
     folder_name = os.path.basename(current_dir)
     computer_name = socket.gethostname()
@@ -20,11 +23,83 @@ def send_email(subject, body):
     msg["Subject"] = f"{subject} : {folder_name}"
     msg["From"] = SENDER_EMAIL
     msg["To"] = ", ".join(RECIPIENT_EMAILS)
+    return msg
+
+
+def send_email(subject, body):
+    msg = _create_message(subject, body)
 
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
+        smtp_class = smtplib.SMTP_SSL if smtp_settings["use_ssl"] else smtplib.SMTP
+        with span("smtp.send") as email_span:
+            email_span.bytes = len(msg.as_bytes())
+            with smtp_class(smtp_settings["server"], smtp_settings["port"]) as server:
+                server.login(SENDER_EMAIL, SENDER_PASSWORD)
+                server.send_message(msg)
         print("Email sent successfully.")
     except Exception as e:
         print(f"Error sending email: {e}")
+
+
+class NotificationCollector:
+    """
+    Collects the notifications raised during a run so they are sent together in a single
+    digest email at the end, instead of opening an SMTP connection for each one.
+    Urgent notifications are sent right away by a background thread without blocking the caller.
+    """
+
+    def __init__(self):
+        self.notifications = []
+        self._lock = threading.Lock()
+        self._urgent = queue.Queue()
+        self._sender = None
+
+    def add(self, subject, body):
+        """Queues a notification for the digest."""
+        with self._lock:
+            self.notifications.append((subject, body))
+
+    def take(self):
+        """Takes the queued notifications out of the collector."""
+        with self._lock:
+            notifications, self.notifications = self.notifications, []
+        return notifications
+
+    def send_urgent(self, subject, body):
+        """Sends a notification on its own from the background sender thread."""
+        with self._lock:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_urgent, daemon=True)
+                self._sender.start()
+        self._urgent.put((subject, body))
+
+    def _send_urgent(self):
+        while True:
+            subject, body = self._urgent.get()
+            send_email(subject, body)
+            self._urgent.task_done()
+
+    def send_digest(self, subject="SellerCloud invoicing notifications"):
+        """Sends all the queued notifications in one email and waits for the urgent ones."""
+        self._urgent.join()
+
+        notifications = self.take()
+        if not notifications:
+            return
+
+        body = "\n\n".join(
+            f"{index}. {notification_subject}\n{notification_body}"
+            for index, (notification_subject, notification_body) in enumerate(
+                notifications, start=1
+            )
+        )
+        send_email(f"{subject} ({len(notifications)})", body)
+
+
+# Notifications of the current run
+notifications = NotificationCollector()
+
+
+def notify(subject, body):
+    """Adds a notification to the digest sent at the end of the run."""
+    notifications.add(subject, body)
@@ -1,26 +1,30 @@
 import pyodbc
-from config import create_connection_string, db_config
-from decimal_rounding import round_to_decimal
-from datetime import datetime
+from config import create_connection_string, db_config, extraction_settings
+from decimal_rounding import from_cents, to_cents
+from order import Order, OrderItems
+from datetime import datetime, timedelta
+import json
+import os
+import time
 from tqdm import tqdm
+from tracing import span
+from cassette import cassette
+from email_helper import notify
+from atomic_write import write_atomically
 
 
 class ExampleDb:
-    def __init__(self):
-        try:
-            self.conn = pyodbc.connect(create_connection_string(db_config["ExampleDb"]))
-            self.cursor = self.conn.cursor()
-        except pyodbc.Error as e:
-            print(f"Error establishing connection to the ExampleDb database: {e}")
-            raise
+    # Number of rows pulled from the cursor on each fetchmany call
+    FETCH_SIZE = 5000
+    # Number of orders whose invoice status is updated and committed at a time
+    WRITE_BACK_CHUNK_SIZE = 1000
+    # Number of order ids in each order items query, SQL Server takes at most 2100 parameters per statement
+    ORDER_ITEMS_CHUNK_SIZE = 2000
 
-    def get_invoice_ready_orders(self):
-        """Gets all the untracked orders from the ExampleDb database."""
-        try:
-            self.cursor.execute(
-                """
-                SELECT   
-                    po.id,     
+    # Everything after the SELECT of the ready to invoice orders query, shared by the full and the paged queries
+    READY_ORDERS_QUERY = """
+                    po.id,
+                    po.dropshipper_id,
                     po.purchase_order_number,
                     po.sellercloud_order_id,
                     po.shipping_cost,
@@ -42,54 +46,50 @@ class ExampleDb:
                 JOIN DropshipperFileFormats dff ON dff.dropshipper_id = d.id
                 JOIN FileFormats ff ON ff.id = dff.format_id
                 WHERE po.tracking_number IS NOT NULL AND ff.type = 'invoice' AND po.is_invoiced = 0
-                """
+    """
+
+    def __init__(self):
+        try:
+            self.conn = cassette.connect(
+                "exampledb",
+                pyodbc.connect,
+                create_connection_string(db_config["ExampleDb"]),
             )
+            self.cursor = self.conn.cursor()
+        except pyodbc.Error as e:
+            print(f"Error establishing connection to the ExampleDb database: {e}")
+            raise
 
-            rows = self.cursor.fetchall()
+        self.watermark_path = extraction_settings["watermark_path"]
+        # When the last run that read every order ran, in seconds since the epoch
+        self.full_sweep_at = None
 
-            dropshippers_untracked_orders = {}
+    def get_invoice_ready_orders(self):
+        """Gets all the untracked orders from the ExampleDb database."""
+        try:
+            with span("exampledb.ready_orders") as query_span:
+                self.cursor.execute(f"SELECT {ExampleDb.READY_ORDERS_QUERY}")
+                rows = self.cursor.fetchall()
+                query_span.attributes["rows"] = len(rows)
 
-            for row in tqdm(rows, desc="Getting ready to invoice orders"):
-                # Creating a tuple to identify the dropshipper
-                dropshipper_info = (row.code, row.ftp_folder_name)
-                items = self._get_invoice_ready_order_items(row.id)
-
-                order = {
-                    "items": items,
-                    "purchase_order_number": row.purchase_order_number,
-                    "sellercloud_order_id": row.sellercloud_order_id,
-                    "tax": "",  # Because is null
-                    "shipping": round_to_decimal(row.shipping_cost),
-                    "subtotal": "",  # Because is null
-                    "code": row.code,
-                    "tracking_number": row.tracking_number,
-                    "ship_date": row.tracking_date.strftime("%Y/%m/%d"),
-                    "city": row.city,
-                    "state": row.state,
-                    "country": row.country,
-                    "postal_code": row.zip,
-                    "address": row.address,
-                    "dropshipper_name": row.name,
-                }
-                # Making sure that the dropshipper code is included in the order id
-                code_length = len(row.code)
-                if row.purchase_order_number[:code_length] == row.code:
-                    order["order_id"] = row.purchase_order_number
-                else:
-                    order["order_id"] = row.code + row.purchase_order_number
+            # Loading the items of every ready order in a single round trip
+            order_items = self._get_invoice_ready_order_items()
 
-                # Adding the order to the dictionary using the dropshipper info as the key
-                if dropshippers_untracked_orders.get(dropshipper_info):
-                    dropshippers_untracked_orders[dropshipper_info]["orders"].append(
-                        order
-                    )
+            dropshippers_untracked_orders = {}
 
-                else:
-                    dropshippers_untracked_orders[dropshipper_info] = {
-                        "orders": [order],
-                        # The file format name is used to determine the csv headers
-                        "file_format_name": row.file_format_name,
-                    }
+            shipping = self._shipping_cents(rows)
+
+            for row, row_shipping in zip(
+                tqdm(rows, desc="Getting ready to invoice orders"), shipping
+            ):
+                if row_shipping is None:
+                    continue
+                self._add_order(
+                    dropshippers_untracked_orders,
+                    row,
+                    order_items.get(row.id) or OrderItems(),
+                    row_shipping,
+                )
 
             return dropshippers_untracked_orders
 
@@ -97,44 +97,283 @@ class ExampleDb:
             print(f"Error while storing purchase orders: {e}")
             raise
 
-    def _get_invoice_ready_order_items(self, id):
-        """Gets all the untracked order items from the ExampleDb database."""
+    def iter_invoice_ready_orders(self, page_size, watermark=None):
+        """Yields the untracked orders in pages of page_size orders, each page grouped by dropshipper
+        like get_invoice_ready_orders. The orders are read in dropshipper order with keyset pagination,
+        so each query only reads its page. When a watermark is given, only the orders tracked since then are read.
+        """
+        last_key = None
+        while True:
+            try:
+                conditions = []
+                params = [page_size]
+                if watermark is not None:
+                    conditions.append("po.tracking_date >= ?")
+                    params.append(watermark)
+                # Continuing right after the last order of the previous page
+                if last_key is not None:
+                    conditions.append(
+                        "(po.dropshipper_id > ? OR (po.dropshipper_id = ? AND po.id > ?))"
+                    )
+                    params.extend([last_key[0], last_key[0], last_key[1]])
+
+                query = f"SELECT TOP (?) {ExampleDb.READY_ORDERS_QUERY}"
+                for condition in conditions:
+                    query += f" AND {condition}"
+                query += " ORDER BY po.dropshipper_id, po.id"
+
+                with span("exampledb.ready_orders_page") as query_span:
+                    self.cursor.execute(query, params)
+                    rows = self.cursor.fetchall()
+                    query_span.attributes["rows"] = len(rows)
+                if not rows:
+                    return
+
+                # Loading the items of the page's orders only
+                order_items = self._get_invoice_ready_order_items(
+                    [row.id for row in rows]
+                )
+
+                shipping = self._shipping_cents(rows)
+
+                dropshippers_untracked_orders = {}
+                for row, row_shipping in zip(rows, shipping):
+                    if row_shipping is None:
+                        continue
+                    self._add_order(
+                        dropshippers_untracked_orders,
+                        row,
+                        order_items.get(row.id) or OrderItems(),
+                        row_shipping,
+                    )
+                last_key = (rows[-1].dropshipper_id, rows[-1].id)
+
+            except Exception as e:
+                print(f"Error while storing purchase orders: {e}")
+                raise
+
+            yield dropshippers_untracked_orders
+
+            # A page that isn't full is the last one
+            if len(rows) < page_size:
+                return
+
+    def _shipping_cents(self, rows):
+        """Gets the shipping cost of each row in cents, None for the orders whose shipping cost isn't valid,
+        which are reported and left out."""
         try:
-            self.cursor.execute(
-                """
-                SELECT
-                    poi.sku,
-                    poi.quantity
-                FROM PurchaseOrderItems poi
-                WHERE poi.purchase_order_id = ?
-                """,
-                id,
-            )
-            rows = self.cursor.fetchall()
+            # Rounding the whole shipping cost column to cents at once
+            return to_cents([row.shipping_cost for row in rows]).tolist()
+        except ValueError:
+            pass
+
+        shipping = []
+        for row in rows:
+            try:
+                shipping.append(to_cents(row.shipping_cost))
+            except ValueError as e:
+                print(f"Order {row.purchase_order_number} has no valid shipping cost")
+                notify(
+                    f"Order {row.purchase_order_number} has no valid shipping cost",
+                    f"The shipping cost of the order in the database is not a valid amount: {e}. No invoice was created.",
+                )
+                shipping.append(None)
+        return shipping
+
+    def _add_order(self, dropshippers_untracked_orders, row, items, shipping):
+        """Creates the order of the row and adds it to its dropshipper."""
+        # Creating a tuple to identify the dropshipper
+        dropshipper_info = (row.code, row.ftp_folder_name)
+
+        # Making sure that the dropshipper code is included in the order id
+        code_length = len(row.code)
+        if row.purchase_order_number[:code_length] == row.code:
+            order_id = row.purchase_order_number
+        else:
+            order_id = row.code + row.purchase_order_number
 
-            untracked_order_items = [(row.sku, row.quantity) for row in rows]
+        order = Order(
+            items=items,
+            purchase_order_id=row.id,
+            purchase_order_number=row.purchase_order_number,
+            sellercloud_order_id=row.sellercloud_order_id,
+            order_id=order_id,
+            shipping=shipping,
+            code=row.code,
+            tracking_number=row.tracking_number,
+            ship_date=row.tracking_date.strftime("%Y/%m/%d"),
+            city=row.city,
+            state=row.state,
+            country=row.country,
+            postal_code=row.zip,
+            address=row.address,
+            dropshipper_name=row.name,
+        )
+
+        # Adding the order to the dictionary using the dropshipper info as the key
+        if dropshippers_untracked_orders.get(dropshipper_info):
+            dropshippers_untracked_orders[dropshipper_info]["orders"].append(order)
+
+        else:
+            dropshippers_untracked_orders[dropshipper_info] = {
+                "orders": [order],
+                # The file format name is used to determine the csv headers
+                "file_format_name": row.file_format_name,
+            }
+
+    def _get_invoice_ready_order_items(self, order_ids=None):
+        """Gets the items of all the untracked orders from the ExampleDb database grouped by order id.
+        When order_ids is given, only the items of those orders are read."""
+        try:
+            with span("exampledb.order_items") as query_span:
+                untracked_order_items = {}
+                if order_ids is None:
+                    self.cursor.execute(
+                        """
+                        SELECT
+                            poi.purchase_order_id,
+                            poi.sku,
+                            poi.quantity
+                        FROM PurchaseOrderItems poi
+                        JOIN PurchaseOrders po ON po.id = poi.purchase_order_id
+                        WHERE po.tracking_number IS NOT NULL AND po.is_invoiced = 0
+                        ORDER BY poi.purchase_order_id
+                        """
+                    )
+                    self._fetch_order_items(untracked_order_items)
+                else:
+                    for start in range(
+                        0, len(order_ids), ExampleDb.ORDER_ITEMS_CHUNK_SIZE
+                    ):
+                        chunk = order_ids[
+                            start : start + ExampleDb.ORDER_ITEMS_CHUNK_SIZE
+                        ]
+                        placeholders = ", ".join("?" * len(chunk))
+                        self.cursor.execute(
+                            f"""
+                            SELECT
+                                poi.purchase_order_id,
+                                poi.sku,
+                                poi.quantity
+                            FROM PurchaseOrderItems poi
+                            WHERE poi.purchase_order_id IN ({placeholders})
+                            ORDER BY poi.purchase_order_id
+                            """,
+                            chunk,
+                        )
+                        self._fetch_order_items(untracked_order_items)
+                query_span.attributes["rows"] = sum(
+                    len(items) for items in untracked_order_items.values()
+                )
 
-            # return untracked_order_items, items_price_total
             return untracked_order_items
 
         except Exception as e:
             print(f"Error while storing purchase order items: {e}")
             raise
 
-    def get_vendor_mapping(self):
-        """Gets the vendor mapping from the ExampleDb database"""
+    def _fetch_order_items(self, untracked_order_items):
+        """Adds the order items of the query just executed to untracked_order_items, by order id."""
+        # Streaming the rows in batches instead of loading them all at once
+        while True:
+            rows = self.cursor.fetchmany(ExampleDb.FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                untracked_order_items.setdefault(
+                    row.purchase_order_id, OrderItems()
+                ).append(row.sku, row.quantity)
+
+    def load_watermark(self):
+        """Loads the tracking date the previous runs left the extraction at, None to read every order.
+        Every order is read again once the last full sweep is older than the sweep interval.
+        """
+        if not self.watermark_path or not os.path.exists(self.watermark_path):
+            return None
         try:
-            self.cursor.execute(
-                """
+            with open(self.watermark_path) as watermark_file:
+                saved_watermark = json.load(watermark_file)
+            watermark = datetime.fromisoformat(saved_watermark["tracking_date"])
+            self.full_sweep_at = saved_watermark.get("full_sweep_at")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error while loading the extraction watermark: {e}")
+            return None
+
+        # Reading every order from time to time, so an order tracked before the watermark is never skipped for good
+        sweep_interval = extraction_settings["watermark_full_sweep_interval"]
+        if sweep_interval is not None and (
+            self.full_sweep_at is None
+            or time.time() - self.full_sweep_at >= sweep_interval
+        ):
+            return None
+
+        # Going back a bit to pick up the orders whose tracking date was set late
+        return watermark - timedelta(seconds=extraction_settings["watermark_lookback"])
+
+    def update_watermark(self, watermark=None):
+        """Moves the watermark to the tracking date of the oldest order that still isn't invoiced,
+        or of the newest tracked order when every order is invoiced, and saves it for the next runs.
+        watermark is the one the run read the orders from, None when it read every order.
+        """
+        if not self.watermark_path:
+            return
+        try:
+            query = """
                 SELECT
-                    name,
-                    ship_method,
-                    invoice_email,
-                    quickbook_id
-                FROM Dropshippers WHERE code != 'ABS'
+                    MIN(CASE WHEN po.is_invoiced = 0 THEN po.tracking_date END) AS pending_date,
+                    MAX(po.tracking_date) AS last_date
+                FROM PurchaseOrders po
+                JOIN DropshipperFileFormats dff ON dff.dropshipper_id = po.dropshipper_id
+                JOIN FileFormats ff ON ff.id = dff.format_id
+                WHERE po.tracking_number IS NOT NULL AND ff.type = 'invoice'
                 """
+            params = []
+            if watermark is not None:
+                query += " AND po.tracking_date >= ?"
+                params.append(watermark)
+            with span("exampledb.watermark"):
+                self.cursor.execute(query, params)
+                row = self.cursor.fetchone()
+        except Exception as e:
+            print(f"Error while updating the extraction watermark: {e}")
+            raise
+
+        new_watermark = row.pending_date or row.last_date
+        if new_watermark is None:
+            return
+
+        # A run without a watermark read every order
+        if watermark is None:
+            self.full_sweep_at = time.time()
+
+        try:
+            write_atomically(
+                self.watermark_path,
+                json.dumps(
+                    {
+                        "tracking_date": new_watermark.isoformat(),
+                        "full_sweep_at": self.full_sweep_at,
+                    }
+                ),
             )
-            rows = self.cursor.fetchall()
+        except OSError as e:
+            print(f"Error while saving the extraction watermark: {e}")
+
+    def get_vendor_mapping(self):
+        """Gets the vendor mapping from the ExampleDb database"""
+        try:
+            with span("exampledb.vendor_mapping"):
+                self.cursor.execute(
+                    """
+                    SELECT
+                        name,
+                        ship_method,
+                        invoice_email,
+                        quickbook_id
+                    FROM Dropshippers WHERE code != 'ABS'
+                    """
+                )
+                rows = self.cursor.fetchall()
             vendor_mapping = {}
             for row in rows:
                 vendor_mapping[row.name] = {
@@ -152,19 +391,20 @@ class ExampleDb:
     def get_invoice_csv_headers(self):
         """Gets the csv headers for the invoice files."""
         try:
-            self.cursor.execute(
-                """
-                SELECT 
-                    f.name AS file_format_name,
-                    STRING_AGG(fd.header_name, ', ') AS header_names
-                FROM fileformats f 
-                JOIN fileformatdetails fd ON fd.format_id = f.id
-                WHERE f.type = 'invoice'
-                GROUP BY f.name
-                ORDER BY f.name;
-                """
-            )
-            rows = self.cursor.fetchall()
+            with span("exampledb.csv_headers"):
+                self.cursor.execute(
+                    """
+                    SELECT 
+                        f.name AS file_format_name,
+                        STRING_AGG(fd.header_name, ', ') AS header_names
+                    FROM fileformats f 
+                    JOIN fileformatdetails fd ON fd.format_id = f.id
+                    WHERE f.type = 'invoice'
+                    GROUP BY f.name
+                    ORDER BY f.name;
+                    """
+                )
+                rows = self.cursor.fetchall()
             headers = {
                 row.file_format_name: row.header_names.split(", ") for row in rows
             }
@@ -175,56 +415,145 @@ class ExampleDb:
 
     def update_invoice_status(self, pos_invoiced):
         """Updates the invoice status of the given purchase order number."""
-        po_update_data = []
-        items_update_data = []
+        # The updates of each order with the updates of its items, so a chunk always has whole orders
+        order_updates = []
+        invoiced_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
         for order in pos_invoiced:
             subtotal = 0
-            for item in order["items"]:
-                sku, quantity, price = item
+            # Keyed by sku so a repeated sku keeps the last price, like the row by row updates did
+            item_prices = {}
+            for sku, quantity, line_total in order.items:
+                # The unit price, like the sellercloud line total over the quantity always was
+                price = from_cents(line_total) / quantity
                 subtotal += price
-                items_update_data.append((price, order["purchase_order_number"], sku))
-            po_update_data.append(
+                item_prices[sku] = price
+            order_updates.append(
                 (
-                    subtotal,
-                    order["shipping"],
-                    order["tax"],
-                    order["subtotal"],
-                    datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-                    order["purchase_order_number"],
+                    (
+                        order.purchase_order_id,
+                        subtotal,
+                        from_cents(order.shipping),
+                        from_cents(order.tax),
+                        from_cents(order.subtotal),
+                        invoiced_date,
+                    ),
+                    [
+                        (order.purchase_order_id, sku, price)
+                        for sku, price in item_prices.items()
+                    ],
                 )
             )
 
         try:
-            self.cursor.executemany(
-                """
-                UPDATE PurchaseOrders
-                SET 
-                subtotal = ?,
-                shipping_cost = ?,
-                tax = ?,
-                total = ?,
-                is_invoiced = 1,
-                invoiced_date = ?
-                WHERE purchase_order_number = ?
-                """,
-                po_update_data,
-            )
+            self._create_invoice_status_tables()
 
-            self.cursor.executemany(
-                """
-                UPDATE PurchaseOrderItems
-                SET 
-                price = ?
-                WHERE purchase_order_id = (SELECT id FROM PurchaseOrders WHERE purchase_order_number = ?) AND sku = ?
-                """,
-                items_update_data,
-            )
+            # Sending the rows in bulk instead of one statement per row
+            self.cursor.fast_executemany = True
+
+            # Committing chunk by chunk so the PurchaseOrders rows are only locked for a chunk's updates
+            for start in tqdm(
+                range(0, len(order_updates), ExampleDb.WRITE_BACK_CHUNK_SIZE),
+                desc="Updating invoice status",
+            ):
+                chunk = order_updates[start : start + ExampleDb.WRITE_BACK_CHUNK_SIZE]
+                po_update_data = [po_row for po_row, _ in chunk]
+                items_update_data = [
+                    item_row for _, item_rows in chunk for item_row in item_rows
+                ]
+
+                with span("exampledb.update_invoice_status", orders=len(chunk)):
+                    self.cursor.executemany(
+                        """
+                        INSERT INTO #InvoicedOrders
+                        (purchase_order_id, subtotal, shipping_cost, tax, total, invoiced_date)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        po_update_data,
+                    )
+                    if items_update_data:
+                        self.cursor.executemany(
+                            """
+                            INSERT INTO #InvoicedItems (purchase_order_id, sku, price)
+                            VALUES (?, ?, ?)
+                            """,
+                            items_update_data,
+                        )
 
-            self.conn.commit()
+                    self.cursor.execute(
+                        """
+                        UPDATE po
+                        SET
+                        subtotal = io.subtotal,
+                        shipping_cost = io.shipping_cost,
+                        tax = io.tax,
+                        total = io.total,
+                        is_invoiced = 1,
+                        invoiced_date = io.invoiced_date
+                        FROM PurchaseOrders po
+                        JOIN #InvoicedOrders io ON io.purchase_order_id = po.id
+                        """
+                    )
+                    self.cursor.execute(
+                        """
+                        UPDATE poi
+                        SET
+                        price = ii.price
+                        FROM PurchaseOrderItems poi
+                        JOIN #InvoicedItems ii ON ii.purchase_order_id = poi.purchase_order_id AND ii.sku = poi.sku
+                        """
+                    )
+                    self.cursor.execute("TRUNCATE TABLE #InvoicedOrders")
+                    self.cursor.execute("TRUNCATE TABLE #InvoicedItems")
+
+                    self.conn.commit()
+
+            self._drop_invoice_status_tables()
         except Exception as e:
+            self.conn.rollback()
             print(f"Error while updating invoice status: {e}")
             raise
+        finally:
+            self.cursor.fast_executemany = False
+
+    def _create_invoice_status_tables(self):
+        """Creates the temp tables the invoice status updates are loaded into, with the same column types
+        as the tables they update."""
+        self._drop_invoice_status_tables()
+        # Casting the id so the temp table doesn't take its identity property
+        self.cursor.execute(
+            """
+            SELECT TOP 0
+                CAST(id AS BIGINT) AS purchase_order_id,
+                subtotal,
+                shipping_cost,
+                tax,
+                total,
+                invoiced_date
+            INTO #InvoicedOrders
+            FROM PurchaseOrders
+            """
+        )
+        self.cursor.execute(
+            """
+            SELECT TOP 0
+                purchase_order_id,
+                sku,
+                price
+            INTO #InvoicedItems
+            FROM PurchaseOrderItems
+            """
+        )
+        self.conn.commit()
+
+    def _drop_invoice_status_tables(self):
+        self.cursor.execute(
+            """
+            IF OBJECT_ID('tempdb..#InvoicedOrders') IS NOT NULL DROP TABLE #InvoicedOrders;
+            IF OBJECT_ID('tempdb..#InvoicedItems') IS NOT NULL DROP TABLE #InvoicedItems;
+            """
+        )
+        self.conn.commit()
 
     def close(self):
         self.conn.close()
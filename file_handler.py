@@ -1,4 +1,5 @@
 import os
+import csv
 
 
 class FileHandler:
@@ -14,9 +15,7 @@ class FileHandler:
         """Saves the tracking data to a file."""
         if invoice_data_df.empty:
             return False
-        directory_path = self._create_directory_structure(ftp_folder_name)
-        date_str = self.report_date.strftime(FileHandler.DATE_FORMAT)
-        file_path = f"{directory_path}\\Invoice_{date_str}.csv"
+        file_path = self._create_file_path(ftp_folder_name)
 
         try:
             invoice_data_df.to_csv(file_path, index=False)
@@ -25,6 +24,16 @@ class FileHandler:
             print(f"Error while saving tracking data to file: {e}")
             raise
 
+    def open_invoice_file(self, ftp_folder_name, headers):
+        """Opens a writer that streams the invoice rows straight to the dropshipper's csv file."""
+        return InvoiceFileWriter(self, ftp_folder_name, headers)
+
+    def _create_file_path(self, ftp_folder_name):
+        """Creates the directory structure and returns the path of the invoice file."""
+        directory_path = self._create_directory_structure(ftp_folder_name)
+        date_str = self.report_date.strftime(FileHandler.DATE_FORMAT)
+        return f"{directory_path}\\Invoice_{date_str}.csv"
+
     def _create_directory_structure(self, ftp_folder_name):
         """Creates the directory structure for the tracking files."""
         datetime_str = self.report_date.strftime(
@@ -34,7 +43,62 @@ class FileHandler:
             FileHandler.BASE_DIRECTORY, ftp_folder_name, datetime_str
         )
 
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
+        # The worker processes can create the folders at the same time
+        os.makedirs(dir_path, exist_ok=True)
 
         return dir_path
+
+
+class InvoiceFileWriter:
+    """
+    Writes invoice rows to the dropshipper's csv file as they are added, without building a dataframe.
+    The file is only created when the first row is written, so dropshippers without rows get no file,
+    the same way save_data_to_file skips empty dataframes.
+    """
+
+    def __init__(self, file_handler, ftp_folder_name, headers):
+        self.file_handler = file_handler
+        self.ftp_folder_name = ftp_folder_name
+        self.headers = headers
+        self.file_path = None
+        self.file = None
+        self.writer = None
+        self.float_columns = None
+
+    def write_rows(self, rows):
+        """Writes the rows, given as tuples in header order, to the file."""
+        if not rows:
+            return
+        try:
+            if self.file is None:
+                self.file_path = self.file_handler._create_file_path(
+                    self.ftp_folder_name
+                )
+                # Same line endings and quoting as DataFrame.to_csv
+                self.file = open(self.file_path, "w", newline="", encoding="utf-8")
+                self.writer = csv.writer(self.file, lineterminator=os.linesep)
+                self.writer.writerow(self.headers)
+                # Like in a dataframe, a column starting with a float is a float column
+                self.float_columns = [isinstance(value, float) for value in rows[0]]
+
+            self.writer.writerows(self._format_row(row) for row in rows)
+        except Exception as e:
+            print(f"Error while saving tracking data to file: {e}")
+            raise
+
+    def _format_row(self, row):
+        return [
+            (
+                float(value)
+                if is_float and isinstance(value, int) and not isinstance(value, bool)
+                else value
+            )
+            for value, is_float in zip(row, self.float_columns)
+        ]
+
+    def close(self):
+        """Closes the file and returns its path, or False if no rows were written."""
+        if self.file is None:
+            return False
+        self.file.close()
+        return self.file_path
@@ -1,58 +1,145 @@
 import os
+import io
 import ftplib
-from config import ftp_server
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import ftp_server, ftp_settings
 from tqdm import tqdm
-from email_helper import send_email
+from email_helper import notifications
+from tracing import span
+from cassette import cassette
 
 
 class FTPManager:
     def __init__(self):
         self.host = ftp_server["server"]
+        self.port = ftp_server.get("port", 21)
         self.username = ftp_server["username"]
         self.password = ftp_server["password"]
+        self.max_connections = ftp_settings["max_connections"]
+        self.max_attempts = ftp_settings["max_attempts"]
+
+        # Every upload thread keeps its own connection, all of them are closed at the end
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
 
     def upload_files(self, all_paths):
-        """Uploads files to both the dropshipper's and the log's folders in the FTP server."""
-        try:
-            # Starting connection to FTP
-            self.ftp = ftplib.FTP(self.host)
-            self.ftp.login(self.username, self.password)
+        """Uploads files to both the dropshipper's and the log's folders in the FTP server.
+        The files are uploaded in parallel over a small pool of connections and a file that
+        keeps failing doesn't stop the others. all_paths can be any iterable, the files are
+        uploaded as they come.
+        """
+        failed_paths = []
+        with ThreadPoolExecutor(max_workers=max(self.max_connections, 1)) as executor:
+            uploads = {
+                path: executor.submit(self._upload_file, path)
+                for path in tqdm(all_paths, desc="Uploading files to FTP server")
+            }
+            for path, upload in uploads.items():
+                error = upload.result()
+                if error:
+                    print(f"There was an error uploading {path} to FTP server: {error}")
+                    failed_paths.append(path)
 
-            for path in tqdm(all_paths, desc="Uploading files to FTP server"):
-                ftp_folder_name, file_name = self._path_decomposer(path)
+        self._close_connections()
 
-                if ftp_folder_name != "absolute_trade":
-                    # List of directories to upload the file
-                    ftp_directories = [
-                        f"dropshipper_logs/invoice_logs/{ftp_folder_name}",
-                        f"dropshipper/{ftp_folder_name}/invoices",
-                    ]
+        if failed_paths:
+            paths = "\n\t".join(failed_paths)
+            notifications.send_urgent(
+                "There was an error uploading the invoice files to FTP server",
+                f"The following invoice files were not uploaded to the FTP server, please upload them manually:\n\t{paths}",
+            )
 
-                    for ftp_directory in ftp_directories:
-                        # Reset to the root directory
-                        self.ftp.cwd("/")
+        return failed_paths
 
-                        # Change to the remote directory
-                        self.ftp.cwd(ftp_directory)
+    def _upload_file(self, path):
+        """Uploads a file to its FTP folders, retrying with a new connection if it fails.
+        Returns the last error if it couldn't be uploaded."""
+        ftp_folder_name, file_name = self._path_decomposer(path)
 
-                        # Uploading file
-                        with open(path, "rb") as local_file:
-                            self.ftp.storbinary(
-                                "STOR " + os.path.basename(path), local_file
-                            )
+        if ftp_folder_name == "absolute_trade":
+            return None
 
-            self.ftp.quit()
+        # List of directories to upload the file
+        ftp_directories = [
+            f"dropshipper_logs/invoice_logs/{ftp_folder_name}",
+            f"dropshipper/{ftp_folder_name}/invoices",
+        ]
 
-        except ftplib.all_errors as e:
-            # Closing
-            self.ftp.quit()
+        try:
+            # Reading the file only once for both uploads
+            with open(path, "rb") as local_file:
+                file_data = local_file.read()
+        except OSError as e:
+            return e
 
-            print(f"There was an error uploading the invoice files to FTP server: {e}")
-            paths = "\n".join(all_paths)
-            send_email(
-                "There was an error uploading the invoice files to FTP server",
-                f"The following invoice files were not uploaded to the FTP server, please upload them manually:\n\t{paths}",
+        try:
+            # The file names have the run's date, so an upload is told apart by its folder only
+            cassette.call(
+                "ftp",
+                ftp_folder_name,
+                lambda: self._store_file(path, file_data, ftp_directories),
             )
+            return None
+        except ftplib.all_errors as e:
+            return e
+
+    def _store_file(self, path, file_data, ftp_directories):
+        """Stores the file in each of the directories, raising the last error if every attempt fails."""
+        for attempt in range(self.max_attempts):
+            try:
+                ftp = self._get_connection()
+                for ftp_directory in ftp_directories:
+                    self._change_directory(ftp, ftp_directory)
+                    with span("ftp.stor", directory=ftp_directory) as upload_span:
+                        upload_span.bytes = len(file_data)
+                        ftp.storbinary(
+                            "STOR " + os.path.basename(path), io.BytesIO(file_data)
+                        )
+                return
+            except ftplib.all_errors:
+                # The connection might be broken, the next attempt starts a new one
+                self._drop_connection()
+                if attempt == self.max_attempts - 1:
+                    raise
+
+    def _get_connection(self):
+        """Gets the connection of the current thread, opening it if needed."""
+        ftp = getattr(self._local, "ftp", None)
+        if ftp is None:
+            with span("ftp.connect"):
+                ftp = ftplib.FTP()
+                ftp.connect(self.host, self.port)
+                ftp.login(self.username, self.password)
+            # Keeping track of the current directory to skip changing to it again
+            self._local.current_directory = None
+            self._local.ftp = ftp
+            with self._connections_lock:
+                self._connections.append(ftp)
+        return ftp
+
+    def _change_directory(self, ftp, ftp_directory):
+        if self._local.current_directory != ftp_directory:
+            ftp.cwd("/" + ftp_directory)
+            self._local.current_directory = ftp_directory
+
+    def _drop_connection(self):
+        ftp = getattr(self._local, "ftp", None)
+        self._local.ftp = None
+        if ftp is not None:
+            with self._connections_lock:
+                self._connections.remove(ftp)
+            ftp.close()
+
+    def _close_connections(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
 
     def _path_decomposer(self, path):
         """Decomposes the path into the FTP folder name and the file name.""" ""
@@ -1,5 +1,12 @@
-from config import client_data
+from config import client_data, pipeline_settings, qb_settings
+from tracing import span
+from decimal_rounding import from_cents
+from qbo_scheduler import QboScheduler
+from atomic_write import write_atomically
+from cassette import cassette, decode_response, encode_response
 from intuitlib.client import AuthClient
+from intuitlib.utils import get_discovery_doc
+import intuitlib.client
 from quickbooks import QuickBooks
 from quickbooks.objects import (
     Invoice,
@@ -12,6 +19,25 @@ from quickbooks.objects import (
 )
 from datetime import datetime
 from quickbooks.objects.base import Ref, Address, EmailAddress
+from quickbooks.utils import build_choose_clause
+from quickbooks.batch import BatchManager
+from quickbooks.objects.batchrequest import BatchOperation
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import time
+from urllib.parse import urlsplit
+
+
+def _cassette_discovery_doc(environment, session=None):
+    """Gets the discovery document AuthClient asks for through the cassette."""
+    return cassette.call(
+        "qbo_discovery",
+        # Told apart by the path only, in case it's the url of another host
+        urlsplit(environment)[2:],
+        lambda: get_discovery_doc(environment, session=session),
+    )
 
 
 def format_date(date_str, input_format="%m/%d/%Y", output_format="%Y-%m-%d"):
@@ -19,12 +45,31 @@ def format_date(date_str, input_format="%m/%d/%Y", output_format="%Y-%m-%d"):
 
 
 class QbInvoice:
-    def __init__(self, current_refresh_token):
+    # Doc numbers per "DocNumber IN (...)" query, keeps the query under QBO's length limit
+    DOC_NUMBER_CHUNK_SIZE = 100
+    # Longest DocNumber QBO accepts
+    DOC_NUMBER_MAX_LENGTH = 21
+    # Largest amount QBO accepts, it takes at most 10 digits before the decimal point
+    AMOUNT_MAX = 9_999_999_999.99
+    # Maximum number of results QBO returns per query page
+    QUERY_PAGE_SIZE = 1000
+
+    def __init__(self, current_refresh_token, access_token=None):
+        # A replayed run never refreshes the tokens, the requests don't reach QBO
+        if cassette.replaying and access_token is None:
+            access_token = "replayed_access_token"
+        # AuthClient gets its discovery document over the network too
+        cassette.patch(intuitlib.client, "get_discovery_doc", _cassette_discovery_doc)
+
+        # With an access token the client reuses that session instead of refreshing the tokens,
+        # which is how the worker processes share the tokens the main process refreshed
         self.auth_client = AuthClient(
             client_id=client_data["client_id"],
             client_secret=client_data["client_secret"],
             environment=client_data["environment"],
             redirect_uri=client_data["redirect_uri"],
+            access_token=access_token,
+            refresh_token=current_refresh_token if access_token else None,
         )
         self.client = QuickBooks(
             auth_client=self.auth_client,
@@ -32,18 +77,153 @@ class QbInvoice:
             company_id=client_data["realm_id"],
         )
 
+        # Pointing the client to another QBO API, like the local stand-in server
+        if qb_settings["api_url"]:
+            self.client.api_url_v3 = qb_settings["api_url"]
+            self.client.sandbox_api_url_v3 = qb_settings["api_url"]
+
+        # Recording or replaying each HTTP exchange, under the scheduler so the retries are replayed as they happened
+        if cassette.mode:
+            self.client.process_request = self._cassette_request(
+                self.client.process_request
+            )
+
+        # Sending every request through the scheduler, each worker process gets its share of the realm's limits
+        processes = max(1, pipeline_settings["invoice_processes"])
+        self.scheduler = QboScheduler(
+            requests_per_minute=qb_settings["requests_per_minute"] / processes,
+            batch_requests_per_minute=qb_settings["batch_requests_per_minute"]
+            / processes,
+            max_concurrency=max(1, qb_settings["max_concurrency"] // processes),
+            target_latency=qb_settings["target_latency"],
+            max_attempts=qb_settings["max_attempts"],
+        )
+        self.client.process_request = self.scheduler.wrap(self.client.process_request)
+
+        # Refs don't change between invoices, so each one is resolved once and reused
+        # Across runs too
+        self.ref_cache_path = qb_settings["ref_cache_path"]
+        self.ref_cache_ttl = qb_settings["ref_cache_ttl"]
+        self.ref_cache = self._load_ref_cache()
+
+    def _cassette_request(self, process_request):
+        """Wraps the process_request method of the client so its requests go through the cassette."""
+
+        def cassette_request(request_type, url, headers="", params="", data=""):
+            # The requestid and the batch item ids are new on every run, so they're left out of the request
+            request_params = {
+                key: value
+                for key, value in (params or {}).items()
+                if key != "requestid"
+            }
+            request_data = data
+            bids = []
+            if url.rstrip("/").endswith("/batch") and data:
+                request_data = json.loads(data)
+                for index, item in enumerate(request_data["BatchItemRequest"]):
+                    bids.append(item["bId"])
+                    item["bId"] = index
+
+            def encode(response):
+                recorded = encode_response(response)
+                for index, bid in enumerate(bids):
+                    recorded["body"] = recorded["body"].replace(
+                        f'"{bid}"', f'"$bId{index}"'
+                    )
+                return recorded
+
+            def decode(recorded):
+                for index, bid in enumerate(bids):
+                    recorded["body"] = recorded["body"].replace(
+                        f'"$bId{index}"', f'"{bid}"'
+                    )
+                return decode_response(recorded)
+
+            return cassette.call(
+                "qbo",
+                (
+                    request_type,
+                    url.split("/v3/company/")[-1],
+                    request_params,
+                    request_data,
+                ),
+                lambda: process_request(
+                    request_type, url, headers=headers, params=params, data=data
+                ),
+                encode=encode,
+                decode=decode,
+            )
+
+        return cassette_request
+
+    def _load_ref_cache(self):
+        """Loads the refs persisted by previous runs that haven't expired."""
+        if not self.ref_cache_path or not os.path.exists(self.ref_cache_path):
+            return {}
+        try:
+            with open(self.ref_cache_path) as cache_file:
+                cached_refs = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            print(f"Error while loading the QuickBooks refs cache: {e}")
+            return {}
+
+        ref_cache = {}
+        now = time.time()
+        for key, cached_ref in cached_refs.items():
+            if now - cached_ref["cached_at"] < self.ref_cache_ttl:
+                ref = Ref()
+                ref.value = cached_ref["value"]
+                ref.name = cached_ref["name"]
+                ref.type = cached_ref["type"]
+                ref_cache[key] = (ref, cached_ref["cached_at"])
+
+        return ref_cache
+
+    def _save_ref_cache(self):
+        """Persists the refs cache so the next runs don't have to resolve the refs again."""
+        if not self.ref_cache_path:
+            return
+        cached_refs = {
+            key: {
+                "value": ref.value,
+                "name": ref.name,
+                "type": ref.type,
+                "cached_at": cached_at,
+            }
+            for key, (ref, cached_at) in self.ref_cache.items()
+        }
+        try:
+            write_atomically(self.ref_cache_path, json.dumps(cached_refs))
+        except OSError as e:
+            print(f"Error while saving the QuickBooks refs cache: {e}")
+
+    def _get_ref(self, qb_object, id):
+        """Gets the ref of a QuickBooks object, only asking QuickBooks the first time."""
+        key = f"{client_data['realm_id']}:{qb_object.qbo_object_name}:{id}"
+        cached = self.ref_cache.get(key)
+        if cached:
+            return cached[0]
+
+        with span("qbo.get_ref", object=qb_object.qbo_object_name):
+            ref = qb_object.get(id, qb=self.client).to_ref()
+        self.ref_cache[key] = (ref, time.time())
+        self._save_ref_cache()
+
+        return ref
+
     def _create_sales_item_line(
-        self, sku, quantity, unit_cost, item_ref, class_ref, date
+        self, sku, quantity, line_total, item_ref, class_ref, date
     ):
         line_detail = SalesItemLineDetail()
         line_detail.ServiceDate = date
-        line_detail.UnitPrice = unit_cost
+        line_detail.UnitPrice = from_cents(line_total) / quantity
         line_detail.Qty = quantity
         line_detail.ItemRef = item_ref
         line_detail.ClassRef = class_ref
 
         line = SalesItemLine()
-        line.Amount = str(float(unit_cost) * quantity)
+        # The amount comes straight from the cents so it's the exact line total
+        line.Amount = str(from_cents(line_total))
         line.DetailType = "SalesItemLineDetail"
         line.Description = sku
         line.SalesItemLineDetail = line_detail
@@ -87,57 +267,80 @@ class QbInvoice:
         invoice = Invoice()
         invoice.CustomerRef = customer_ref
         invoice.SalesTermRef = term_ref
-        invoice.TrackingNum = row["tracking_number"]
-        invoice.ShipDate = row["ship_date"]
+        invoice.TrackingNum = row.tracking_number
+        invoice.ShipDate = row.ship_date
         invoice.Line = line_items
-        invoice.TxnDate = row["ship_date"]
-        invoice.DocNumber = row["order_id"]
+        invoice.TxnDate = row.ship_date
+        invoice.DocNumber = row.order_id
         invoice.BillEmail = EmailAddress()
-        invoice.BillEmail.Address = vendor_mappping[row["dropshipper_name"]]["email"]
+        invoice.BillEmail.Address = vendor_mappping[row.dropshipper_name]["email"]
 
         invoice.ShipMethodRef = ship_method_ref
         invoice.ShipAddr = Address()
-        invoice.ShipAddr.City = row["city"]
-        invoice.ShipAddr.CountrySubDivisionCode = row["state"]
-        invoice.ShipAddr.Country = row["country"]
-        invoice.ShipAddr.PostalCode = row["postal_code"]
-        invoice.ShipAddr.Line1 = row["address"]
+        invoice.ShipAddr.City = row.city
+        invoice.ShipAddr.CountrySubDivisionCode = row.state
+        invoice.ShipAddr.Country = row.country
+        invoice.ShipAddr.PostalCode = row.postal_code
+        invoice.ShipAddr.Line1 = row.address
 
         return invoice
 
-    def create_invoice(self, row, vendor_mappping):
-        items = row["items"]
-        date = row["ship_date"]
+    def _validate_invoice(self, invoice):
+        """Checks locally what QBO would reject the invoice for, returns the error or None if it's valid."""
+        if not invoice.DocNumber:
+            return "The invoice has no DocNumber"
+        if len(str(invoice.DocNumber)) > QbInvoice.DOC_NUMBER_MAX_LENGTH:
+            return f"The DocNumber {invoice.DocNumber} is longer than {QbInvoice.DOC_NUMBER_MAX_LENGTH} characters"
+        if not invoice.TxnDate:
+            return "The invoice has no date"
+        for line in invoice.Line:
+            if line.SalesItemLineDetail.Qty <= 0:
+                return f"The line {line.Description} has no quantity"
+            amount = float(line.Amount)
+            if not math.isfinite(amount):
+                return f"The line {line.Description} has no amount"
+            if abs(amount) > QbInvoice.AMOUNT_MAX:
+                return f"The amount {line.Amount} of the line {line.Description} is out of range"
+        return None
 
-        item_ref = Item.get(2, qb=self.client).to_ref()
-        tax_ref = Item.get(24, qb=self.client).to_ref()
-        shipping_ref = Item.get(23, qb=self.client).to_ref()
-        class_ref = Class.get(1111, qb=self.client).to_ref()  # Class id placeholder
+    def build_invoice(self, row, vendor_mappping):
+        """Builds and validates the invoice of the order without sending it, returns None if it couldn't be prepared."""
+        items = row.items
+        date = row.ship_date
 
-        line_items = []
+        item_ref = self._get_ref(Item, 2)
+        tax_ref = self._get_ref(Item, 24)
+        shipping_ref = self._get_ref(Item, 23)
+        class_ref = self._get_ref(Class, 1111)  # Class id placeholder
+        term_ref = self._get_ref(Term, 4)
+        customer_id = vendor_mappping[row.dropshipper_name]["customer_id"]
+        customer_ref = self._get_ref(Customer, customer_id)
 
-        for item in items:
-            sku, quantity, unit_cost = item
+        try:
+            line_items = []
 
-            sales_item_line = self._create_sales_item_line(
-                sku, quantity, unit_cost, item_ref, class_ref, date
-            )
-            line_items.append(sales_item_line)
+            for item in items:
+                sku, quantity, line_total = item
 
-        # adding the tax line
-        line_items.append(self._create_tax_line(row["tax"], tax_ref, class_ref, date))
-        line_items.append(
-            self._create_shipping_line(row["shipping"], shipping_ref, class_ref, date)
-        )
+                sales_item_line = self._create_sales_item_line(
+                    sku, quantity, line_total, item_ref, class_ref, date
+                )
+                line_items.append(sales_item_line)
 
-        ship_method_ref = Ref()
-        ship_method_ref.value = vendor_mappping[row["dropshipper_name"]]["ship_method"]
-        ship_method_ref.name = vendor_mappping[row["dropshipper_name"]]["ship_method"]
+            # adding the tax line
+            line_items.append(
+                self._create_tax_line(from_cents(row.tax), tax_ref, class_ref, date)
+            )
+            line_items.append(
+                self._create_shipping_line(
+                    from_cents(row.shipping), shipping_ref, class_ref, date
+                )
+            )
+
+            ship_method_ref = Ref()
+            ship_method_ref.value = vendor_mappping[row.dropshipper_name]["ship_method"]
+            ship_method_ref.name = vendor_mappping[row.dropshipper_name]["ship_method"]
 
-        customer_id = vendor_mappping[row["dropshipper_name"]]["customer_id"]
-        customer_ref = Customer.get(customer_id, qb=self.client).to_ref()
-        term_ref = Term.get(4, qb=self.client).to_ref()
-        try:
             invoice = self._prepare_invoice(
                 row,
                 line_items,
@@ -146,19 +349,91 @@ class QbInvoice:
                 ship_method_ref,
                 vendor_mappping,
             )
+            error = self._validate_invoice(invoice)
         except Exception as e:
-            print(e)
-            return False
+            error = e
+
+        if error:
+            print(f"Error preparing invoice {row.order_id}: {error}")
+            return None
+        return invoice
+
+    def build_invoices(self, rows, vendor_mappping):
+        """Builds and validates the invoices of the given orders without sending them.
+        Returns the invoices and the errors of the ones that couldn't be prepared, both keyed by order id.
+        """
+        invoices = {}
+        failed_invoices = {}
+        for row in rows:
+            invoice = self.build_invoice(row, vendor_mappping)
+            if invoice is None:
+                failed_invoices[row.order_id] = "The invoice could not be prepared"
+            else:
+                invoices[row.order_id] = invoice
+        return invoices, failed_invoices
+
+    def save_invoices(self, invoices):
+        """Creates already built invoices in QBO batch requests.
+        Returns the saved invoices, as QBO sent them back, and the errors of the ones that failed, both keyed by order id.
+        """
+        created_invoices = {}
+        failed_invoices = {}
+
+        invoices = list(invoices)
+        batch_size = qb_settings["batch_size"]
+        batches = [
+            invoices[i : i + batch_size] for i in range(0, len(invoices), batch_size)
+        ]
+        # Sending the batches at once, the scheduler keeps them within QBO's limits
+        with ThreadPoolExecutor(max_workers=self.scheduler.max_concurrency) as executor:
+            batch_results = list(executor.map(self._create_batch, batches))
+
+        for batch, (saved_invoices, faults, error) in zip(batches, batch_results):
+            if error:
+                print(f"Error: {error}")
+                for invoice in batch:
+                    failed_invoices[invoice.DocNumber] = str(error)
+                continue
+
+            for invoice in saved_invoices:
+                created_invoices[invoice.DocNumber] = invoice
+            for fault in faults:
+                error = "; ".join(str(fault_error) for fault_error in fault.Error)
+                print(
+                    f"Error creating invoice {fault.original_object.DocNumber}: {error}"
+                )
+                failed_invoices[fault.original_object.DocNumber] = error
+
+        return created_invoices, failed_invoices
+
+    def _create_batch(self, batch):
+        """Creates a batch of invoices, returns the saved invoices, the faults and the error if the request failed."""
         try:
-            invoice.save(qb=self.client)
-            return True
+            # A batch of one is sent through the regular endpoint
+            if qb_settings["batch_size"] == 1:
+                with span("qbo.create", invoices=1):
+                    return [batch[0].save(qb=self.client)], [], None
+            with span("qbo.batch_create", invoices=len(batch)):
+                response = BatchManager(BatchOperation.CREATE).process_batch(
+                    batch, qb=self.client
+                )
+            return response.successes, response.faults, None
         except Exception as e:
-            print(f"Error: {e}")
-            return False
+            return [], [], e
+
+    def load_invoice(self, invoice_id, sync_token):
+        """Builds an invoice a previous run already saved from its Id and SyncToken, without asking QuickBooks,
+        so the journaled order counts as invoiced and is written to this run's file."""
+        invoice = Invoice()
+        invoice.Id = invoice_id
+        invoice.SyncToken = sync_token
+        return invoice
 
     def check_exist(self, invoice_number):
         try:
-            invoice = Invoice.filter(DocNumber=invoice_number, qb=self.client)[0]
+            with span("qbo.query", doc_numbers=1):
+                invoices = Invoice.filter(DocNumber=invoice_number, qb=self.client)
+            invoice = invoices[0]
             return invoice
         except IndexError:
             return False
@@ -166,16 +441,50 @@ class QbInvoice:
             print(f"Error: {e}")
             return False
 
-    def delete_invoice(self, invoice: Invoice):
-        try:
-            invoice.delete(qb=self.client)
-            return True
+    def get_existing_invoices(self, invoice_numbers):
+        """Gets the already existing invoices for the given invoice numbers as a DocNumber -> Invoice dict."""
+        existing_invoices = {}
+        invoice_numbers = list(dict.fromkeys(invoice_numbers))
 
-        except IndexError:
-            return False
+        chunks = [
+            invoice_numbers[i : i + QbInvoice.DOC_NUMBER_CHUNK_SIZE]
+            for i in range(0, len(invoice_numbers), QbInvoice.DOC_NUMBER_CHUNK_SIZE)
+        ]
+        # Looking up the chunks at once, the scheduler keeps them within QBO's limits
+        with ThreadPoolExecutor(max_workers=self.scheduler.max_concurrency) as executor:
+            for chunk_invoices in executor.map(self._get_existing_chunk, chunks):
+                for invoice_number, invoice in chunk_invoices.items():
+                    existing_invoices.setdefault(invoice_number, invoice)
+
+        return existing_invoices
+
+    def _get_existing_chunk(self, chunk):
+        """Gets the already existing invoices of a chunk of invoice numbers."""
+        existing_invoices = {}
+        try:
+            start_position = 1
+            while True:
+                with span("qbo.query", doc_numbers=len(chunk)):
+                    invoices = Invoice.where(
+                        build_choose_clause(chunk, "DocNumber"),
+                        start_position=start_position,
+                        max_results=QbInvoice.QUERY_PAGE_SIZE,
+                        qb=self.client,
+                    )
+                for invoice in invoices:
+                    existing_invoices.setdefault(invoice.DocNumber, invoice)
+                if len(invoices) < QbInvoice.QUERY_PAGE_SIZE:
+                    break
+                start_position += QbInvoice.QUERY_PAGE_SIZE
         except Exception as e:
-            print(f"Error: {e}")
-            return False
+            # Falling back to checking the invoices of this chunk one by one
+            print(f"Error while looking up existing invoices: {e}")
+            for invoice_number in chunk:
+                invoice = self.check_exist(invoice_number)
+                if invoice:
+                    existing_invoices[invoice_number] = invoice
+
+        return existing_invoices
 
     def close(self):
         self.client.close()
@@ -0,0 +1,198 @@
+from operator import attrgetter
+import numpy as np
+from decimal_rounding import from_cents
+
+
+class InvoiceLines:
+    """
+    Lines of a batch of orders kept column by column: the order each line belongs to, its item
+    (a sku or a label like Taxes), its quantity and its amount in cents.
+    integer_lines has the indexes of the lines whose amount is written without decimals.
+    """
+
+    __slots__ = ("orders", "items", "quantities", "amounts", "integer_lines")
+
+    def __init__(self):
+        self.orders = []
+        self.items = []
+        self.quantities = []
+        self.amounts = []
+        self.integer_lines = []
+
+    def __len__(self):
+        return len(self.orders)
+
+
+def item_lines(orders):
+    """Lays the orders out with a line per item."""
+    lines = InvoiceLines()
+    for order in orders:
+        lines.orders.extend([order] * len(order.items))
+        lines.items.extend(order.items.skus)
+        lines.quantities.extend(order.items.quantities)
+        lines.amounts.extend(order.items.line_totals)
+    return lines
+
+
+def item_tax_shipping_lines(orders):
+    """Lays the orders out with a line per item followed by a line for the tax and one for the shipping."""
+    lines = InvoiceLines()
+    for order in orders:
+        if "tax" in order.integer_amounts:
+            lines.integer_lines.append(len(lines.orders) + len(order.items))
+        lines.orders.extend([order] * (len(order.items) + 2))
+        lines.items.extend(order.items.skus)
+        lines.items.extend(("Taxes", "SHIPPING"))
+        lines.quantities.extend(order.items.quantities)
+        lines.quantities.extend((1, 1))
+        lines.amounts.extend(order.items.line_totals)
+        lines.amounts.extend((order.tax, order.shipping))
+    return lines
+
+
+def order_field(field):
+    """Column with the given field of each line's order."""
+    get_field = attrgetter(field)
+    return lambda lines: list(map(get_field, lines.orders))
+
+
+def constant(value):
+    """Column with the same value on every line."""
+    return lambda lines: [value] * len(lines)
+
+
+def _order_cents(lines, field):
+    get_field = attrgetter(field)
+    return np.fromiter(
+        map(get_field, lines.orders), dtype=np.int64, count=len(lines.orders)
+    )
+
+
+def _keep_integers(amounts, integer_lines):
+    """Writes the amounts of the given lines as whole numbers, like the files had the ones SellerCloud gave as integers."""
+    for index in integer_lines:
+        amounts[index] = int(amounts[index])
+    return amounts
+
+
+def order_amount(field):
+    """Column with an amount in cents of each line's order, in dollars."""
+
+    def column(lines):
+        integer_lines = [
+            index
+            for index, order in enumerate(lines.orders)
+            if field in order.integer_amounts
+        ]
+        return _keep_integers(
+            from_cents(_order_cents(lines, field)).tolist(), integer_lines
+        )
+
+    return column
+
+
+def order_subtotal_amount(lines):
+    """Column with the order's grand total without its tax, subtracted in cents so no rounding is needed."""
+    return from_cents(
+        _order_cents(lines, "subtotal") - _order_cents(lines, "tax")
+    ).tolist()
+
+
+def items(lines):
+    return list(lines.items)
+
+
+def quantities(lines):
+    return list(lines.quantities)
+
+
+def unit_costs(lines):
+    """Column with each line's amount over its quantity."""
+    return (
+        from_cents(lines.amounts) / np.asarray(lines.quantities, dtype=np.float64)
+    ).tolist()
+
+
+def line_prices(lines):
+    """Column with each line's unit cost times its quantity, the way the files always had it."""
+    line_quantities = np.asarray(lines.quantities, dtype=np.float64)
+    return _keep_integers(
+        (from_cents(lines.amounts) / line_quantities * line_quantities).tolist(),
+        lines.integer_lines,
+    )
+
+
+def _empty(lines):
+    return [None] * len(lines)
+
+
+class InvoiceFormat:
+    """
+    File format of the invoices: how the orders are laid out in lines and the column each csv
+    header gets, as a function that builds the whole column for a batch of lines.
+    """
+
+    def __init__(self, lines, columns):
+        self.lines = lines
+        self.columns = columns
+
+    def compile(self, headers):
+        """Compiles the format for the headers get_invoice_csv_headers gives it into a row emitter,
+        which returns the rows of a batch of orders as tuples in header order, or grouped by their
+        order with by_order. The headers the format has no column for are left empty."""
+        header_columns = [self.columns.get(header, _empty) for header in headers]
+
+        def emit_rows(orders, by_order=False):
+            lines = self.lines(orders)
+            rows = list(zip(*(column(lines) for column in header_columns)))
+            if not by_order:
+                return rows
+
+            rows_by_order = {}
+            for order, row in zip(lines.orders, rows):
+                rows_by_order.setdefault(order, []).append(row)
+            return rows_by_order
+
+        return emit_rows
+
+
+# Invoice file formats by the file_format_name of the dropshippers
+INVOICE_FORMATS = {}
+
+
+def register_invoice_format(name, lines, columns):
+    """Adds a file format to the ones the dropshippers can use."""
+    INVOICE_FORMATS[name] = InvoiceFormat(lines, columns)
+
+
+register_invoice_format(
+    "default",
+    item_lines,
+    {
+        "po_number": order_field("purchase_order_number"),
+        "invoice_number": order_field("order_id"),
+        "invoice_date": order_field("ship_date"),
+        "invoice_total_amount": order_amount("subtotal"),
+        "invoice_subtotal_amount": order_subtotal_amount,
+        "invoice_tax_amount": order_amount("tax"),
+        "line_item_sku": items,
+        "line_item_quantity": quantities,
+        "line_item_unit_cost": unit_costs,
+    },
+)
+
+register_invoice_format(
+    "aag",
+    item_tax_shipping_lines,
+    {
+        "Invoice Number": order_field("order_id"),
+        "SONumber": order_field("purchase_order_number"),
+        "Date": order_field("ship_date"),
+        "Customer": constant("auto_accessories_garage"),
+        "CarrierName": constant("FEDEX_GROUND"),
+        "TrackingNumber": order_field("tracking_number"),
+        "item": items,
+        "qty": quantities,
+        "price": line_prices,
+    },
+)
@@ -1,114 +1,524 @@
 from exampple_db import ExampleDb
 from invoice import QbInvoice
 from quick_books_db import QuickBooksDb
-from email_helper import send_email
-from seller_cloud_data import get_sellercloud_data
+from email_helper import send_email, notifications
+from seller_cloud_data import iter_sellercloud_pages
 from file_handler import FileHandler
 from df_creator import DfCreator
 from ftp import FTPManager
+from pipeline import PipelineStage
+from run_journal import RunJournal
+from tracing import tracer
+from cassette import cassette
+from config import (
+    file_settings,
+    pipeline_settings,
+    extraction_settings,
+    journal_settings,
+    cassette_settings,
+)
+import config
+import multiprocessing
 import traceback
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from tqdm import tqdm
 from datetime import datetime, timedelta
 
+# Settings the worker processes take from the main process
+WORKER_SETTINGS = [
+    "client_data",
+    "qb_settings",
+    "file_settings",
+    "journal_settings",
+    "tracing_settings",
+    "cassette_settings",
+    "pipeline_settings",
+]
+
+
+def open_dropshipper_file(
+    invoice_csv_headers, f_handler, dropshipper_info, dropshipper_data
+):
+    """Opens the invoice csv file of a dropshipper, which gets the rows of all its orders."""
+    # Getting the folder name for the FTP server
+    _, ftp_folder_name = dropshipper_info
+
+    # Opening the invoice csv file when the rows are streamed to it
+    invoice_file = None
+    if file_settings["stream_invoice_files"]:
+        invoice_file = f_handler.open_invoice_file(
+            ftp_folder_name,
+            invoice_csv_headers[dropshipper_data["file_format_name"]],
+        )
+
+    return {
+        "dropshipper_info": dropshipper_info,
+        "invoice_file": invoice_file,
+        # Creating the dataframe that will be used to create the invoice csv file
+        "df_creator": DfCreator(invoice_csv_headers, dropshipper_data, invoice_file),
+        "file_orders": [],
+    }
+
+
+def close_dropshipper_file(f_handler, dropshipper_file, journal=None):
+    """Closes the invoice csv file of a dropshipper, returns its path or False if it has no rows."""
+    _, ftp_folder_name = dropshipper_file["dropshipper_info"]
+
+    # Creating the tmp folder and saving the invoice data to a csv file
+    if dropshipper_file["invoice_file"]:
+        file_path = dropshipper_file["invoice_file"].close()
+    else:
+        file_path = f_handler.save_data_to_file(
+            dropshipper_file["df_creator"].invoice_file_df, ftp_folder_name
+        )
+
+    if journal and file_path:
+        journal.record(
+            RunJournal.WRITTEN,
+            {
+                purchase_order_number: file_path
+                for purchase_order_number in dropshipper_file["file_orders"]
+            },
+        )
+
+    return file_path
+
+
+def invoice_dropshipper(
+    api,
+    vendor_mappping,
+    df_creator,
+    dropshipper_info,
+    dropshipper_data,
+    journal=None,
+):
+    """Creates the invoices of a dropshipper's orders and adds them to its invoice csv file.
+    When a run journal is given, the work a previous run already did for the orders is skipped.
+    """
+    # Getting the dropshipper code
+    dropshipper_code, _ = dropshipper_info
+
+    result = {
+        "orders_unable_to_invoice": [],
+        "orders_already_invoiced": [],
+        "pos_invoiced": [],
+        "file_orders": [],
+    }
+
+    orders = dropshipper_data["orders"]
+    journaled_invoices = {}
+    if journal:
+        # Orders a previous run already uploaded only need their status updated
+        pending_orders = []
+        for order in orders:
+            last_stage = journal.last_stage(order.purchase_order_number)
+            if last_stage == RunJournal.UPLOADED:
+                result["pos_invoiced"].append(order)
+            else:
+                pending_orders.append(order)
+                # Orders a previous run invoiced keep that invoice and are written to this run's file,
+                # which replaces the one that wasn't uploaded
+                if last_stage in (RunJournal.INVOICED, RunJournal.WRITTEN):
+                    invoice_data = journal.get(
+                        order.purchase_order_number, RunJournal.INVOICED
+                    )
+                    # Older runs recorded None for the invoices they deleted, those orders are invoiced again
+                    if invoice_data is not None:
+                        journaled_invoices.setdefault(
+                            order.order_id,
+                            api.load_invoice(
+                                invoice_data["Id"], invoice_data["SyncToken"]
+                            ),
+                        )
+        orders = pending_orders
+
+    # Looking up all the already invoiced orders of the dropshipper at once
+    existing_invoices = api.get_existing_invoices(
+        [order.order_id for order in orders if order.order_id not in journaled_invoices]
+    )
+
+    # The orders that haven't been invoiced yet, repeated orders count as invoiced
+    orders_to_invoice = {}
+    for order in orders:
+        if order.order_id not in existing_invoices:
+            orders_to_invoice.setdefault(order.order_id, order)
+
+    # Building the file rows and the invoices of the orders first, so only the orders that
+    # will make it to the file are invoiced and no invoice has to be deleted afterwards
+    order_rows, orders_without_rows = df_creator.prepare_orders(
+        list(orders_to_invoice.values())
+    )
+    orders_without_rows = set(orders_without_rows)
+    invoices, _ = api.build_invoices(
+        [
+            order
+            for order_id, order in orders_to_invoice.items()
+            if order_id not in journaled_invoices and order not in orders_without_rows
+        ],
+        vendor_mappping,
+    )
+
+    # Creating the validated invoices in batches
+    created_invoices, _ = api.save_invoices(invoices.values())
+    if journal:
+        journal.record(
+            RunJournal.INVOICED,
+            {
+                orders_to_invoice[order_id].purchase_order_number: {
+                    "Id": invoice.Id,
+                    "SyncToken": invoice.SyncToken,
+                }
+                for order_id, invoice in created_invoices.items()
+            },
+        )
+    created_invoices.update(journaled_invoices)
+
+    # The orders whose invoices were created, their rows are added to the file all at once
+    invoiced_orders = []
+    for order in tqdm(
+        orders,
+        desc=f"Processing invoices for {dropshipper_code}",
+    ):
+        # Checking if the order has already been invoiced, repeated orders count as invoiced
+        if orders_to_invoice.get(order.order_id) is order:
+            invoice = created_invoices.get(order.order_id)
+
+            # If the invoice is None, it means that there was an error
+            if not invoice or order in orders_without_rows:
+                result["orders_unable_to_invoice"].append(order.purchase_order_number)
+            # If the invoice is not None, it means that the invoice was created successfully
+            else:
+                invoiced_orders.append(order)
+
+        # If the order has already been invoiced, it is added to the orders_already_invoiced list
+        else:
+            result["orders_already_invoiced"].append(order.purchase_order_number)
+            # Adding the order to the pos_invoiced list so that the is_invoiced status can be updated
+            result["pos_invoiced"].append(
+                (order),
+            )
+
+    # Adding the invoice data to the dataframe
+    if df_creator.add_rows(
+        [row for order in invoiced_orders for row in order_rows.get(order, ())]
+    ):
+        result["pos_invoiced"].extend(invoiced_orders)
+        result["file_orders"].extend(
+            order.purchase_order_number for order in invoiced_orders
+        )
+    else:
+        # The invoices stay in QBO and in the journal, so the next run writes them to its file
+        result["orders_unable_to_invoice"].extend(
+            order.purchase_order_number for order in invoiced_orders
+        )
+
+    return result
+
+
+def upload_invoice_files(uploads, journal=None):
+    """Uploads each invoice file to the FTP server as soon as it is ready.
+    uploads yields each file path with the purchase order numbers in it.
+    """
+    file_orders = {}
+
+    def file_paths():
+        for file_path, purchase_order_numbers in uploads:
+            file_orders[file_path] = purchase_order_numbers
+            yield file_path
+
+    ftp = FTPManager()
+    failed_paths = ftp.upload_files(file_paths())
+
+    if journal:
+        journal.record(
+            RunJournal.UPLOADED,
+            {
+                purchase_order_number: None
+                for file_path, purchase_order_numbers in file_orders.items()
+                if file_path not in failed_paths
+                for purchase_order_number in purchase_order_numbers
+            },
+        )
+
+
+def invoice_dropshipper_into_file(invoicer, dropshipper_info, dropshipper_data):
+    """Invoices the orders of a dropshipper into its invoice file, which stays open for the dropshipper's next pages.
+    invoicer holds the api, the vendor mapping, the csv headers, the file handler, the journal and the open file.
+    Returns the invoice_dropshipper result with the dropshipper info and the (file path, purchase order numbers)
+    of the files closed because the dropshipper changed.
+    """
+    closed_files = []
+    dropshipper_file = invoicer["dropshipper_file"]
+    if dropshipper_file and dropshipper_file["dropshipper_info"] != dropshipper_info:
+        closed_files = close_invoicer_file(invoicer)
+    if invoicer["dropshipper_file"] is None:
+        invoicer["dropshipper_file"] = open_dropshipper_file(
+            invoicer["invoice_csv_headers"],
+            invoicer["f_handler"],
+            dropshipper_info,
+            dropshipper_data,
+        )
+
+    result = invoice_dropshipper(
+        invoicer["api"],
+        invoicer["vendor_mappping"],
+        invoicer["dropshipper_file"]["df_creator"],
+        dropshipper_info,
+        dropshipper_data,
+        invoicer["journal"],
+    )
+    invoicer["dropshipper_file"]["file_orders"].extend(result["file_orders"])
+
+    result["dropshipper_info"] = dropshipper_info
+    result["closed_files"] = closed_files
+    return result
+
+
+def close_invoicer_file(invoicer):
+    """Closes the open file of the invoicer, returns its (file path, purchase order numbers) in a list if it has rows."""
+    dropshipper_file, invoicer["dropshipper_file"] = invoicer["dropshipper_file"], None
+    if dropshipper_file is None:
+        return []
+
+    file_path = close_dropshipper_file(
+        invoicer["f_handler"], dropshipper_file, invoicer["journal"]
+    )
+    if not file_path:
+        return []
+    return [(file_path, dropshipper_file["file_orders"])]
+
+
+# Invoicer of a worker process, set up by _start_invoice_worker
+_worker_invoicer = {}
+
+
+def _start_invoice_worker(
+    refresh_token,
+    access_token,
+    vendor_mappping,
+    invoice_csv_headers,
+    report_date,
+    settings,
+):
+    """Sets up a worker process with its own QBO client, file handler and journal connection.
+    It uses the settings of the main process, which can differ from the ones in config.
+    """
+    for name, values in settings.items():
+        getattr(config, name).update(values)
+    cassette.configure(
+        cassette_settings["mode"],
+        # A recording worker hands its interactions to the main process, which writes the cassette
+        None if cassette_settings["mode"] == "record" else cassette_settings["path"],
+        cassette_settings["replay_latency"],
+    )
+
+    _worker_invoicer.update(
+        # Reusing the session of the main process, so the tokens are only refreshed there
+        api=QbInvoice(refresh_token, access_token),
+        vendor_mappping=vendor_mappping,
+        invoice_csv_headers=invoice_csv_headers,
+        f_handler=FileHandler(report_date),
+        journal=(
+            RunJournal(journal_settings["path"]) if journal_settings["path"] else None
+        ),
+        dropshipper_file=None,
+    )
+
+
+def _invoice_in_worker(dropshipper_info, dropshipper_data):
+    return invoice_dropshipper_into_file(
+        _worker_invoicer, dropshipper_info, dropshipper_data
+    )
+
+
+def _finish_invoice_worker():
+    """Closes the last file of the worker and hands back the notifications, latencies and interactions it collected.
+    The collectors of a worker only live in its process, so what they gathered is taken out of them
+    to be merged into the ones of the main process.
+    """
+    closed_files = close_invoicer_file(_worker_invoicer)
+    if _worker_invoicer["journal"]:
+        _worker_invoicer["journal"].close()
+
+    return {
+        "closed_files": closed_files,
+        "notifications": notifications.take(),
+        "histograms": tracer.take_histograms(),
+        "interactions": cassette.take(),
+        "cassette_misses": cassette.take_misses(),
+    }
+
+
+def start_invoice_workers(
+    processes, api, vendor_mappping, invoice_csv_headers, report_date
+):
+    """Starts a worker process per hash bucket of dropshippers."""
+    settings = {name: getattr(config, name) for name in WORKER_SETTINGS}
+    return [
+        ProcessPoolExecutor(
+            max_workers=1,
+            # Spawning the workers the same way on every platform
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_start_invoice_worker,
+            initargs=(
+                api.client.refresh_token,
+                api.auth_client.access_token,
+                vendor_mappping,
+                invoice_csv_headers,
+                report_date,
+                settings,
+            ),
+        )
+        for _ in range(processes)
+    ]
+
 
 def main():
+    journal = None
+    invoice_workers = []
+    run_date = datetime.now()
     try:
+        # Opening the journal of the previous runs to resume the work they left unfinished
+        if journal_settings["path"]:
+            journal = RunJournal(journal_settings["path"])
+
         # Gettting invoice ready orders that have tracking numbers and
         # creating an object with the orders grouped by dropshipper
         ex_db = ExampleDb()
         invoice_csv_headers = ex_db.get_invoice_csv_headers()
         vendor_mappping = ex_db.get_vendor_mapping()
 
-        ready_to_invoice_orders = ex_db.get_invoice_ready_orders()
-
-        # Getting the financial data from SellerCloud
-        ready_to_invoice_orders = get_sellercloud_data(ready_to_invoice_orders)
-
-        if not ready_to_invoice_orders:
-            print("There are no orders ready to be invoiced")
-            send_email(
-                "SellerCloud invoicing ran successfully",
-                "There are not orders to invoice.",
+        # Reading the orders in pages from where the previous runs left the extraction, or all at once
+        watermark = None
+        if extraction_settings["page_size"]:
+            watermark = ex_db.load_watermark()
+            ready_to_invoice_pages = ex_db.iter_invoice_ready_orders(
+                extraction_settings["page_size"], watermark
             )
-            ex_db.close()
-            return
-
-        # Creating the quickbooks api that takes care of making the invoice and sending it
-        qb_db = QuickBooksDb()
-        current_refresh_token = qb_db.get_refresh_token()
-        api = QbInvoice(current_refresh_token)
+        else:
+            ready_to_invoice_pages = [ex_db.get_invoice_ready_orders()]
 
-        # Auto refresfing invoice token
-        if api.client.refresh_token != current_refresh_token:
-            qb_db.update_refresh_token(api.client.refresh_token)
+        # The stages run at the same time: while a dropshipper is being invoiced, the
+        # SellerCloud data of the next ones is fetched and the files of the previous ones are uploaded
+        queue_size = pipeline_settings["queue_size"]
+        sellercloud_stage = PipelineStage(
+            lambda _: iter_sellercloud_pages(ready_to_invoice_pages, journal=journal),
+            queue_size,
+        ).start()
+        upload_stage = PipelineStage(
+            lambda uploads: upload_invoice_files(uploads, journal), queue_size
+        ).start()
 
         # Placeholders
+        api = None
+        qb_db = None
+        invoicer = None
         orders_unable_to_invoice = {}
         orders_already_invoiced = {}
         pos_invoiced = []
-        tmp_files_paths = []
+        pending_results = set()
 
         # Report date
         report_date = datetime.now()  # - timedelta(days=1)
         f_handler = FileHandler(report_date)
 
-        for dropshipper_info, dropshipper_data in ready_to_invoice_orders.items():
-            # Getting the dropshipper code and the folder name for the FTP server
-            dropshipper_code, ftp_folder_name = dropshipper_info
-
-            # Creating the dataframe that will be used to create the invoice csv file
-            df_creator = DfCreator(invoice_csv_headers, dropshipper_data)
-
-            for order in tqdm(
-                dropshipper_data["orders"],
-                desc=f"Creating invoices for {dropshipper_code}",
-            ):
-                # Checking if the order has already been invoiced
-                if not api.check_exist(order["order_id"]):
-                    # Creating new invoice
-                    invoice = api.create_invoice(order, vendor_mappping)
-
-                    # If the invoice is None, it means that there was an error
-                    if not invoice:
-                        orders_unable_to_invoice.setdefault(
-                            dropshipper_code, []
-                        ).append(order["purchase_order_number"])
-                    # If the invoice is not None, it means that the invoice was created successfully
-                    else:
-                        pos_invoiced.append(
-                            (order),
-                        )
-                        # Adding the invoice data to the dataframe
-                        in_file = df_creator.populate_df(order)
-
-                        if not in_file:
-                            # If the invoice was not created correctly, it is deleted
-                            just_created_invoice = api.check_exist(order["order_id"])
-                            api.delete_invoice(just_created_invoice)
-                            orders_unable_to_invoice.setdefault(
-                                dropshipper_code, []
-                            ).append(order["purchase_order_number"])
-
-                # If the order has already been invoiced, it is added to the orders_already_invoiced dictionary
-                else:
-                    orders_already_invoiced.setdefault(dropshipper_code, []).append(
-                        order["purchase_order_number"]
+        def add_result(result):
+            # Uploading the closed files to the FTP server while the next dropshippers are invoiced
+            for closed_file in result["closed_files"]:
+                upload_stage.put(closed_file)
+
+            dropshipper_code = result["dropshipper_info"][0]
+            if result["orders_unable_to_invoice"]:
+                orders_unable_to_invoice.setdefault(dropshipper_code, []).extend(
+                    result["orders_unable_to_invoice"]
+                )
+            if result["orders_already_invoiced"]:
+                orders_already_invoiced.setdefault(dropshipper_code, []).extend(
+                    result["orders_already_invoiced"]
+                )
+            pos_invoiced.extend(result["pos_invoiced"])
+
+        # Getting the financial data from SellerCloud as each dropshipper is ready
+        for dropshipper_info, dropshipper_data in sellercloud_stage:
+            if api is None:
+                # Creating the quickbooks api that takes care of making the invoice and sending it
+                qb_db = QuickBooksDb()
+                current_refresh_token = qb_db.get_refresh_token()
+                api = QbInvoice(current_refresh_token)
+
+                # Auto refresfing invoice token
+                if api.client.refresh_token != current_refresh_token:
+                    qb_db.update_refresh_token(api.client.refresh_token)
+
+                invoicer = {
+                    "api": api,
+                    "vendor_mappping": vendor_mappping,
+                    "invoice_csv_headers": invoice_csv_headers,
+                    "f_handler": f_handler,
+                    "journal": journal,
+                    "dropshipper_file": None,
+                }
+                if pipeline_settings["invoice_processes"] > 1:
+                    invoice_workers = start_invoice_workers(
+                        pipeline_settings["invoice_processes"],
+                        api,
+                        vendor_mappping,
+                        invoice_csv_headers,
+                        report_date,
                     )
-                    # Adding the order to the pos_invoiced list so that the is_invoiced status can be updated
-                    pos_invoiced.append(
-                        (order),
+
+            if not invoice_workers:
+                add_result(
+                    invoice_dropshipper_into_file(
+                        invoicer, dropshipper_info, dropshipper_data
                     )
+                )
+                continue
 
-            # Creating the tmp folder and saving the invoice data to a csv file
-            file_path = f_handler.save_data_to_file(
-                df_creator.invoice_file_df, ftp_folder_name
+            # A dropshipper always goes to the worker of its bucket, which keeps its file open for its next pages
+            bucket = zlib.crc32(dropshipper_info[0].encode()) % len(invoice_workers)
+            pending_results.add(
+                invoice_workers[bucket].submit(
+                    _invoice_in_worker, dropshipper_info, dropshipper_data
+                )
             )
-            if file_path:
-                tmp_files_paths.append(file_path)
-        # Uploading the files to the FTP server
-        if tmp_files_paths:
-            ftp = FTPManager()
-            ftp.upload_files(tmp_files_paths)
+            # Waiting for the workers when enough dropshippers are waiting for them
+            if len(pending_results) >= len(invoice_workers) * queue_size:
+                done, pending_results = wait(
+                    pending_results, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    add_result(future.result())
+
+        for future in pending_results:
+            add_result(future.result())
+
+        # Uploading the last files and collecting what the workers reported
+        for invoice_worker in invoice_workers:
+            finished = invoice_worker.submit(_finish_invoice_worker).result()
+            for closed_file in finished["closed_files"]:
+                upload_stage.put(closed_file)
+            for notification in finished["notifications"]:
+                notifications.add(*notification)
+            tracer.merge(finished["histograms"])
+            cassette.merge(finished["interactions"], finished["cassette_misses"])
+        if invoicer:
+            for closed_file in close_invoicer_file(invoicer):
+                upload_stage.put(closed_file)
+
+        upload_stage.close()
+        upload_stage.join()
+
+        if api is None:
+            print("There are no orders ready to be invoiced")
+            send_email(
+                "SellerCloud invoicing ran successfully",
+                "There are not orders to invoice.",
+            )
+            ex_db.update_watermark(watermark)
+            ex_db.close()
+            return
 
         if orders_unable_to_invoice or orders_already_invoiced:
             # Sending an email to notify of the orders that were unable to be invoiced
@@ -117,6 +527,14 @@ def main():
         if pos_invoiced:
             # Updating the is_invoiced status of the PurchaseOrders table
             ex_db.update_invoice_status(pos_invoiced)
+            if journal:
+                journal.record(
+                    RunJournal.STATUS_UPDATED,
+                    {order.purchase_order_number: None for order in pos_invoiced},
+                )
+
+        # Moving the extraction watermark forward for the next runs
+        ex_db.update_watermark(watermark)
 
         send_email(
             "SellerCloud invoicing ran successfully",
@@ -131,6 +549,24 @@ def main():
         send_email("An Error Occurred", f"Error: {e}\n\n{traceback.format_exc()}")
         raise e
 
+    finally:
+        for invoice_worker in invoice_workers:
+            invoice_worker.shutdown(cancel_futures=True)
+
+        # Forgetting the orders that went through every stage
+        if journal:
+            journal.prune(journal_settings["max_age"])
+            journal.close()
+
+        # Sending everything that was reported during the run in a single email
+        notifications.send_digest()
+
+        # Saving the latency of the run's requests, queries, uploads and emails
+        tracer.export(run_date)
+
+        # Finishing the recording of the run's external interactions
+        cassette.close()
+
 
 if __name__ == "__main__":
     main()
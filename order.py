@@ -0,0 +1,129 @@
+import sys
+from array import array
+
+
+def _intern(value):
+    """Interns the strings repeated across orders, so every order shares the same copy."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class OrderItems:
+    """
+    Items of an order stored as typed arrays instead of a tuple per item: the skus (interned,
+    they repeat across orders), the quantities and, once SellerCloud prices them, the line totals
+    in cents. Iterating gives (sku, quantity) for each item, or (sku, quantity, line_total) once priced.
+    """
+
+    __slots__ = ("skus", "quantities", "line_totals")
+
+    def __init__(self, skus=(), quantities=(), line_totals=None):
+        self.skus = [_intern(sku) for sku in skus]
+        self.quantities = array("l", quantities)
+        self.line_totals = None if line_totals is None else array("q", line_totals)
+
+    def append(self, sku, quantity):
+        self.skus.append(_intern(sku))
+        self.quantities.append(quantity)
+
+    def price(self, line_totals):
+        """Sets the line totals in cents of the items, given in the same order as the items."""
+        self.line_totals = array("q", line_totals)
+
+    def copy(self):
+        return OrderItems(self.skus, self.quantities, self.line_totals)
+
+    def __len__(self):
+        return len(self.skus)
+
+    def __repr__(self):
+        return f"OrderItems({list(self)!r})"
+
+    def __iter__(self):
+        if self.line_totals is None:
+            return zip(self.skus, self.quantities)
+        return zip(self.skus, self.quantities, self.line_totals)
+
+
+class Order:
+    """
+    Purchase order ready to be invoiced, with its money amounts in integer cents.
+    The orders are slotted records with the strings they repeat (dropshipper, code, place and date)
+    interned, so the large backfills keep a small footprint.
+    The tax and the subtotal (the SellerCloud grand total) are None until SellerCloud prices the order,
+    integer_amounts names the ones SellerCloud gave as whole numbers, which the files write without decimals.
+    """
+
+    __slots__ = (
+        "items",
+        "purchase_order_id",
+        "purchase_order_number",
+        "sellercloud_order_id",
+        "order_id",
+        "tax",
+        "shipping",
+        "subtotal",
+        "code",
+        "tracking_number",
+        "ship_date",
+        "city",
+        "state",
+        "country",
+        "postal_code",
+        "address",
+        "dropshipper_name",
+        "integer_amounts",
+    )
+
+    def __init__(
+        self,
+        items,
+        purchase_order_id,
+        purchase_order_number,
+        sellercloud_order_id,
+        order_id,
+        shipping,
+        code,
+        tracking_number,
+        ship_date,
+        city,
+        state,
+        country,
+        postal_code,
+        address,
+        dropshipper_name,
+        tax=None,
+        subtotal=None,
+        integer_amounts=(),
+    ):
+        self.items = items
+        self.purchase_order_id = purchase_order_id
+        self.purchase_order_number = purchase_order_number
+        self.sellercloud_order_id = sellercloud_order_id
+        self.order_id = order_id
+        self.tax = tax
+        self.shipping = shipping
+        self.subtotal = subtotal
+        self.code = _intern(code)
+        self.tracking_number = tracking_number
+        self.ship_date = _intern(ship_date)
+        self.city = _intern(city)
+        self.state = _intern(state)
+        self.country = _intern(country)
+        self.postal_code = _intern(postal_code)
+        self.address = address
+        self.dropshipper_name = _intern(dropshipper_name)
+        self.integer_amounts = integer_amounts
+
+    def copy(self):
+        """Copies the order with its own items, so pricing the copy leaves this one as it is."""
+        order = Order.__new__(Order)
+        for field in Order.__slots__:
+            setattr(order, field, getattr(self, field))
+        order.items = self.items.copy()
+        return order
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{field}={getattr(self, field)!r}" for field in Order.__slots__
+        )
+        return f"Order({fields})"
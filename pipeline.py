@@ -0,0 +1,61 @@
+import queue
+import threading
+
+# Marks the end of the items going through a stage
+_END = object()
+
+
+class PipelineStage:
+    """
+    Runs one stage of the invoicing on its own thread so it overlaps with the other stages.
+    The stage function gets an iterator over the items put into the stage and may return an
+    iterable with the items it hands over to the next stage. Both sides go through bounded
+    queues, so a fast stage waits for a slow one instead of piling up work in memory.
+    """
+
+    def __init__(self, function, queue_size=1):
+        self.function = function
+        self.inputs = queue.Queue(maxsize=queue_size)
+        self.outputs = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, item):
+        """Hands an item over to the stage."""
+        self.inputs.put(item)
+
+    def close(self):
+        """Lets the stage know that no more items are coming."""
+        self.inputs.put(_END)
+
+    def join(self):
+        """Waits for the stage to finish, raising its error if it failed."""
+        for _ in self:
+            pass
+
+    def _run(self):
+        try:
+            results = self.function(self._drain(self.inputs))
+            for item in results or ():
+                self.outputs.put(item)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.outputs.put(_END)
+
+    def _drain(self, items):
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            yield item
+
+    def __iter__(self):
+        yield from self._drain(self.outputs)
+        self.thread.join()
+        if self.error:
+            raise self.error
@@ -0,0 +1,170 @@
+import random
+import threading
+import time
+import uuid
+from requests.exceptions import ConnectionError, Timeout
+from tracing import span
+
+
+class TokenBucket:
+    """
+    Hands out the requests allowed per minute. The bucket holds a tenth of the minute's
+    requests for bursts and refills with the rest, so no minute ever has more than the limit.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.capacity = max(1.0, requests_per_minute / 10)
+        self.rate = max(requests_per_minute - self.capacity, 1) / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request is allowed and takes it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Lets no request through for the given seconds, like when QBO asks to retry later."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class QboScheduler:
+    """
+    Schedules the HTTP requests of a QuickBooks client within the realm's limits:
+    every request takes a token from the requests per minute bucket (batches also from the
+    batch bucket) and a slot of the concurrency limit. Throttled (429) and failed (5xx or
+    connection error) requests are retried with exponential backoff, or after the Retry-After
+    QBO sends. The concurrency limit adapts to QBO: it grows by one per window of fast requests,
+    halves when QBO throttles and shrinks when the requests get slower than the target latency.
+    The POST requests that change data carry a requestid, which QBO uses to answer a retried
+    request without doing it again.
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        requests_per_minute,
+        batch_requests_per_minute,
+        max_concurrency,
+        target_latency,
+        max_attempts,
+        backoff=1.0,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.batch_requests = TokenBucket(batch_requests_per_minute)
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # Starting with half of the allowed concurrency and adapting from there
+        self.concurrency = max(1.0, max_concurrency / 2)
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def wrap(self, process_request):
+        """Wraps the process_request method of a QuickBooks client so every request goes through the scheduler."""
+
+        def scheduled_request(request_type, url, headers="", params="", data=""):
+            return self.request(
+                process_request, request_type, url, headers, params, data
+            )
+
+        return scheduled_request
+
+    def request(self, process_request, request_type, url, headers, params, data):
+        """Sends the request when the limits allow it, retrying it while QBO throttles or fails.
+        After the last attempt the response is returned, or the connection error raised, as they are.
+        """
+        if request_type == "POST" and "/query" not in url and isinstance(params, dict):
+            params.setdefault("requestid", uuid.uuid4().hex)
+        is_batch = url.rstrip("/").endswith("/batch")
+
+        for attempt in range(self.max_attempts):
+            self.requests.acquire()
+            if is_batch:
+                self.batch_requests.acquire()
+
+            response = None
+            error = None
+            self._take_slot()
+            start = time.perf_counter()
+            try:
+                with span("qbo.request", method=request_type) as request_span:
+                    response = process_request(
+                        request_type, url, headers=headers, params=params, data=data
+                    )
+                    request_span.attributes["status_code"] = response.status_code
+            except (ConnectionError, Timeout) as e:
+                error = e
+            finally:
+                self._release_slot()
+            latency = time.perf_counter() - start
+
+            if error is None and response.status_code not in self.RETRY_STATUS_CODES:
+                self._adapt(latency)
+                return response
+
+            retry_after = self._retry_after(response)
+            if response is not None and response.status_code == 429:
+                self._adapt(latency, throttled=True)
+                self.requests.pause(retry_after or self.backoff)
+
+            if attempt == self.max_attempts - 1:
+                if error is not None:
+                    raise error
+                return response
+
+            # Waiting longer on every attempt, with jitter so the threads don't retry at once
+            delay = retry_after or self.backoff * 2**attempt
+            status = error or f"status code {response.status_code}"
+            print(f"QBO request failed ({status}), retrying in {delay:.1f}s")
+            time.sleep(delay * random.uniform(1, 1.5))
+
+    def _take_slot(self):
+        with self._condition:
+            while self.active >= int(self.concurrency):
+                self._condition.wait()
+            self.active += 1
+
+    def _release_slot(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def _adapt(self, latency, throttled=False):
+        """Adjusts the concurrency limit with the outcome of a request, additive increase and multiplicative decrease."""
+        with self._condition:
+            if throttled:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            elif latency > self.target_latency:
+                self.concurrency = max(1.0, self.concurrency * 0.9)
+            else:
+                self.concurrency = min(
+                    float(self.max_concurrency),
+                    self.concurrency + 1 / self.concurrency,
+                )
+            self._condition.notify_all()
+
+    def _retry_after(self, response):
+        """Gets the seconds QBO asked to wait before retrying, if it did."""
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
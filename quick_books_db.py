@@ -1,11 +1,16 @@
 import pyodbc
 from config import create_connection_string, db_config
+from cassette import cassette
 
 
 class QuickBooksDb:
     def __init__(self):
-        self.conn = pyodbc.connect(
-            create_connection_string(db_config["QuickBooks_ExampleDb"])
+        self.conn = cassette.connect(
+            "quickbooksdb",
+            pyodbc.connect,
+            create_connection_string(db_config["QuickBooks_ExampleDb"]),
+            # The keys table holds the QBO refresh tokens
+            redact=True,
         )
         self.cursor = self.conn.cursor()
 
@@ -14,8 +19,12 @@ class QuickBooksDb:
         return self.cursor.fetchone()[0]
 
     def update_refresh_token(self, refresh_token):
-        conn = pyodbc.connect(
-            create_connection_string(db_config["QuickBooks_ExampleDb"])
+        conn = cassette.connect(
+            "quickbooksdb",
+            pyodbc.connect,
+            create_connection_string(db_config["QuickBooks_ExampleDb"]),
+            # The keys table holds the QBO refresh tokens
+            redact=True,
         )
         cursor = conn.cursor()
         cursor.execute("INSERT INTO keys (refresh_token) VALUES (?)", refresh_token)
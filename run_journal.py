@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class RunJournal:
+    """
+    Append-only journal, kept in SQLite, of the stages each purchase order has gone through.
+    If a run dies halfway, the next one reads it to skip the work that was already done.
+    The stages are recorded in this order, each one with optional data to resume from it.
+    """
+
+    FETCHED = "fetched"
+    INVOICED = "invoiced"
+    WRITTEN = "written"
+    UPLOADED = "uploaded"
+    STATUS_UPDATED = "status_updated"
+    STAGES = [FETCHED, INVOICED, WRITTEN, UPLOADED, STATUS_UPDATED]
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # The journal is written from the pipeline threads, so every use goes through the lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps the journal consistent if the process dies while writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS order_stages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                purchase_order_number TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                data TEXT,
+                recorded_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE INDEX IF NOT EXISTS order_stages_purchase_order_number
+            ON order_stages (purchase_order_number)
+            """
+        )
+        self.conn.commit()
+
+        # The stages of the orders that weren't finished by previous runs
+        self.orders = self._load()
+
+    def _load(self):
+        orders = {}
+        rows = self.conn.execute(
+            "SELECT purchase_order_number, stage, data FROM order_stages ORDER BY id"
+        )
+        for purchase_order_number, stage, data in rows:
+            orders.setdefault(purchase_order_number, {})[stage] = (
+                json.loads(data) if data is not None else None
+            )
+        return {
+            purchase_order_number: stages
+            for purchase_order_number, stages in orders.items()
+            if RunJournal.STATUS_UPDATED not in stages
+        }
+
+    def record(self, stage, entries):
+        """Records that the orders reached the stage. entries maps each purchase order number to its data."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (
+                purchase_order_number,
+                stage,
+                json.dumps(data) if data is not None else None,
+                now,
+            )
+            for purchase_order_number, data in entries.items()
+        ]
+        with self._lock:
+            self.conn.executemany(
+                """
+                INSERT INTO order_stages (purchase_order_number, stage, data, recorded_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                rows,
+            )
+            self.conn.commit()
+            for purchase_order_number, data in entries.items():
+                self.orders.setdefault(purchase_order_number, {})[stage] = data
+
+    def get(self, purchase_order_number, stage):
+        """Gets the data the order was recorded with at the stage, None if it didn't reach it."""
+        return self.orders.get(purchase_order_number, {}).get(stage)
+
+    def last_stage(self, purchase_order_number):
+        """Gets the furthest stage the order reached, None if it isn't in the journal."""
+        stages = self.orders.get(purchase_order_number, {})
+        for stage in reversed(RunJournal.STAGES):
+            if stage in stages:
+                return stage
+        return None
+
+    def prune(self, max_age=None):
+        """Removes the orders that went through all the stages, and the ones whose last stage was
+        recorded more than max_age seconds ago, whatever stage they're at."""
+        cutoff = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            self.conn.execute(
+                """
+                DELETE FROM order_stages WHERE purchase_order_number IN (
+                    SELECT purchase_order_number FROM order_stages
+                    GROUP BY purchase_order_number
+                    HAVING SUM(stage = ?) > 0 OR MAX(recorded_at) < ?
+                )
+                """,
+                (RunJournal.STATUS_UPDATED, cutoff),
+            )
+            self.conn.commit()
+            self.orders = self._load()
+
+    def close(self):
+        self.conn.close()
@@ -1,8 +1,26 @@
+import json
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, Timeout, RequestException
-from email_helper import send_email
-from urllib.parse import quote
-from config import sellercloud_credentials, sellercloud_endpoints
+from email_helper import notify
+from tracing import span
+from atomic_write import write_atomically
+from cassette import (
+    REDACTED,
+    cassette,
+    decode_response,
+    encode_response,
+    redact_response,
+)
+from urllib.parse import quote, urlsplit
+from config import (
+    sellercloud_credentials,
+    sellercloud_endpoints,
+    sellercloud_settings,
+)
 
 
 class SellerCloudAPI:
@@ -22,9 +40,78 @@ class SellerCloudAPI:
     def __init__(self):
         self.data = sellercloud_credentials
         self.endpoints = sellercloud_endpoints
-        response = self.execute(self.data, "GET_TOKEN")
-        self.token = response.json()["access_token"]
-        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+        # One keep-alive session shared by every request, with a pool big enough for the concurrent fetches
+        pool_size = max(sellercloud_settings["max_workers"], 1)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # The token is reused across runs until it's about to expire
+        self.token_path = sellercloud_settings["token_path"]
+        self._token_lock = threading.Lock()
+        self.token = None
+        self.token_expires_at = 0
+        self.headers = None
+        self._load_token()
+        self._get_headers()
+
+    def _load_token(self):
+        """Loads the token saved by a previous run, if it was issued for the same endpoint."""
+        if not self.token_path or not os.path.exists(self.token_path):
+            return
+        try:
+            with open(self.token_path) as token_file:
+                saved_token = json.load(token_file)
+        except (OSError, ValueError) as e:
+            print(f"Error while loading the SellerCloud token: {e}")
+            return
+        if saved_token.get("url") == self.endpoints["GET_TOKEN"]["url"]:
+            self.token = saved_token["access_token"]
+            self.token_expires_at = saved_token["expires_at"]
+            self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    def _save_token(self):
+        """Saves the token so the next runs can reuse it, readable only by the current user."""
+        if not self.token_path:
+            return
+        saved_token = {
+            "url": self.endpoints["GET_TOKEN"]["url"],
+            "access_token": self.token,
+            "expires_at": self.token_expires_at,
+        }
+        try:
+            write_atomically(self.token_path, json.dumps(saved_token), mode=0o600)
+        except OSError as e:
+            print(f"Error while saving the SellerCloud token: {e}")
+
+    def _get_headers(self, rejected_headers=None):
+        """Gets the authorization headers, getting a new token if the current one is
+        about to expire or was rejected by SellerCloud."""
+        with self._token_lock:
+            refresh_at = (
+                self.token_expires_at - sellercloud_settings["token_refresh_margin"]
+            )
+            if (
+                self.token is None
+                or self.headers is rejected_headers
+                or time.time() >= refresh_at
+            ):
+                response = self.execute(self.data, "GET_TOKEN")
+                token_data = response.json()
+                self.token = token_data["access_token"]
+                self.token_expires_at = time.time() + token_data.get(
+                    "expires_in", sellercloud_settings["token_lifetime"]
+                )
+                self.headers = {"Authorization": f"Bearer {self.token}"}
+                self._save_token()
+
+            return self.headers
+
+    @staticmethod
+    def _encode_token_response(response):
+        return redact_response(encode_response(response), ["access_token"])
 
     def execute(self, data, action):
         """Executes a request to the SellerCloud API.
@@ -43,10 +130,23 @@ class SellerCloudAPI:
             raise ValueError("Invalid API action")
 
         if action == "GET_TOKEN":
-            self.headers = None
-            return self.perform_request(self.data, **config)
+            return self.perform_request(
+                dict(self.data), headers=None, action=action, **config
+            )
+
+        headers = self._get_headers()
+        response = self.perform_request(
+            dict(data), headers=headers, action=action, **config
+        )
+
+        # If SellerCloud rejected the token, the request is sent again with a new one
+        if response is not None and response.status_code == 401:
+            headers = self._get_headers(rejected_headers=headers)
+            response = self.perform_request(
+                dict(data), headers=headers, action=action, **config
+            )
 
-        return self.perform_request(data, **config)
+        return response
 
     def perform_request(
         self,
@@ -55,26 +155,48 @@ class SellerCloudAPI:
         url,
         endpoint_error_message,
         success_message,
+        headers=None,
+        action="REQUEST",
     ):
         """Performs a request to the SellerCloud API."""
         error_message = None
         max_attempts = 3
         timeout = 1000
 
+        # Taking the url args out once so the retries keep using them
+        url_args = data.pop("url_args", None)
+
         for attempt in range(max_attempts):
             try:
-                url_args = data.pop("url_args", None)
-
                 if url_args:
                     formatted_url = self._sanitize_url(url, url_args)
                 else:
                     formatted_url = url
 
-                request_function = getattr(requests, type)
+                request_function = getattr(self.session, type)
 
-                response = request_function(
-                    formatted_url, headers=self.headers, json=data, timeout=timeout
-                )
+                with span(f"sellercloud.{action.lower()}") as request_span:
+                    # The request is told apart by its path, so a replay can use another host
+                    # The credentials and the token are kept out of the cassette
+                    response = cassette.call(
+                        "sellercloud",
+                        (
+                            type,
+                            urlsplit(formatted_url)[2:],
+                            REDACTED if action == "GET_TOKEN" else data,
+                        ),
+                        lambda: request_function(
+                            formatted_url, headers=headers, json=data, timeout=timeout
+                        ),
+                        encode=(
+                            self._encode_token_response
+                            if action == "GET_TOKEN"
+                            else encode_response
+                        ),
+                        decode=decode_response,
+                    )
+                    request_span.bytes = len(response.content)
+                    request_span.attributes["status_code"] = response.status_code
                 break
             except ConnectionError:
                 if attempt < max_attempts - 1:
@@ -98,7 +220,7 @@ class SellerCloudAPI:
 
         if error_message:
             print(error_message)
-            send_email(
+            notify(
                 "There was an error executing a request on SellerCloud API : ",
                 error_message,
             )
@@ -1,72 +1,241 @@
 from seller_cloud_api import SellerCloudAPI
-from email_helper import send_email
+from sellercloud_cache import SellerCloudCache
+from email_helper import notify
+from run_journal import RunJournal
+from decimal_rounding import to_cents
+from config import sellercloud_settings
+from concurrent.futures import Future, ThreadPoolExecutor
 import traceback
 
 
-def get_sellercloud_data(ready_to_invoice_orders):
-    """Gets the financial data from SellerCloud for the orders that are ready to be invoiced."""
+def iter_sellercloud_pages(pages, max_workers=None, journal=None):
+    """Yields the dropshippers of each page of ready to invoice orders as soon as they have the SellerCloud data.
+    A dropshipper whose orders span several pages is yielded once per page. Orders with issues are removed
+    and dropshippers left without orders are skipped.
+    When a run journal is given, the orders a previous run already invoiced reuse the data their invoice was made with.
+    """
+    if max_workers is None:
+        max_workers = sellercloud_settings["max_workers"]
 
-    # Creating the SellerCloudAPI object to get the order data
-    sc_api = SellerCloudAPI()
+    # The local cache, the SellerCloud session and the request threads are shared by every page of the run
+    fetcher = _SellerCloudFetcher(max_workers)
+    try:
+        for ready_to_invoice_orders in pages:
+            fetches = fetcher.fetch(ready_to_invoice_orders, journal)
+            yield from _add_sellercloud_data(
+                ready_to_invoice_orders, fetches, journal, fetcher.cache
+            )
+    finally:
+        fetcher.close()
 
-    # Iterating over the dropshippers NOTE: Using a copy of the ready_to_invoice_orders.items to remove any dropshipper that has no orders
-    for dropshipper_key, dropshipper_data in list(ready_to_invoice_orders.items()):
 
-        # Iterating over the orders to get the order data from SellerCloud NOTE: Using a copy of the orders to remove any order that has issues
-        orders_copy = dropshipper_data["orders"].copy()
-        for order in orders_copy:
-            order_index = dropshipper_data["orders"].index(order)
+class _SellerCloudFetcher:
+    """Fetches the SellerCloud data of the orders through the local cache, the SellerCloudAPI session
+    and the request threads are only created once an order is missing from it."""
+
+    def __init__(self, max_workers):
+        self.max_workers = max(max_workers, 1)
+        self.sc_api = None
+        self.executor = None
+
+        # Opening the local cache of SellerCloud orders
+        self.cache = None
+        if sellercloud_settings["cache_path"]:
+            self.cache = SellerCloudCache(
+                sellercloud_settings["cache_path"],
+                sellercloud_settings["cache_ttl"],
+                sellercloud_settings["cache_max_entries"],
+            )
+
+    def fetch(self, ready_to_invoice_orders, journal=None):
+        """Returns a future of the SellerCloud data of each order, by dropshipper."""
+        # Taking the cached orders first, only the missing ones are requested to SellerCloud
+        fetches = {}
+        missing_orders = []
+        for dropshipper_key, dropshipper_data in ready_to_invoice_orders.items():
+            fetches[dropshipper_key] = []
+            for order in dropshipper_data["orders"]:
+                fetch = Future()
+                # The other orders go through the cache like any order, so their data is never older than its ttl
+                if journal and journal.last_stage(order.purchase_order_number) in (
+                    RunJournal.INVOICED,
+                    RunJournal.WRITTEN,
+                    RunJournal.UPLOADED,
+                ):
+                    sellercloud_order = journal.get(
+                        order.purchase_order_number, RunJournal.FETCHED
+                    )
+                    if sellercloud_order is not None:
+                        fetch.set_result(sellercloud_order)
+                if self.cache and not fetch.done():
+                    sellercloud_order = self.cache.get(order.sellercloud_order_id)
+                    if sellercloud_order is not None:
+                        fetch.set_result(sellercloud_order)
+                if not fetch.done():
+                    missing_orders.append((order, fetch))
+                fetches[dropshipper_key].append(fetch)
+
+        if missing_orders and self.executor is None:
+            # Creating the SellerCloudAPI object to get the order data
+            self.sc_api = SellerCloudAPI()
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # Requesting every missing order up front so the requests run concurrently, bounded by max_workers
+        for order, fetch in missing_orders:
+            self.executor.submit(_fetch_order, self.sc_api, self.cache, order, fetch)
+        return fetches
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+        if self.cache:
+            self.cache.close()
+
+
+def _fetch_order(sc_api, cache, order, fetch):
+    """Gets the order from SellerCloud into the fetch, None if SellerCloud didn't find it."""
+    try:
+        response = sc_api.execute(
+            {"url_args": {"order_id": order.sellercloud_order_id}},
+            "GET_ORDERS",
+        )
+        sellercloud_order = None
+        if response.status_code == 200:
+            sellercloud_order = response.json()
+            if cache:
+                cache.put(order.sellercloud_order_id, sellercloud_order)
+        fetch.set_result(sellercloud_order)
+    except Exception as e:
+        fetch.set_exception(e)
+
+
+def _add_sellercloud_data(ready_to_invoice_orders, fetches, journal, cache=None):
+    """Adds the fetched SellerCloud data to the orders, yielding the dropshippers that still have orders.
+    The orders whose data can't be added are removed from the cache, so a fix made in SellerCloud is picked up by the next run.
+    """
+    for dropshipper_key, dropshipper_data in ready_to_invoice_orders.items():
+
+        # Keeping only the orders that got all their data from SellerCloud, the ones with issues are left out
+        orders = []
+        fetched_orders = {}
+        for order, fetch in zip(dropshipper_data["orders"], fetches[dropshipper_key]):
             try:
-                # Getting the order data from SellerCloud
-                response = sc_api.execute(
-                    {"url_args": {"order_id": order["sellercloud_order_id"]}},
-                    "GET_ORDERS",
-                )
-                if response.status_code == 200:
-                    sellercloud_order = response.json()
-                    # Adding the financial data at the order level
-                    order["tax"] = sellercloud_order["TotalInfo"]["Tax"]
-                    order["subtotal"] = sellercloud_order["TotalInfo"]["GrandTotal"]
-                    # Adding the financial data at the item level
-                    for item in order["items"]:
-                        # Keeping the original item data to be able to update the price later
-                        item_index = order["items"].index(item)
-                        sku, quantity = item
-                        for product in sellercloud_order["OrderItems"]:
-                            if product["ProductIDOriginal"] == sku:
-                                item = (sku, quantity, product["LineTotal"] / quantity)
-                                order["items"][item_index] = item
-                                break
-                        # If no price was added to the item, the order is removed from the list
-                        if len(item) != 3:
-                            print(f"Item {sku} not found in SellerCloud")
-                            send_email(
-                                f"Item {sku} on order {order['purchase_order_number']} was not found in SellerCloud",
-                                "There is a missmatch on the skus the order has in the database and the ones it has in SellerCloud. No invoice was created.",
-                            )
-                            dropshipper_data["orders"].pop(order_index)
-                            break
-                # If the order was not found, the order is removed from the list
+                # Waiting for the order data from SellerCloud
+                sellercloud_order = fetch.result()
+                if sellercloud_order is not None:
+                    if _add_order_data(order, sellercloud_order):
+                        orders.append(order)
+                        fetched_orders[order.purchase_order_number] = _journal_data(
+                            sellercloud_order
+                        )
+                    elif cache:
+                        cache.delete(order.sellercloud_order_id)
+                # If the order was not found, the order is left out
                 else:
                     print(
-                        f"Order {order['purchase_order_number']} not found in SellerCloud"
+                        f"Order {order.purchase_order_number} not found in SellerCloud"
                     )
-                    send_email(
-                        f"Order {order['purchase_order_number']} not found in SellerCloud",
-                        f"The API was not able to retrieve {order['purchase_order_number']} using the sellercloud_id {order['sellercloud_order_id']}. No invoice was created.",
+                    notify(
+                        f"Order {order.purchase_order_number} not found in SellerCloud",
+                        f"The API was not able to retrieve {order.purchase_order_number} using the sellercloud_id {order.sellercloud_order_id}. No invoice was created.",
                     )
-                    dropshipper_data["orders"].pop(order_index)
 
             except Exception as e:
+                if cache:
+                    cache.delete(order.sellercloud_order_id)
                 print(f"Error: {e}")
-                send_email(
-                    f"Unable to get price data from SellerCloud for order {order['purchase_order_number']}",
+                notify(
+                    f"Unable to get price data from SellerCloud for order {order.purchase_order_number}",
                     f"An unexpected error occurred. No invoice was created.\nError: {e}\n\n{traceback.format_exc()}",
                 )
-                dropshipper_data["orders"].pop(order_index)
 
-        # If there are no orders left for the dropshipper, the dropshipper is removed from the list
-        if not dropshipper_data["orders"]:
-            del ready_to_invoice_orders[dropshipper_key]
+        dropshipper_data["orders"] = orders
+        if journal:
+            journal.record(RunJournal.FETCHED, fetched_orders)
+
+        # If there are no orders left for the dropshipper, the dropshipper is skipped
+        if dropshipper_data["orders"]:
+            yield dropshipper_key, dropshipper_data
+
+
+def _add_order_data(order, sellercloud_order):
+    """Adds the SellerCloud financial data to the order in integer cents, returns False if any of its skus is missing,
+    any of its quantities isn't positive or any of its amounts isn't valid.
+    Each item gets the cents of its whole line, the unit cost is worked out where it's written.
+    """
+    products = sellercloud_order["OrderItems"]
+    total_info = sellercloud_order["TotalInfo"]
+
+    # Rounding the line totals, the tax and the grand total to cents at once
+    try:
+        cents = to_cents(
+            [product["LineTotal"] for product in products]
+            + [total_info["Tax"], total_info["GrandTotal"]]
+        ).tolist()
+    except ValueError as e:
+        print(
+            f"Order {order.purchase_order_number} has amounts that are not valid in SellerCloud"
+        )
+        notify(
+            f"Order {order.purchase_order_number} has amounts that are not valid in SellerCloud",
+            f"The line totals, tax or grand total of the order in SellerCloud are not valid amounts: {e}. No invoice was created.",
+        )
+        return False
+
+    # Mapping each product to the first line it shows up in
+    line_totals = {}
+    for product, line_total in zip(products, cents):
+        line_totals.setdefault(product["ProductIDOriginal"], line_total)
+
+    # Adding the financial data at the item level
+    items_line_totals = []
+    for sku, quantity in order.items:
+        # The unit cost is the line total over the quantity, so an item without a quantity leaves the order out
+        if quantity <= 0:
+            print(f"Item {sku} has a quantity of {quantity}")
+            notify(
+                f"Item {sku} on order {order.purchase_order_number} has a quantity of {quantity}",
+                "The quantity of the item in the database must be positive to work out its unit cost. No invoice was created.",
+            )
+            return False
+        # If no price is found for the item, the order is left out
+        if sku not in line_totals:
+            print(f"Item {sku} not found in SellerCloud")
+            notify(
+                f"Item {sku} on order {order.purchase_order_number} was not found in SellerCloud",
+                "There is a missmatch on the skus the order has in the database and the ones it has in SellerCloud. No invoice was created.",
+            )
+            return False
+        items_line_totals.append(line_totals[sku])
+
+    # Adding the financial data at the order level
+    order.items.price(items_line_totals)
+    order.tax = cents[-2]
+    order.subtotal = cents[-1]
+    order.integer_amounts = tuple(
+        field
+        for field, amount in (
+            ("tax", total_info["Tax"]),
+            ("subtotal", total_info["GrandTotal"]),
+        )
+        if isinstance(amount, int)
+    )
+
+    return True
+
 
-    return ready_to_invoice_orders
+def _journal_data(sellercloud_order):
+    """Keeps only the part of the SellerCloud order that _add_order_data uses."""
+    return {
+        "TotalInfo": {
+            "Tax": sellercloud_order["TotalInfo"]["Tax"],
+            "GrandTotal": sellercloud_order["TotalInfo"]["GrandTotal"],
+        },
+        "OrderItems": [
+            {
+                "ProductIDOriginal": product["ProductIDOriginal"],
+                "LineTotal": product["LineTotal"],
+            }
+            for product in sellercloud_order["OrderItems"]
+        ],
+    }
@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SellerCloudCache:
+    """
+    Local SQLite cache of the GET_ORDERS responses from SellerCloud, keyed by sellercloud_order_id.
+    The financial data of a shipped order rarely changes, so reruns can take it from here instead
+    of asking SellerCloud again. Responses older than the ttl are ignored and only the max_entries
+    most recently used responses are kept.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # The connection is shared by the fetching threads, so every use goes through the lock
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                sellercloud_order_id TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                cached_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS orders_last_used_at ON orders (last_used_at)"
+        )
+        self.conn.commit()
+
+    def get(self, sellercloud_order_id):
+        """Gets the cached order, or None if it isn't cached or has expired."""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT response, cached_at FROM orders WHERE sellercloud_order_id = ?",
+                (str(sellercloud_order_id),),
+            ).fetchone()
+            if row is None:
+                return None
+
+            response, cached_at = row
+            if now - cached_at >= self.ttl:
+                self.conn.execute(
+                    "DELETE FROM orders WHERE sellercloud_order_id = ?",
+                    (str(sellercloud_order_id),),
+                )
+                self.conn.commit()
+                return None
+
+            self.conn.execute(
+                "UPDATE orders SET last_used_at = ? WHERE sellercloud_order_id = ?",
+                (now, str(sellercloud_order_id)),
+            )
+            self.conn.commit()
+
+        return json.loads(response)
+
+    def put(self, sellercloud_order_id, sellercloud_order):
+        """Caches the order returned by SellerCloud."""
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO orders (sellercloud_order_id, response, cached_at, last_used_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (str(sellercloud_order_id), json.dumps(sellercloud_order), now, now),
+            )
+            self.conn.commit()
+
+    def delete(self, sellercloud_order_id):
+        """Removes the cached order, so the next run asks SellerCloud for it again."""
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM orders WHERE sellercloud_order_id = ?",
+                (str(sellercloud_order_id),),
+            )
+            self.conn.commit()
+
+    def evict(self):
+        """Removes the expired orders and the least recently used ones over max_entries."""
+        with self._lock:
+            self.conn.execute(
+                "DELETE FROM orders WHERE cached_at <= ?", (time.time() - self.ttl,)
+            )
+            self.conn.execute(
+                """
+                DELETE FROM orders WHERE sellercloud_order_id IN (
+                    SELECT sellercloud_order_id FROM orders
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.evict()
+        self.conn.close()
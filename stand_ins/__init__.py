@@ -0,0 +1 @@
+"""Local stand-ins for the external systems, used to run the invoicing offline."""
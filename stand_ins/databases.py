@@ -0,0 +1,328 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from decimal import Decimal
+from decimal_rounding import from_cents
+
+# Reading the columns back with the types pyodbc gives them
+sqlite3.register_converter("DECIMAL", lambda value: Decimal(value.decode()))
+sqlite3.register_converter(
+    "DATETIME", lambda value: datetime.fromisoformat(value.decode())
+)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+
+
+class ExampleDbStandIn:
+    """
+    SQLite stand-in for the ExampleDb SQL Server database, with the tables and columns ExampleDb uses.
+    orders is a list of (dropshipper_info, file_format_name, order) with each order in the shape
+    get_invoice_ready_orders gives it.
+    The statements of ExampleDb run as they are written, only the few T-SQL constructs SQLite doesn't
+    have are rewritten (TOP, the temp tables, UPDATE ... FROM with a JOIN, STRING_AGG, TRUNCATE), so
+    its set-based queries, keyset paging and temp table write-back all run. Their timings show the
+    round trips and the rows moved, not SQL Server's query plans.
+    Use it in ExampleDb by replacing pyodbc.connect with the stand-in's connect.
+    """
+
+    def __init__(self, orders, vendor_mapping, invoice_csv_headers, query_latency=0.0):
+        self.query_latency = query_latency
+        self.query_count = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            ":memory:",
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.executescript(_EXAMPLE_DB_SCHEMA)
+        self._load(orders, vendor_mapping, invoice_csv_headers)
+
+    def _load(self, orders, vendor_mapping, invoice_csv_headers):
+        dropshippers = {}
+        for dropshipper_info, file_format_name, order in orders:
+            dropshippers.setdefault(
+                dropshipper_info, (file_format_name, order.dropshipper_name)
+            )
+        # In the same order as the dropshipper keys, which is the order the pages are read in
+        dropshipper_ids = {
+            dropshipper_info: index
+            for index, dropshipper_info in enumerate(sorted(dropshippers), 1)
+        }
+        format_ids = {
+            name: index for index, name in enumerate(sorted(invoice_csv_headers), 1)
+        }
+        states = {}
+        countries = {}
+        for _, _, order in orders:
+            states.setdefault(order.state, len(states) + 1)
+            countries.setdefault(order.country, len(countries) + 1)
+
+        self._db.executemany(
+            "INSERT INTO FileFormats (id, name, type) VALUES (?, ?, 'invoice')",
+            [(format_id, name) for name, format_id in format_ids.items()],
+        )
+        self._db.executemany(
+            "INSERT INTO FileFormatDetails (format_id, header_name) VALUES (?, ?)",
+            [
+                (format_ids[name], header)
+                for name, headers in invoice_csv_headers.items()
+                for header in headers
+            ],
+        )
+        self._db.executemany(
+            """
+            INSERT INTO Dropshippers
+            (id, code, name, ftp_folder_name, ship_method, invoice_email, quickbook_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    dropshipper_ids[dropshipper_info],
+                    dropshipper_info[0],
+                    name,
+                    dropshipper_info[1],
+                    vendor_mapping[name]["ship_method"],
+                    vendor_mapping[name]["email"],
+                    vendor_mapping[name]["customer_id"],
+                )
+                for dropshipper_info, (_, name) in dropshippers.items()
+            ],
+        )
+        self._db.executemany(
+            "INSERT INTO DropshipperFileFormats (dropshipper_id, format_id) VALUES (?, ?)",
+            [
+                (dropshipper_ids[dropshipper_info], format_ids[file_format_name])
+                for dropshipper_info, (file_format_name, _) in dropshippers.items()
+            ],
+        )
+        self._db.executemany(
+            "INSERT INTO States (id, code) VALUES (?, ?)",
+            [(state_id, code) for code, state_id in states.items()],
+        )
+        self._db.executemany(
+            "INSERT INTO Countries (id, two_letter_code) VALUES (?, ?)",
+            [(country_id, code) for code, country_id in countries.items()],
+        )
+        self._db.executemany(
+            """
+            INSERT INTO PurchaseOrders
+            (id, dropshipper_id, purchase_order_number, sellercloud_order_id, shipping_cost,
+            tracking_number, tracking_date, city, zip, address, state, country, is_invoiced)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            """,
+            [
+                (
+                    order.purchase_order_id,
+                    dropshipper_ids[dropshipper_info],
+                    order.purchase_order_number,
+                    order.sellercloud_order_id,
+                    str(from_cents(order.shipping)),
+                    order.tracking_number,
+                    datetime.strptime(order.ship_date, "%Y/%m/%d"),
+                    order.city,
+                    order.postal_code,
+                    order.address,
+                    states[order.state],
+                    countries[order.country],
+                )
+                for dropshipper_info, _, order in orders
+            ],
+        )
+        self._db.executemany(
+            "INSERT INTO PurchaseOrderItems (purchase_order_id, sku, quantity) VALUES (?, ?, ?)",
+            [
+                (order.purchase_order_id, sku, quantity)
+                for _, _, order in orders
+                for sku, quantity in order.items
+            ],
+        )
+
+    @property
+    def invoiced_count(self):
+        """Number of purchase orders marked as invoiced."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM PurchaseOrders WHERE is_invoiced = 1"
+            ).fetchone()[0]
+
+    def connect(self, *args, **kwargs):
+        """Opens a pyodbc like connection to the stand-in, the connection string is ignored."""
+        return _StandInConnection(self)
+
+    def _run(self, sql, params=(), many=False):
+        """Runs a T-SQL statement of ExampleDb, returns its description and rows."""
+        with self._lock:
+            self.query_count += 1
+            if self.query_latency:
+                time.sleep(self.query_latency)
+            cursor = self._db.cursor()
+            for statement, statement_params in _translate(sql, params, many):
+                if many:
+                    cursor.executemany(statement, statement_params)
+                else:
+                    cursor.execute(statement, statement_params)
+            return cursor.description, cursor.fetchall()
+
+
+# The tables and columns of ExampleDb that ExampleDb reads and writes
+_EXAMPLE_DB_SCHEMA = """
+CREATE TABLE Dropshippers (
+    id INTEGER PRIMARY KEY,
+    code TEXT,
+    name TEXT,
+    ftp_folder_name TEXT,
+    ship_method TEXT,
+    invoice_email TEXT,
+    quickbook_id INTEGER
+);
+CREATE TABLE States (id INTEGER PRIMARY KEY, code TEXT);
+CREATE TABLE Countries (id INTEGER PRIMARY KEY, two_letter_code TEXT);
+CREATE TABLE FileFormats (id INTEGER PRIMARY KEY, name TEXT, type TEXT);
+CREATE TABLE FileFormatDetails (
+    id INTEGER PRIMARY KEY,
+    format_id INTEGER,
+    header_name TEXT
+);
+CREATE TABLE DropshipperFileFormats (dropshipper_id INTEGER, format_id INTEGER);
+CREATE TABLE PurchaseOrders (
+    id INTEGER PRIMARY KEY,
+    dropshipper_id INTEGER,
+    purchase_order_number TEXT,
+    sellercloud_order_id TEXT,
+    shipping_cost DECIMAL(10, 2),
+    tracking_number TEXT,
+    tracking_date DATETIME,
+    city TEXT,
+    zip TEXT,
+    address TEXT,
+    state INTEGER,
+    country INTEGER,
+    is_invoiced INTEGER,
+    subtotal DECIMAL(10, 2),
+    tax DECIMAL(10, 2),
+    total DECIMAL(10, 2),
+    invoiced_date DATETIME
+);
+CREATE INDEX PurchaseOrders_ready ON PurchaseOrders (is_invoiced, dropshipper_id, id);
+CREATE TABLE PurchaseOrderItems (
+    id INTEGER PRIMARY KEY,
+    purchase_order_id INTEGER,
+    sku TEXT,
+    quantity INTEGER,
+    price DECIMAL(10, 2)
+);
+CREATE INDEX PurchaseOrderItems_order ON PurchaseOrderItems (purchase_order_id);
+"""
+
+# The T-SQL of ExampleDb SQLite doesn't have, with what it's rewritten to
+_DROP_TEMP_TABLE = re.compile(
+    r"IF OBJECT_ID\('tempdb\.\.#(\w+)'\) IS NOT NULL DROP TABLE #\w+"
+)
+_SELECT_INTO_TEMP_TABLE = re.compile(
+    r"SELECT\s+TOP 0\s+(.*?)\s+INTO\s+#(\w+)\s+FROM\s+(\w+)", re.DOTALL
+)
+_UPDATE_JOIN = re.compile(
+    r"UPDATE\s+(\w+)\s+SET\s+(.*?)\s+FROM\s+(\w+)\s+\1\s+JOIN\s+(#?\w+)\s+(\w+)\s+ON\s+(.*)",
+    re.DOTALL,
+)
+_TOP_PARAMETER = re.compile(r"SELECT\s+TOP \(\?\)")
+
+
+def _translate(sql, params, many=False):
+    """Rewrites a T-SQL statement of ExampleDb for SQLite, returns the statements to run with their parameters."""
+    sql = _DROP_TEMP_TABLE.sub(r"DROP TABLE IF EXISTS temp.\1", sql)
+    sql = _SELECT_INTO_TEMP_TABLE.sub(
+        r"CREATE TEMP TABLE \2 AS SELECT \1 FROM \3 LIMIT 0", sql
+    )
+    sql = _UPDATE_JOIN.sub(r"UPDATE \3 AS \1 SET \2 FROM \4 AS \5 WHERE \6", sql)
+    sql = sql.replace("TRUNCATE TABLE", "DELETE FROM")
+    sql = sql.replace("STRING_AGG(", "group_concat(")
+    sql = re.sub(r"#(\w+)", r"temp.\1", sql)
+
+    params = list(params)
+    # TOP (?) takes the first parameter, LIMIT takes it at the end
+    if not many and _TOP_PARAMETER.search(sql):
+        sql = _TOP_PARAMETER.sub("SELECT", sql, count=1) + " LIMIT ?"
+        params = params[1:] + params[:1]
+
+    statements = [statement for statement in sql.split(";") if statement.strip()]
+    if len(statements) > 1 and params:
+        raise ValueError("The stand-in can't split a statement with parameters")
+    return [(statement, params) for statement in statements]
+
+
+class _StandInCursor:
+    """pyodbc like cursor over the SQLite stand-in, with rows that have attribute access."""
+
+    def __init__(self, stand_in):
+        self._stand_in = stand_in
+        self._rows = deque()
+        self.description = None
+        self.fast_executemany = False
+
+    def execute(self, sql, *params):
+        # The parameters can be given one by one or as a single sequence, like in pyodbc
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self.description, rows = self._stand_in._run(sql, params)
+        self._rows = deque()
+        if self.description:
+            row_class = namedtuple(
+                "Row", [column[0] for column in self.description], rename=True
+            )
+            self._rows = deque(row_class(*row) for row in rows)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._stand_in._run(sql, list(seq_of_params), many=True)
+        self.description = None
+        self._rows = deque()
+
+    def fetchone(self):
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=1):
+        return [self._rows.popleft() for _ in range(min(size, len(self._rows)))]
+
+    def fetchall(self):
+        rows, self._rows = list(self._rows), deque()
+        return rows
+
+
+class _StandInConnection:
+    """pyodbc like connection to the SQLite stand-in, each statement is committed as it runs."""
+
+    def __init__(self, stand_in):
+        self._stand_in = stand_in
+
+    def cursor(self):
+        return _StandInCursor(self._stand_in)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QuickBooksDbStandIn:
+    """In-memory stand-in for QuickBooksDb, keeping the refresh tokens it's given."""
+
+    def __init__(self, refresh_token="stand_in_refresh_token"):
+        self.refresh_tokens = [refresh_token]
+
+    def get_refresh_token(self):
+        return self.refresh_tokens[-1]
+
+    def update_refresh_token(self, refresh_token):
+        self.refresh_tokens.append(refresh_token)
+        return True
+
+    def close(self):
+        pass
@@ -0,0 +1,117 @@
+import socket
+import socketserver
+import threading
+
+
+class FtpStandIn:
+    """
+    Minimal in-process FTP server with the commands FTPManager uses: login, changing
+    directories and passive mode binary uploads. Any user and directory is accepted and
+    the uploaded files are only counted, not kept.
+    Point FTPManager at it with:
+        ftp_server["server"], ftp_server["port"] = stand_in.address
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.uploads = {}
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(
+            (host, port), self._handler_class()
+        )
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                stand_in._handle(self)
+
+        return Handler
+
+    def _handle(self, handler):
+        def reply(line):
+            handler.wfile.write(f"{line}\r\n".encode())
+
+        current_directory = "/"
+        data_listener = None
+        reply("220 FTP stand-in ready")
+
+        for raw_line in handler.rfile:
+            command, _, argument = raw_line.decode().strip().partition(" ")
+            command = command.upper()
+
+            if command == "USER":
+                reply("331 Password required")
+            elif command == "PASS":
+                reply("230 Logged in")
+            elif command in ("TYPE", "MODE", "STRU"):
+                reply("200 OK")
+            elif command == "SYST":
+                reply("215 UNIX Type: L8")
+            elif command == "PWD":
+                reply(f'257 "{current_directory}"')
+            elif command == "CWD":
+                current_directory = argument
+                reply("250 Directory changed")
+            elif command == "NOOP":
+                reply("200 OK")
+            elif command == "PASV":
+                data_listener = socket.create_server((self.host, 0))
+                port = data_listener.getsockname()[1]
+                address = self.host.replace(".", ",")
+                reply(
+                    f"227 Entering Passive Mode ({address},{port // 256},{port % 256})"
+                )
+            elif command == "STOR":
+                if data_listener is None:
+                    reply("425 Use PASV first")
+                    continue
+                reply("150 Opening data connection")
+                connection, _ = data_listener.accept()
+                size = 0
+                with connection:
+                    while True:
+                        chunk = connection.recv(65536)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                data_listener.close()
+                data_listener = None
+                path = f"{current_directory.rstrip('/')}/{argument}"
+                with self._lock:
+                    self.uploads[path] = self.uploads.get(path, 0) + 1
+                    self.bytes_received += size
+                reply("226 Transfer complete")
+            elif command == "QUIT":
+                reply("221 Goodbye")
+                break
+            else:
+                reply(f"502 {command} not implemented")
+
+        if data_listener is not None:
+            data_listener.close()
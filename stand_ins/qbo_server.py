@@ -0,0 +1,280 @@
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class QboStandIn:
+    """
+    In-process stand-in for the pieces of the QuickBooks Online v3 API that QbInvoice uses:
+    the OAuth discovery document and token endpoint, single object reads, queries,
+    invoice creation and deletion, and batch requests.
+    Point QbInvoice at it with:
+        client_data["environment"] = stand_in.discovery_url
+        qb_settings["api_url"] = stand_in.api_url
+    Invoices whose DocNumber is in fail_doc_numbers are rejected with a validation fault.
+    A throttle_rate share of the API requests is answered with a 429 like QBO's throttling,
+    and a POST repeating a requestid gets the response of the first one, like in QBO.
+    """
+
+    QUERY_PATTERN = re.compile(
+        r"SELECT \* FROM (?P<object>\w+)\s*(WHERE (?P<field>\w+) (?P<op>=|in) (?P<values>\(.*\)|'.*?'))?"
+        r"(\s*STARTPOSITION (?P<start>\d+))?(\s*MAXRESULTS (?P<max>\d+))?",
+        re.IGNORECASE,
+    )
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        fail_doc_numbers=(),
+        throttle_rate=0.0,
+    ):
+        self.latency = latency
+        self.fail_doc_numbers = set(fail_doc_numbers)
+        self.throttle_rate = throttle_rate
+        self.throttled_count = 0
+        self.responses_by_request_id = {}
+        self._random = random.Random(0)
+        self.invoices = {}
+        # Index of the invoices by DocNumber so the lookups stay fast with many invoices
+        self.invoices_by_doc_number = {}
+        self.request_count = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        return f"{self.base_url}/v3"
+
+    @property
+    def discovery_url(self):
+        return f"{self.base_url}/.well-known/openid_configuration"
+
+    def start(self):
+        # The QuickBooks client refuses to send tokens over plain http otherwise
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stand_in._handle(self, "GET")
+
+            def do_POST(self):
+                stand_in._handle(self, "POST")
+
+        return Handler
+
+    def _handle(self, handler, method):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urlparse(handler.path)
+        params = parse_qs(url.query)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length).decode() if length else ""
+        parts = url.path.strip("/").split("/")
+
+        if url.path.endswith("openid_configuration"):
+            status, payload = 200, {
+                "issuer": self.base_url,
+                "authorization_endpoint": f"{self.base_url}/oauth2/authorize",
+                "token_endpoint": f"{self.base_url}/oauth2/tokens/bearer",
+                "revocation_endpoint": f"{self.base_url}/oauth2/tokens/revoke",
+                "userinfo_endpoint": f"{self.base_url}/oauth2/userinfo",
+                "jwks_uri": f"{self.base_url}/oauth2/keys",
+            }
+        elif url.path.endswith("tokens/bearer"):
+            status, payload = 200, {
+                "access_token": "stand_in_access_token",
+                "refresh_token": "stand_in_refresh_token",
+                "expires_in": 3600,
+                "x_refresh_token_expires_in": 8726400,
+                "token_type": "bearer",
+            }
+        # /v3/company/<realm_id>/<resource>[/<id>]
+        elif len(parts) >= 4 and parts[0] == "v3" and parts[1] == "company":
+            status, payload = self._handle_api_request(method, parts[3:], params, body)
+        else:
+            status, payload = 404, {"Fault": self._fault("Not found", 404)}
+
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        if status == 429:
+            handler.send_header("Retry-After", "0.05")
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _handle_api_request(self, method, resource, params, body):
+        with self._lock:
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled_count += 1
+        if throttled:
+            return 429, {"Fault": self._fault("ThrottleExceeded", 3001)}
+
+        request_id = params.get("requestid", [None])[0] if method == "POST" else None
+        if request_id is not None:
+            with self._lock:
+                response = self.responses_by_request_id.get(request_id)
+            if response is not None:
+                return response
+
+        response = self._handle_api(method, resource, params, body)
+        if request_id is not None:
+            with self._lock:
+                self.responses_by_request_id[request_id] = response
+        return response
+
+    def _handle_api(self, method, resource, params, body):
+        name = resource[0]
+        if method == "GET" and len(resource) == 2:
+            return 200, self._read(name, resource[1])
+        if method == "POST" and name == "query":
+            return 200, self._query(body)
+        if method == "POST" and name == "invoice":
+            if params.get("operation") == ["delete"]:
+                return 200, self._delete_invoice(json.loads(body))
+            invoice, fault = self._create_invoice(json.loads(body))
+            if fault:
+                return 400, {"Fault": fault}
+            return 200, {"Invoice": invoice}
+        if method == "POST" and name == "batch":
+            return 200, self._batch(json.loads(body))
+        return 400, {"Fault": self._fault(f"Unsupported operation {name}", 4000)}
+
+    def _read(self, name, id):
+        object_name = {"class": "Class"}.get(name, name.capitalize())
+        return {
+            object_name: {
+                "Id": str(id),
+                "SyncToken": "0",
+                "Name": f"{object_name} {id}",
+                "DisplayName": f"{object_name} {id}",
+                "FullyQualifiedName": f"{object_name} {id}",
+                "Active": True,
+            }
+        }
+
+    def _query(self, select):
+        match = self.QUERY_PATTERN.match(select.strip())
+        if not match or match.group("object") != "Invoice":
+            return {"QueryResponse": {}}
+
+        values = None
+        if match.group("field"):
+            values = re.findall(r"'((?:[^'\\]|\\.)*)'", match.group("values"))
+            values = list(dict.fromkeys(value.replace("\\'", "'") for value in values))
+
+        with self._lock:
+            if match.group("field") == "DocNumber":
+                invoices = [
+                    self.invoices_by_doc_number[value]
+                    for value in values
+                    if value in self.invoices_by_doc_number
+                ]
+            else:
+                invoices = list(self.invoices.values())
+        if values is not None and match.group("field") != "DocNumber":
+            invoices = [
+                invoice
+                for invoice in invoices
+                if str(invoice.get(match.group("field"))) in values
+            ]
+
+        start = int(match.group("start") or 1) - 1
+        max_results = int(match.group("max") or 100)
+        page = invoices[start : start + max_results]
+        if not page:
+            return {"QueryResponse": {}}
+        return {
+            "QueryResponse": {
+                "Invoice": page,
+                "startPosition": start + 1,
+                "maxResults": len(page),
+            }
+        }
+
+    def _create_invoice(self, invoice):
+        if invoice.get("DocNumber") in self.fail_doc_numbers:
+            return None, self._fault("Duplicate Document Number Error", 6140)
+        with self._lock:
+            invoice = dict(invoice, Id=str(next(self._ids)), SyncToken="0")
+            self.invoices[invoice["Id"]] = invoice
+            if invoice.get("DocNumber") is not None:
+                self.invoices_by_doc_number[invoice["DocNumber"]] = invoice
+        return invoice, None
+
+    def _delete_invoice(self, invoice):
+        with self._lock:
+            deleted_invoice = self.invoices.pop(invoice.get("Id"), None)
+            if deleted_invoice is not None:
+                self.invoices_by_doc_number.pop(deleted_invoice.get("DocNumber"), None)
+        return {"Invoice": {"Id": invoice.get("Id"), "status": "Deleted"}}
+
+    def _batch(self, batch):
+        responses = []
+        for item in batch["BatchItemRequest"]:
+            if item["operation"] != "create" or "Invoice" not in item:
+                fault = self._fault("Unsupported batch operation", 4000)
+                responses.append({"bId": item["bId"], "Fault": fault})
+                continue
+            invoice, fault = self._create_invoice(item["Invoice"])
+            if fault:
+                responses.append({"bId": item["bId"], "Fault": fault})
+            else:
+                responses.append({"bId": item["bId"], "Invoice": invoice})
+        return {"BatchItemResponse": responses}
+
+    def _fault(self, message, code):
+        return {
+            "Error": [{"Message": message, "Detail": message, "code": str(code)}],
+            "type": "ValidationFault",
+        }
+
+
+if __name__ == "__main__":
+    with QboStandIn(port=8765) as stand_in:
+        print(f"QBO stand-in listening, discovery url: {stand_in.discovery_url}")
+        print(f"API url: {stand_in.api_url}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+
+
+class SellerCloudStandIn:
+    """
+    In-process stand-in for the SellerCloud REST API endpoints that SellerCloudAPI uses:
+    the token endpoint and the order reads.
+    Point SellerCloudAPI at it by replacing sellercloud_base_url in the sellercloud_endpoints urls
+    with stand_in.base_url.
+    orders maps each SellerCloud order id to the order it returns, the other ids get a 404.
+    """
+
+    def __init__(self, orders=None, host="127.0.0.1", port=0, latency=0.0):
+        self.orders = orders if orders is not None else {}
+        self.latency = latency
+        self.request_count = 0
+        self.token_count = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/rest/api/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeping the connections alive like SellerCloud does, without waiting on Nagle's algorithm
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stand_in._handle(self, "GET")
+
+            def do_POST(self):
+                stand_in._handle(self, "POST")
+
+        return Handler
+
+    def _handle(self, handler, method):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        length = int(handler.headers.get("Content-Length") or 0)
+        if length:
+            handler.rfile.read(length)
+        parts = urlparse(handler.path).path.strip("/").split("/")
+
+        # /rest/api/token and /rest/api/Orders/<order_id>
+        if method == "POST" and parts[-1] == "token":
+            with self._lock:
+                self.token_count += 1
+            status, payload = 200, {
+                "access_token": f"stand_in_token_{self.token_count}",
+                "expires_in": 3600,
+            }
+        elif method == "GET" and len(parts) >= 2 and parts[-2] == "Orders":
+            if handler.headers.get("Authorization", "").startswith("Bearer "):
+                order = self.orders.get(unquote(parts[-1]))
+                if order is None:
+                    status, payload = 404, {"Message": "Order not found"}
+                else:
+                    status, payload = 200, order
+            else:
+                status, payload = 401, {"Message": "Unauthorized"}
+        else:
+            status, payload = 404, {"Message": "Not found"}
+
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -0,0 +1,95 @@
+import socketserver
+import threading
+
+
+class SmtpSink:
+    """
+    Minimal in-process SMTP server that accepts any login and message and drops them,
+    keeping only their subjects.
+    Point send_email at it with:
+        smtp_settings["server"], smtp_settings["port"] = sink.address
+        smtp_settings["use_ssl"] = False
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.subjects = []
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer(
+            (host, port), self._handler_class()
+        )
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _handler_class(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                sink._handle(self)
+
+        return Handler
+
+    def _handle(self, handler):
+        def reply(line):
+            handler.wfile.write(f"{line}\r\n".encode())
+
+        reply("220 SMTP sink ready")
+        for raw_line in handler.rfile:
+            command = raw_line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb == "EHLO":
+                reply("250-SMTP sink")
+                reply("250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                reply("250 SMTP sink")
+            elif verb == "AUTH":
+                # AUTH LOGIN asks for the user and the password, AUTH PLAIN sends them at once
+                if command.upper().startswith("AUTH LOGIN"):
+                    reply("334 VXNlcm5hbWU6")
+                    handler.rfile.readline()
+                    reply("334 UGFzc3dvcmQ6")
+                    handler.rfile.readline()
+                elif command.upper() == "AUTH PLAIN":
+                    reply("334 ")
+                    handler.rfile.readline()
+                reply("235 Authentication successful")
+            elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                reply("250 OK")
+            elif verb == "DATA":
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                subject = None
+                for data_line in handler.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    if subject is None and data_line.startswith(b"Subject:"):
+                        subject = data_line[len(b"Subject:") :].decode().strip()
+                with self._lock:
+                    self.subjects.append(subject)
+                reply("250 Message accepted")
+            elif verb == "QUIT":
+                reply("221 Bye")
+                break
+            else:
+                reply(f"502 {verb} not implemented")
@@ -0,0 +1,127 @@
+import gzip
+import os
+import sqlite3
+import stat
+import types
+import requests
+from cassette import REDACTED, Cassette, encode_response, redact_response
+from config import sellercloud_settings
+
+
+class _PyodbcLikeCursor:
+    """sqlite3 cursor taking the parameters one by one, like pyodbc."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql, *params):
+        self._cursor.execute(sql, params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+class _PyodbcLikeConnection:
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+
+    def cursor(self):
+        return _PyodbcLikeCursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def _keys_db(path):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE keys (ID INTEGER PRIMARY KEY, refresh_token TEXT)")
+    connection.execute(
+        "INSERT INTO keys (refresh_token) VALUES ('secret_refresh_token')"
+    )
+    connection.commit()
+    connection.close()
+
+
+def _use_keys(cassette, db_path, new_refresh_token):
+    connection = cassette.connect(
+        "quickbooksdb", _PyodbcLikeConnection, db_path, redact=True
+    )
+    cursor = connection.cursor()
+    cursor.execute("SELECT refresh_token FROM keys ORDER BY ID DESC LIMIT 1")
+    refresh_token = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO keys (refresh_token) VALUES (?)", new_refresh_token)
+    connection.commit()
+    connection.close()
+    return refresh_token
+
+
+def test_redacting_connection_keeps_the_tokens_out_of_the_cassette(tmp_path):
+    db_path = str(tmp_path / "keys.sqlite3")
+    cassette_path = str(tmp_path / "run.jsonl.gz")
+    _keys_db(db_path)
+
+    recording = Cassette("record", cassette_path)
+    assert (
+        _use_keys(recording, db_path, "secret_new_refresh_token")
+        == "secret_refresh_token"
+    )
+    recording.close()
+
+    with gzip.open(cassette_path, "rt", encoding="utf-8") as cassette_file:
+        recorded = cassette_file.read()
+    assert "secret" not in recorded
+    assert stat.S_IMODE(os.stat(cassette_path).st_mode) == 0o600
+
+    # The replay finds the statements whatever tokens they're given
+    replaying = Cassette("replay", cassette_path)
+    assert _use_keys(replaying, db_path, "another_refresh_token") == REDACTED
+    replaying.close()
+
+
+def test_existing_cassette_is_made_private(tmp_path):
+    cassette_path = tmp_path / "run.jsonl.gz"
+    cassette_path.write_bytes(b"")
+    os.chmod(cassette_path, 0o644)
+
+    recording = Cassette("record", str(cassette_path))
+    recording.call("operation", "request", lambda: "result")
+    recording.close()
+
+    assert stat.S_IMODE(os.stat(cassette_path).st_mode) == 0o600
+
+
+def test_redacted_response_keeps_the_other_values():
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"access_token": "secret_token", "expires_in": 3600}'
+    response.url = "https://sellercloud/rest/api/token"
+
+    recorded = redact_response(encode_response(response), ["access_token"])
+
+    assert "secret_token" not in recorded["body"]
+    assert '"expires_in": 3600' in recorded["body"]
+
+
+def test_local_state_and_patches_are_put_back_when_the_cassette_is_closed(tmp_path):
+    token_path = sellercloud_settings["token_path"]
+    target = types.SimpleNamespace(function=len)
+
+    recording = Cassette("record", str(tmp_path / "run.jsonl.gz"))
+    recording.patch(target, "function", str)
+    assert sellercloud_settings["token_path"] is None
+    assert target.function is str
+    recording.close()
+
+    assert sellercloud_settings["token_path"] == token_path
+    assert target.function is len
+
+    # Without a mode nothing is overridden
+    Cassette().patch(target, "function", str)
+    assert target.function is len
@@ -0,0 +1,29 @@
+from decimal import Decimal
+import pytest
+from decimal_rounding import from_cents, to_cents
+
+
+def test_to_cents_rounds_half_up_like_decimal():
+    assert to_cents(1.005) == 101
+    assert to_cents(Decimal("2.675")) == 268
+    assert to_cents(-1.005) == -101
+    assert to_cents([Decimal("1.005"), 2.5, 0]).tolist() == [101, 250, 0]
+    assert from_cents(to_cents(12.34)) == 12.34
+
+
+@pytest.mark.parametrize(
+    "amounts",
+    [
+        None,
+        float("nan"),
+        Decimal("NaN"),
+        float("inf"),
+        1e300,
+        [Decimal("1.005"), None, Decimal("2.50")],
+        [1.0, float("nan")],
+        [float("-inf")],
+    ],
+)
+def test_to_cents_rejects_amounts_that_are_not_valid(amounts):
+    with pytest.raises(ValueError):
+        to_cents(amounts)
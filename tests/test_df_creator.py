@@ -0,0 +1,248 @@
+import random
+from datetime import datetime
+from decimal import ROUND_HALF_UP, Decimal
+import pandas as pd
+import pytest
+from df_creator import DfCreator
+from file_handler import FileHandler
+from order import Order, OrderItems
+from seller_cloud_data import _add_order_data
+
+# The baseline appends to an empty dataframe, which pandas warns about
+pytestmark = pytest.mark.filterwarnings(
+    "ignore:The behavior of DataFrame concatenation:FutureWarning"
+)
+
+HEADERS = {
+    "default": [
+        "po_number",
+        "invoice_number",
+        "invoice_date",
+        "invoice_total_amount",
+        "invoice_subtotal_amount",
+        "invoice_tax_amount",
+        "line_item_sku",
+        "line_item_quantity",
+        "line_item_unit_cost",
+    ],
+    "aag": [
+        "Invoice Number",
+        "SONumber",
+        "Date",
+        "Customer",
+        "CarrierName",
+        "TrackingNumber",
+        "item",
+        "qty",
+        "price",
+    ],
+}
+
+
+def _old_round_to_decimal(number):
+    return float(Decimal(str(number)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))
+
+
+def _baseline_csv(file_format_name, orders):
+    """The csv DfCreator.populate_df wrote before the amounts were carried in cents,
+    appending the rows to the dataframe one by one."""
+    invoice_file_df = pd.DataFrame(columns=HEADERS[file_format_name])
+    for order in orders:
+        if file_format_name == "default":
+            row = {
+                "po_number": order["purchase_order_number"],
+                "invoice_number": order["order_id"],
+                "invoice_date": order["ship_date"],
+                "invoice_total_amount": order["subtotal"],
+                "invoice_subtotal_amount": _old_round_to_decimal(
+                    order["subtotal"] - order["tax"]
+                ),
+                "invoice_tax_amount": order["tax"],
+            }
+            for sku, quantity, unit_cost in order["items"]:
+                row["line_item_sku"] = sku
+                row["line_item_quantity"] = quantity
+                row["line_item_unit_cost"] = unit_cost
+                invoice_file_df = invoice_file_df._append(row, ignore_index=True)
+        else:
+            common = {
+                "Invoice Number": order["order_id"],
+                "SONumber": order["purchase_order_number"],
+                "Date": order["ship_date"],
+                "Customer": "auto_accessories_garage",
+                "CarrierName": "FEDEX_GROUND",
+                "TrackingNumber": order["tracking_number"],
+            }
+            lines = [
+                (sku, quantity, unit_cost * quantity)
+                for sku, quantity, unit_cost in order["items"]
+            ]
+            lines.append(("Taxes", 1, order["tax"]))
+            lines.append(("SHIPPING", 1, order["shipping"]))
+            for item, qty, price in lines:
+                invoice_file_df = invoice_file_df._append(
+                    dict(common, item=item, qty=qty, price=price), ignore_index=True
+                )
+    return invoice_file_df.to_csv(index=False)
+
+
+def _build_orders(rng, count, start=0):
+    """Builds ExampleDb orders with the SellerCloud data of each, some amounts as JSON integers."""
+    orders = []
+    for number in range(start, start + count):
+        items = [
+            (f"SKU-{number}-{line}", rng.randint(1, 4))
+            for line in range(rng.randint(0 if number % 7 == 3 else 1, 3))
+        ]
+        line_totals = [
+            rng.randint(5, 200) if rng.random() < 0.2 else round(rng.uniform(5, 200), 2)
+            for _ in items
+        ]
+        tax = 0 if number % 5 == 0 else round(sum(line_totals) * 0.07, 2)
+        grand_total = round(sum(line_totals) + tax, 2)
+        if number % 3 == 0:
+            grand_total = round(grand_total)
+        shipping = round(rng.uniform(0, 15), 2)
+        sellercloud_order = {
+            "TotalInfo": {"Tax": tax, "GrandTotal": grand_total},
+            "OrderItems": [
+                {"ProductIDOriginal": sku, "LineTotal": line_total}
+                for (sku, _), line_total in zip(items, line_totals)
+            ],
+        }
+        orders.append((number, items, shipping, sellercloud_order))
+    return orders
+
+
+def _new_order(number, items, shipping):
+    return Order(
+        items=OrderItems(
+            [sku for sku, _ in items], [quantity for _, quantity in items]
+        ),
+        purchase_order_id=number,
+        purchase_order_number=f"PO{number}",
+        sellercloud_order_id=str(number),
+        order_id=f"INV{number}",
+        shipping=round(shipping * 100),
+        code="DS",
+        tracking_number=f"1Z{number}",
+        ship_date="2024/01/02",
+        city="Miami",
+        state="FL",
+        country="US",
+        postal_code="33101",
+        address="1 Main St",
+        dropshipper_name="Dropshipper",
+    )
+
+
+def _old_order(number, items, shipping, sellercloud_order):
+    line_totals = {}
+    for product in sellercloud_order["OrderItems"]:
+        line_totals.setdefault(product["ProductIDOriginal"], product["LineTotal"])
+    return {
+        "purchase_order_number": f"PO{number}",
+        "order_id": f"INV{number}",
+        "ship_date": "2024/01/02",
+        "tracking_number": f"1Z{number}",
+        "shipping": _old_round_to_decimal(shipping),
+        "tax": sellercloud_order["TotalInfo"]["Tax"],
+        "subtotal": sellercloud_order["TotalInfo"]["GrandTotal"],
+        "items": [
+            (sku, quantity, line_totals[sku] / quantity) for sku, quantity in items
+        ],
+    }
+
+
+def _csv(df_creator):
+    return df_creator.invoice_file_df.to_csv(index=False)
+
+
+def _prepare(built_orders, file_format_name, invoice_file=None):
+    """Prices the orders and builds their rows, returning the rows and the baseline csv."""
+    orders = []
+    old_orders = []
+    for number, items, shipping, sellercloud_order in built_orders:
+        order = _new_order(number, items, shipping)
+        assert _add_order_data(order, sellercloud_order)
+        orders.append(order)
+        old_orders.append(_old_order(number, items, shipping, sellercloud_order))
+
+    df_creator = DfCreator(
+        HEADERS, {"file_format_name": file_format_name}, invoice_file
+    )
+    rows_by_order, failed_orders = df_creator.prepare_orders(orders)
+    assert failed_orders == []
+    return (
+        df_creator,
+        [rows_by_order.get(order, ()) for order in orders],
+        _baseline_csv(file_format_name, old_orders),
+    )
+
+
+@pytest.mark.parametrize("file_format_name", ["default", "aag"])
+@pytest.mark.parametrize("seed", range(5))
+def test_csv_matches_baseline_df_creator(file_format_name, seed):
+    df_creator, order_rows, baseline_csv = _prepare(
+        _build_orders(random.Random(seed), 200), file_format_name
+    )
+    assert df_creator.add_rows([row for rows in order_rows for row in rows])
+
+    assert _csv(df_creator) == baseline_csv
+
+
+# The first order decides which columns are float columns: integral amounts, float amounts,
+# and for aag an order without items, which starts with its Taxes row
+@pytest.mark.parametrize("start", [0, 1, 3])
+@pytest.mark.parametrize("file_format_name", ["default", "aag"])
+@pytest.mark.parametrize("seed", range(3))
+def test_streamed_file_matches_baseline_df_creator(
+    monkeypatch, tmp_path, file_format_name, seed, start
+):
+    file_path = tmp_path / "Invoice.csv"
+    f_handler = FileHandler(datetime(2024, 1, 2))
+    monkeypatch.setattr(f_handler, "_create_file_path", lambda _: str(file_path))
+    invoice_file = f_handler.open_invoice_file("folder", HEADERS[file_format_name])
+
+    df_creator, order_rows, baseline_csv = _prepare(
+        _build_orders(random.Random(seed), 100, start), file_format_name, invoice_file
+    )
+    # Streaming the rows order by order, like the orders are invoiced
+    for rows in order_rows:
+        assert df_creator.add_rows(rows)
+    assert df_creator.rows == []
+
+    assert invoice_file.close() == str(file_path)
+    with open(file_path, newline="", encoding="utf-8") as file:
+        assert file.read() == baseline_csv
+
+
+def test_streamed_file_is_not_created_without_rows(monkeypatch, tmp_path):
+    f_handler = FileHandler(datetime(2024, 1, 2))
+    monkeypatch.setattr(
+        f_handler, "_create_file_path", lambda _: str(tmp_path / "Invoice.csv")
+    )
+    invoice_file = f_handler.open_invoice_file("folder", HEADERS["default"])
+    invoice_file.write_rows([])
+
+    assert invoice_file.close() is False
+    assert not (tmp_path / "Invoice.csv").exists()
+
+
+def test_integral_grand_total_is_written_without_decimals():
+    order = _new_order(1, [("SKU", 2)], 5)
+    assert _add_order_data(
+        order,
+        {
+            "TotalInfo": {"Tax": 0, "GrandTotal": 100},
+            "OrderItems": [{"ProductIDOriginal": "SKU", "LineTotal": 100}],
+        },
+    )
+
+    df_creator = DfCreator(HEADERS, {"file_format_name": "default"})
+    rows_by_order, _ = df_creator.prepare_orders([order])
+    df_creator.add_rows(rows_by_order[order])
+
+    assert (
+        _csv(df_creator).splitlines()[1] == "PO1,INV1,2024/01/02,100,100.0,0,SKU,2,50.0"
+    )
@@ -0,0 +1,29 @@
+import pytest
+from quickbooks.objects import Invoice, SalesItemLine, SalesItemLineDetail
+from invoice import QbInvoice
+
+
+def _invoice(amount):
+    line = SalesItemLine()
+    line.Amount = str(amount)
+    line.Description = "SKU-1"
+    line.SalesItemLineDetail = SalesItemLineDetail()
+    line.SalesItemLineDetail.Qty = 1
+
+    invoice = Invoice()
+    invoice.DocNumber = "DS900001"
+    invoice.TxnDate = "2024-01-02"
+    invoice.Line = [line]
+    return invoice
+
+
+@pytest.mark.parametrize("amount", [0, 12.34, -5.0, QbInvoice.AMOUNT_MAX])
+def test_valid_amounts_pass(amount):
+    assert QbInvoice.__new__(QbInvoice)._validate_invoice(_invoice(amount)) is None
+
+
+@pytest.mark.parametrize(
+    "amount", [float("nan"), float("inf"), -92233720368547758.08, 1e11]
+)
+def test_amounts_out_of_range_are_rejected(amount):
+    assert QbInvoice.__new__(QbInvoice)._validate_invoice(_invoice(amount))
@@ -0,0 +1,99 @@
+from concurrent.futures import Future
+import pytest
+import seller_cloud_data
+from order import Order, OrderItems
+from seller_cloud_data import _add_sellercloud_data
+from sellercloud_cache import SellerCloudCache
+
+
+def _order(number, items):
+    return Order(
+        items=OrderItems(
+            [sku for sku, _ in items], [quantity for _, quantity in items]
+        ),
+        purchase_order_id=number,
+        purchase_order_number=f"PO{number}",
+        sellercloud_order_id=str(number),
+        order_id=f"INV{number}",
+        shipping=500,
+        code="DS",
+        tracking_number=f"1Z{number}",
+        ship_date="2024/01/02",
+        city="Miami",
+        state="FL",
+        country="US",
+        postal_code="33101",
+        address="1 Main St",
+        dropshipper_name="Dropshipper",
+    )
+
+
+def _sellercloud_order(line_totals):
+    return {
+        "TotalInfo": {"Tax": 1.5, "GrandTotal": sum(line_totals.values()) + 1.5},
+        "OrderItems": [
+            {"ProductIDOriginal": sku, "LineTotal": line_total}
+            for sku, line_total in line_totals.items()
+        ],
+    }
+
+
+def _fetched(sellercloud_order):
+    fetch = Future()
+    fetch.set_result(sellercloud_order)
+    return fetch
+
+
+def test_orders_that_cant_be_priced_are_removed_from_the_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(seller_cloud_data, "notify", lambda *args: None)
+    cache = SellerCloudCache(str(tmp_path / "cache.sqlite3"), 3600, 100)
+    priced = _sellercloud_order({"SKU-1": 10.0})
+    # The order has a sku SellerCloud doesn't have
+    mismatched = _sellercloud_order({"SKU-1": 10.0})
+    cache.put("1", priced)
+    cache.put("2", mismatched)
+
+    orders = [_order(1, [("SKU-1", 1)]), _order(2, [("SKU-1", 1), ("SKU-2", 1)])]
+    dropshippers = dict(
+        _add_sellercloud_data(
+            {"DS": {"orders": orders}},
+            {"DS": [_fetched(priced), _fetched(mismatched)]},
+            None,
+            cache,
+        )
+    )
+
+    assert dropshippers["DS"]["orders"] == orders[:1]
+    assert cache.get("1") == priced
+    assert cache.get("2") is None
+    cache.close()
+
+
+def test_order_with_a_missing_amount_is_left_out(monkeypatch):
+    notifications = []
+    monkeypatch.setattr(
+        seller_cloud_data, "notify", lambda *args: notifications.append(args)
+    )
+    order = _order(1, [("SKU-1", 1)])
+    sellercloud_order = _sellercloud_order({"SKU-1": 10.0})
+    sellercloud_order["OrderItems"][0]["LineTotal"] = None
+
+    assert not seller_cloud_data._add_order_data(order, sellercloud_order)
+    assert len(notifications) == 1
+    assert order.items.line_totals is None
+
+
+@pytest.mark.parametrize("quantity", [0, -1])
+def test_order_with_non_positive_quantity_is_left_out(monkeypatch, quantity):
+    notifications = []
+    monkeypatch.setattr(
+        seller_cloud_data, "notify", lambda *args: notifications.append(args)
+    )
+    order = _order(1, [("SKU-1", 1), ("SKU-2", quantity)])
+
+    assert not seller_cloud_data._add_order_data(
+        order, _sellercloud_order({"SKU-1": 10, "SKU-2": 10})
+    )
+    assert len(notifications) == 1
+    assert "SKU-2" in notifications[0][0]
+    assert order.items.line_totals is None
@@ -0,0 +1,266 @@
+import bisect
+import json
+import math
+import threading
+import time
+from collections import deque
+from config import tracing_settings
+from atomic_write import write_atomically
+
+
+class Span:
+    """A timed operation. bytes and attributes can be set while it runs, an exception marks it as failed."""
+
+    __slots__ = (
+        "tracer",
+        "name",
+        "attributes",
+        "bytes",
+        "start",
+        "duration",
+        "error",
+        "_started",
+    )
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.bytes = 0
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        self.tracer._record(self)
+        return False
+
+
+class _NullSpan:
+    """Span used when tracing is disabled, it records nothing."""
+
+    def __init__(self):
+        self.attributes = {}
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class LatencyHistogram:
+    """
+    Latencies of an operation counted in exponential buckets, so recording is a bisect and the
+    percentiles are estimated within a bucket's width (about 9% of the value) with fixed memory.
+    """
+
+    # Bucket upper bounds from 0.1 ms to about an hour, each one 2^(1/4) times the previous
+    BOUNDS = [0.0001 * 2 ** (index / 4) for index in range(100)]
+
+    def __init__(self):
+        self.counts = [0] * (len(LatencyHistogram.BOUNDS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, duration, bytes=0, error=False):
+        self.counts[bisect.bisect_left(LatencyHistogram.BOUNDS, duration)] += 1
+        self.count += 1
+        self.sum += duration
+        self.bytes += bytes
+        if error:
+            self.errors += 1
+        if duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        """Adds the latencies counted by another histogram."""
+        self.counts = [
+            count + other_count for count, other_count in zip(self.counts, other.counts)
+        ]
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Estimates the percentile from the buckets, interpolating inside the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank:
+                lower = LatencyHistogram.BOUNDS[index - 1] if index else 0.0
+                upper = (
+                    LatencyHistogram.BOUNDS[index]
+                    if index < len(LatencyHistogram.BOUNDS)
+                    else self.max
+                )
+                value = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(value, self.max)
+            seen += bucket_count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "total_s": self.sum,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+        }
+
+
+class Tracer:
+    """
+    Records spans around the run's I/O (SellerCloud, QuickBooks, the databases, FTP and email)
+    and keeps a latency histogram per operation, exported at the end of the run to a JSON file
+    and/or a Prometheus textfile.
+    Only the most recent max_spans spans are kept, the histograms count all of them.
+    """
+
+    def __init__(self, enabled=True, max_spans=10000):
+        self.enabled = enabled
+        self.spans = deque(maxlen=max_spans)
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        """Times the block it wraps as an operation called name."""
+        if not self.enabled:
+            return _NullSpan()
+        return Span(self, name, attributes)
+
+    def _record(self, span):
+        with self._lock:
+            self.spans.append(span)
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = LatencyHistogram()
+            histogram.add(span.duration, span.bytes, span.error is not None)
+
+    def take_histograms(self):
+        """Takes the histograms out of the tracer and starts over."""
+        with self._lock:
+            histograms, self.histograms = self.histograms, {}
+            self.spans.clear()
+        return histograms
+
+    def merge(self, histograms):
+        """Adds the histograms another tracer took, its spans are only counted in them."""
+        with self._lock:
+            for name, histogram in histograms.items():
+                self.histograms.setdefault(name, LatencyHistogram()).merge(histogram)
+
+    def summary(self):
+        """Gets the latency summary of each operation."""
+        with self._lock:
+            return {
+                name: histogram.summary()
+                for name, histogram in sorted(self.histograms.items())
+            }
+
+    def export(self, run_date):
+        """Writes the run's spans and summaries to the paths in tracing_settings and starts over."""
+        if not self.enabled:
+            return
+        with self._lock:
+            spans = list(self.spans)
+        summary = self.summary()
+
+        json_path = tracing_settings["json_path"]
+        if json_path:
+            json_path = json_path.format(run_date=run_date.strftime("%m%d%Y_%H%M%S"))
+            self._write(
+                json_path,
+                json.dumps(
+                    {
+                        "run_date": run_date.isoformat(),
+                        "operations": summary,
+                        "spans": [
+                            {
+                                "name": span.name,
+                                "start": span.start,
+                                "duration_s": span.duration,
+                                "bytes": span.bytes,
+                                "error": span.error,
+                                "attributes": span.attributes,
+                            }
+                            for span in spans
+                        ],
+                    },
+                    default=str,
+                ),
+            )
+
+        if tracing_settings["prometheus_path"]:
+            self._write(tracing_settings["prometheus_path"], self._prometheus(summary))
+
+        with self._lock:
+            self.spans.clear()
+            self.histograms = {}
+
+    def _prometheus(self, summary):
+        """Formats the summaries in the Prometheus text format."""
+        lines = [
+            "# HELP invoicing_operation_seconds Latency of the invoicing run's operations.",
+            "# TYPE invoicing_operation_seconds summary",
+        ]
+        for name, operation in summary.items():
+            for quantile, key in (
+                ("0.5", "p50_s"),
+                ("0.95", "p95_s"),
+                ("0.99", "p99_s"),
+            ):
+                lines.append(
+                    f'invoicing_operation_seconds{{operation="{name}",quantile="{quantile}"}} '
+                    f"{operation[key]}"
+                )
+            lines.append(
+                f'invoicing_operation_seconds_sum{{operation="{name}"}} {operation["total_s"]}'
+            )
+            lines.append(
+                f'invoicing_operation_seconds_count{{operation="{name}"}} {operation["count"]}'
+            )
+        for metric, key, help in (
+            ("invoicing_operation_errors_total", "errors", "Failed operations."),
+            ("invoicing_operation_bytes_total", "bytes", "Bytes sent or received."),
+        ):
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, operation in summary.items():
+                lines.append(f'{metric}{{operation="{name}"}} {operation[key]}')
+        return "\n".join(lines) + "\n"
+
+    def _write(self, path, content):
+        try:
+            # A collector never reads a half written file
+            write_atomically(path, content)
+        except OSError as e:
+            print(f"Error while saving the run trace: {e}")
+
+
+# Tracer of the current run
+tracer = Tracer(tracing_settings["enabled"], tracing_settings["max_spans"])
+
+
+def span(name, **attributes):
+    """Times the block it wraps as an operation called name."""
+    return tracer.span(name, **attributes)